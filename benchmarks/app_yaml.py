@@ -0,0 +1,81 @@
+# Copyright 2015 tsuru-unit-agent authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Measures how long loading a large tsuru.yaml takes at startup.
+
+    python benchmarks/app_yaml.py [runs] [number of hooks]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tsuru_unit_agent import tasks  # noqa
+
+
+def measure(func, runs):
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    times.sort()
+    return times[0], times[len(times) // 2]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    working_dir = tempfile.mkdtemp()
+    cache_path = os.path.join(working_dir, ".app_yaml_cache")
+    data = {
+        "hooks": {
+            "build": ["echo build step {} && ls -la /tmp".format(i) for i in range(size)],
+            "restart": {
+                "before": ["echo before {}".format(i) for i in range(size)],
+                "after-each": ["echo after {}".format(i) for i in range(size)],
+            },
+        },
+        "healthcheck": {"path": "/healthcheck", "status": 200},
+    }
+    path = os.path.join(working_dir, "tsuru.yaml")
+    with open(path, "w") as f:
+        yaml.dump(data, f, default_flow_style=False)
+
+    def pure_python():
+        with open(path) as f:
+            yaml.load(f.read(), Loader=yaml.Loader)
+
+    def uncached():
+        tasks._app_yaml_cache.clear()
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        tasks.load_app_yaml(working_dir, cache_path=cache_path)
+
+    def snapshot():
+        tasks._app_yaml_cache.clear()
+        tasks.load_app_yaml(working_dir, cache_path=cache_path)
+
+    def in_process():
+        tasks.load_app_yaml(working_dir, cache_path=cache_path)
+
+    try:
+        for name, func in [("pure python loader", pure_python),
+                           ("{} (no cache)".format(tasks.yaml_loader().__name__), uncached),
+                           ("on-disk snapshot", snapshot),
+                           ("in-process cache", in_process)]:
+            best, median = measure(func, runs)
+            print "{:<24} min {:9.3f}ms  median {:9.3f}ms".format(name, best * 1000, median * 1000)
+    finally:
+        shutil.rmtree(working_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# Copyright 2015 tsuru-unit-agent authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Compares the latency of parsing apprc in process and through the shell.
+
+The shell path forks a shell and a second python interpreter, which is what
+a unit used to pay at startup when the API was unreachable.
+
+    python benchmarks/apprc.py [runs] [number of envs]
+"""
+
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tsuru_unit_agent import tasks  # noqa
+
+
+def measure(func, path, runs):
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        func(path)
+        times.append(time.time() - start)
+    times.sort()
+    return times[0], times[len(times) // 2]
+
+
+def parse_with_shell(path):
+    # every line through the shell, as when none of them is recognised.
+    with io.open(path, encoding="utf-8") as f:
+        return tasks._parse_apprc_lines_with_shell(f.read().splitlines(), {})
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    envs = {"VAR_{}".format(i): u"value '{}' with \"quotes\"\n$HOME".format(i) for i in range(size)}
+    fd, path = tempfile.mkstemp(prefix="apprc")
+    os.close(fd)
+    try:
+        tasks.save_apprc_file(envs, file_path=path)
+        for name, func in [("native", tasks.parse_apprc_file),
+                           ("shell", parse_with_shell)]:
+            try:
+                best, median = measure(func, path, runs)
+            except Exception as e:
+                print "{:<8} unavailable: {!r}".format(name, e)
+                continue
+            print "{:<8} min {:8.3f}ms  median {:8.3f}ms".format(name, best * 1000, median * 1000)
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
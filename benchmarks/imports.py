@@ -0,0 +1,57 @@
+# Copyright 2015 tsuru-unit-agent authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Measures cold import time of the agent entry points.
+
+    python benchmarks/imports.py [runs] [budget in ms]
+
+Each run imports the module in a fresh interpreter; the interpreter
+startup itself is subtracted. Exits with 1 when the median of any module
+goes over the budget.
+"""
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ["tsuru_unit_agent.main", "tsuru_unit_agent.stream", "tsuru_unit_agent.affinity"]
+
+PROBE = """
+import sys, time
+start = time.time()
+if sys.argv[1]:
+    __import__(sys.argv[1])
+sys.stdout.write("{} {}".format(time.time() - start, len(sys.modules)))
+"""
+
+
+def cold_import(module, runs):
+    times = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, "-c", PROBE, module], cwd=ROOT)
+        elapsed, modules = output.split()
+        times.append(float(elapsed))
+    times.sort()
+    return times[0], times[len(times) // 2], int(modules)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    budget = float(sys.argv[2]) if len(sys.argv) > 2 else 250
+    _, _, baseline = cold_import("", 1)
+    over = False
+    for module in MODULES:
+        best, median, modules = cold_import(module, runs)
+        print "{:<26} min {:8.1f}ms  median {:8.1f}ms  {:4d} modules (+{})".format(
+            module, best * 1000, median * 1000, modules, modules - baseline)
+        over = over or median * 1000 > budget
+    if over:
+        print "over the {:.0f}ms budget".format(budget)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
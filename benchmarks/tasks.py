@@ -0,0 +1,274 @@
+# Copyright 2015 tsuru-unit-agent authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Measures time and peak memory of the tasks module at scale.
+
+    python benchmarks/tasks.py [--runs N] [--scale F] [--exec-mb N] [--output FILE] [--compare FILE] [CASE...]
+
+Each case runs in a fresh interpreter inside its own temp dir, so the peak
+RSS reported (ru_maxrss, KB on Linux) is its own; hook output is counted
+separately as the peak of the child processes. --scale multiplies the
+sizes of the generated Procfile, envs and tsuru.yaml. --output writes the
+results as JSON, --compare prints the ratios against such a file.
+"""
+
+import argparse
+import collections
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tsuru_unit_agent import tasks  # noqa
+
+CASES = collections.OrderedDict()
+
+ROW = "{:<28} min {:10.3f}ms  median {:10.3f}ms  peak rss {:8d}KB (setup {:8d}KB, children {:8d}KB)"
+
+# Values a shell would choke on unless they're quoted properly.
+AWKWARD_VALUES = [
+    u"it's \"quoted\" and 'single quoted'",
+    u"multi\nline\n\tvalue\n",
+    u"$HOME ${PATH} $(uname -a) `id` \\$escaped",
+    u"back\\slash\\\\es and ; | & < > ~ * ?",
+    u"''''",
+    u"unicode \xe9\xe8 \u4e2d\u6587 \U0001f600",
+    u"",
+    u"plain-value_123",
+]
+
+
+def case(name):
+    def decorator(func):
+        CASES[name] = func
+        return func
+    return decorator
+
+
+def awkward_envs(size):
+    return {"VAR_{}".format(i): u"{} #{}".format(AWKWARD_VALUES[i % len(AWKWARD_VALUES)], i)
+            for i in range(size)}
+
+
+@case("write_circus_conf")
+def circus_conf(tmp, args):
+    size = int(500 * args.scale)
+    envs = {"VAR_{}".format(i): "value-{}".format(i) for i in range(int(2000 * args.scale))}
+    envs["PORT"] = "8888"
+    procfile_path = os.path.join(tmp, "Procfile")
+    with open(procfile_path, "w") as f:
+        for i in range(size):
+            refs = " ".join("--opt{0}=$VAR_{1} --raw{0}=${{VAR_{1}}}".format(j, (i * 20 + j) % len(envs))
+                            for j in range(20))
+            f.write("proc{}: ./bin/run --port $PORT {}\n".format(i, refs))
+    conf_path = os.path.join(tmp, "circus.ini")
+
+    def run():
+        # a fresh conf every run, not the unchanged-content shortcut.
+        for path in (conf_path, conf_path + ".base"):
+            if os.path.exists(path):
+                os.remove(path)
+        tasks.write_circus_conf(procfile_path, conf_path, envs=envs, circus_endpoint="", app_data={})
+    return run
+
+
+@case("save_apprc_file")
+def save_apprc(tmp, args):
+    envs = awkward_envs(int(5000 * args.scale))
+    path = os.path.join(tmp, "apprc")
+
+    def run():
+        if os.path.exists(path):
+            os.remove(path)
+        tasks.save_apprc_file(envs, file_path=path)
+    return run
+
+
+@case("save_apprc_file (unchanged)")
+def save_apprc_unchanged(tmp, args):
+    envs = awkward_envs(int(5000 * args.scale))
+    path = os.path.join(tmp, "apprc")
+    tasks.save_apprc_file(envs, file_path=path)
+    return lambda: tasks.save_apprc_file(envs, file_path=path)
+
+
+@case("parse_apprc_file")
+def parse_apprc(tmp, args):
+    envs = awkward_envs(int(5000 * args.scale))
+    path = os.path.join(tmp, "apprc")
+    tasks.save_apprc_file(envs, file_path=path)
+    if tasks.parse_apprc_file(path) != envs:
+        raise AssertionError("apprc did not round trip")
+    return lambda: tasks.parse_apprc_file(path)
+
+
+def write_app_yaml(tmp, scale):
+    size = int(2000 * scale)
+    data = {
+        "hooks": {
+            "build": ["echo build step {} && ls -la /tmp".format(i) for i in range(size)],
+            "restart": {
+                "before": ["echo before {}".format(i) for i in range(size)],
+                "after": ["echo after {}".format(i) for i in range(size)],
+            },
+        },
+        "processes": {"proc{}".format(i): {"numprocesses": 2, "rlimits": {"nofile": 4096}}
+                      for i in range(size // 10)},
+        "healthcheck": {"path": "/healthcheck", "status": 200},
+    }
+    with open(os.path.join(tmp, "tsuru.yaml"), "w") as f:
+        yaml.dump(data, f, default_flow_style=False)
+
+
+@case("load_app_yaml")
+def app_yaml(tmp, args):
+    write_app_yaml(tmp, args.scale)
+    cache_path = os.path.join(tmp, ".app_yaml_cache")
+
+    def run():
+        tasks._app_yaml_cache.clear()
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        tasks.load_app_yaml(tmp, cache_path=cache_path)
+    return run
+
+
+@case("load_app_yaml (snapshot)")
+def app_yaml_snapshot(tmp, args):
+    write_app_yaml(tmp, args.scale)
+    cache_path = os.path.join(tmp, ".app_yaml_cache")
+    tasks.load_app_yaml(tmp, cache_path=cache_path)
+
+    def run():
+        tasks._app_yaml_cache.clear()
+        tasks.load_app_yaml(tmp, cache_path=cache_path)
+    return run
+
+
+@case("exec_with_envs")
+def exec_hooks(tmp, args):
+    half = (args.exec_mb << 20) // 2
+    line = "x" * 99
+    # half of the output on each stream, as framed lines.
+    command = "(yes {0} | head -c {1}) & (yes {0} | head -c {1} >&2); wait".format(line, half)
+    # lines are framed by the streams but shipped nowhere.
+    envs = {"TSURU_APPNAME": "", "TSURU_HOST": "", "TSURU_SYSLOG_SERVER": "", "LOG_CAPTURE_PATH": ""}
+    devnull = os.open(os.devnull, os.O_WRONLY)
+
+    def run():
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved = os.dup(1), os.dup(2)
+        # the streams echo everything.
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        try:
+            tasks.exec_with_envs([command], with_shell=True, working_dir=tmp, pipe_output=True, envs=envs)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+    run.runs = args.exec_runs
+    return run
+
+
+def run_case(name, args):
+    tmp = tempfile.mkdtemp(prefix="tasks-bench-")
+    try:
+        func = CASES[name](tmp, args)
+        setup_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        times = []
+        for _ in range(getattr(func, "runs", args.runs)):
+            start = time.time()
+            func()
+            times.append(time.time() - start)
+    finally:
+        shutil.rmtree(tmp)
+    times.sort()
+    return {
+        "runs": len(times),
+        "min_ms": round(times[0] * 1000, 3),
+        "median_ms": round(times[len(times) // 2] * 1000, 3),
+        "setup_rss_kb": setup_rss,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "children_peak_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+def measure(name, args):
+    fd, result_path = tempfile.mkstemp(prefix="tasks-bench-", suffix=".json")
+    os.close(fd)
+    try:
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), "--child", name, "--result", result_path,
+                               "--runs", str(args.runs), "--exec-runs", str(args.exec_runs),
+                               "--scale", str(args.scale), "--exec-mb", str(args.exec_mb)])
+        with open(result_path) as f:
+            return json.load(f)
+    finally:
+        os.remove(result_path)
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    for key in ("scale", "exec_mb"):
+        if baseline.get(key) != results[key]:
+            print "warning: baseline {} is {}, not {}".format(key, baseline.get(key), results[key])
+    for name, result in results["cases"].items():
+        base = baseline["cases"].get(name)
+        if not base:
+            continue
+        print "{:<28} median x{:5.2f}  peak rss x{:5.2f}".format(
+            name, result["median_ms"] / max(base["median_ms"], 0.001),
+            float(result["peak_rss_kb"]) / max(base["peak_rss_kb"], 1))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cases", nargs="*", metavar="CASE", help="one of: " + ", ".join(CASES))
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--exec-runs", type=int, default=1)
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--exec-mb", type=int, default=256)
+    parser.add_argument("--output")
+    parser.add_argument("--compare")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        result = run_case(args.child, args)
+        with open(args.result, "w") as f:
+            json.dump(result, f)
+        return
+    names = args.cases or list(CASES)
+    for name in names:
+        if name not in CASES:
+            parser.error("unknown case {!r}".format(name))
+    results = {"python": sys.version.split()[0], "scale": args.scale, "exec_mb": args.exec_mb,
+               "cases": collections.OrderedDict()}
+    for name in names:
+        result = results["cases"][name] = measure(name, args)
+        print ROW.format(name, result["min_ms"], result["median_ms"], result["peak_rss_kb"],
+                         result["setup_rss_kb"], result["children_peak_rss_kb"])
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True, separators=(",", ": "))
+            f.write("\n")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
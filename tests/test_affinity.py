@@ -0,0 +1,28 @@
+import unittest
+
+import mock
+
+from tsuru_unit_agent.affinity import cpu_for_worker, main
+
+
+class AffinityTest(unittest.TestCase):
+
+    def test_cpu_for_worker(self):
+        cpus = [2, 3, 5]
+        self.assertEqual([cpu_for_worker(wid, cpus) for wid in ["1", "2", "3", "4"]], [2, 3, 5, 2])
+
+    def test_main(self):
+        with mock.patch("tsuru_unit_agent.affinity.os", spec=["execvp"]) as os_mock:
+            main(["2", "0,1", "--", "python", "app.py"])
+        os_mock.execvp.assert_called_once_with(
+            "taskset", ["taskset", "-c", "1", "python", "app.py"])
+
+    @mock.patch("tsuru_unit_agent.affinity.os")
+    def test_main_sched_setaffinity(self, os_mock):
+        main(["3", "4,6", "--", "python", "app.py"])
+        os_mock.sched_setaffinity.assert_called_once_with(0, [4])
+        os_mock.execvp.assert_called_once_with("python", ["python", "app.py"])
+
+    @mock.patch("sys.stderr")
+    def test_main_invalid_args(self, stderr_mock):
+        self.assertRaises(SystemExit, main, ["1", "0", "python"])
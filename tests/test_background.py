@@ -0,0 +1,33 @@
+import threading
+import unittest
+
+from tsuru_unit_agent.background import BackgroundCall
+
+
+class BackgroundCallTest(unittest.TestCase):
+
+    def test_result(self):
+        call = BackgroundCall(lambda a, b=0: a + b, 1, b=2)
+        self.assertTrue(call.daemon)
+        self.assertEqual(call.result(), 3)
+
+    def test_result_reraises(self):
+        def fail():
+            raise ValueError("boom")
+        call = BackgroundCall(fail)
+        with self.assertRaises(ValueError) as cm:
+            call.result()
+        self.assertEqual(str(cm.exception), "boom")
+
+    def test_runs_concurrently(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def wait():
+            started.set()
+            return release.wait(5)
+        call = BackgroundCall(wait)
+        self.assertTrue(started.wait(5))
+        self.assertTrue(call.is_alive())
+        release.set()
+        self.assertTrue(call.result())
@@ -0,0 +1,132 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from tsuru_unit_agent import capture
+from tsuru_unit_agent.capture import MAGIC, Capture, Record, Replay, open_capture, read_capture
+from tsuru_unit_agent.stream import Stream
+
+
+class CaptureTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "capture")
+
+    def read(self):
+        with open(self.path, "rb") as f:
+            return list(read_capture(f))
+
+    def test_write_read(self):
+        c = Capture(self.path)
+        c.write("web", "stdout", "line 1\n", now=10.5)
+        c.write("web", "stderr", u"\ufffd\n", now=11)
+        c.write(None, None, "", now=12)
+        c.close()
+        self.assertEqual(self.read(), [Record(10.5, "web", "stdout", "line 1\n"),
+                                       Record(11, "web", "stderr", u"\ufffd\n".encode("utf-8")),
+                                       Record(12, "", "", "")])
+
+    def test_reopen_appends(self):
+        Capture(self.path).write("web", "stdout", "a\n", now=1)
+        Capture(self.path).write("web", "stdout", "b\n", now=2)
+        self.assertEqual([r.data for r in self.read()], ["a\n", "b\n"])
+
+    def test_max_bytes(self):
+        c = Capture(self.path, max_bytes=len(MAGIC) + capture.RECORD.size + 16)
+        c.write("web", "stdout", "line 1\n")
+        c.write("web", "stdout", "line 2\n")
+        self.assertEqual(c.dropped, 1)
+        self.assertEqual(c.written, os.path.getsize(self.path))
+        self.assertEqual([r.data for r in self.read()], ["line 1\n"])
+
+    def test_read_invalid(self):
+        self.assertRaises(ValueError, list, read_capture(io.BytesIO(b"garbage")))
+        c = Capture(self.path)
+        c.write("web", "stdout", "line 1\n")
+        with open(self.path, "rb") as f:
+            data = f.read()
+        self.assertEqual(len(list(read_capture(io.BytesIO(data)))), 1)
+        self.assertEqual(list(read_capture(io.BytesIO(data[:-1]))), [])
+        self.assertEqual(list(read_capture(io.BytesIO(data[:len(MAGIC) + 2]))), [])
+
+    def test_open_capture_shared(self):
+        self.addCleanup(capture._captures.pop, self.path)
+        self.assertIs(open_capture(self.path), open_capture(self.path))
+
+    def test_stream_tap(self):
+        self.addCleanup(capture._captures.pop, self.path)
+        queue = mock.Mock()
+        stream = Stream(watcher_name="web", queue=queue,
+                        envs={"TSURU_APPNAME": "app1", "TSURU_HOST": "http://tsuru", "TSURU_APP_TOKEN": "x",
+                              "LOG_CAPTURE_PATH": self.path})
+        stream({"data": "line 1\nline", "name": "stdout"})
+        stream({"data": " 2\n", "name": "stderr"})
+        records = self.read()
+        self.assertEqual([(r.watcher, r.name, r.data) for r in records],
+                         [("web", "stdout", "line 1\nline"), ("web", "stderr", " 2\n")])
+        self.assertEqual(queue.put_nowait.call_count, 2)
+        self.assertEqual(stream.stats()["capture_dropped"], 0)
+
+    def test_stream_without_tap(self):
+        stream = Stream(watcher_name="web", queue=mock.Mock(), envs={"LOG_CAPTURE_PATH": ""})
+        self.assertIsNone(stream.capture)
+        self.assertNotIn("capture_bytes", stream.stats())
+
+
+class ReplayTestCase(unittest.TestCase):
+
+    def records(self, count=20):
+        return [Record(100 + i * 0.01, "web" if i % 2 else "worker", "stdout", "line {}\n".format(i))
+                for i in range(count)]
+
+    def test_replay(self):
+        report = Replay().run(self.records(), speed=0, timeout=10)
+        self.assertEqual(report["records"], 20)
+        self.assertEqual(report["lines_enqueued"], 20)
+        self.assertEqual(report["lines_received"], 20)
+        self.assertEqual(report["lines_dropped"], 0)
+        self.assertEqual(report["writers_alive"], 0)
+        self.assertIsNotNone(report["latency_p99_ms"])
+        self.assertNotIn("syslog_datagrams", report)
+
+    def test_replay_original_timing(self):
+        report = Replay().run(self.records(11), speed=1, timeout=10)
+        self.assertGreaterEqual(report["feed_seconds"], 0.09)
+        report = Replay().run(self.records(11), speed=2, timeout=10)
+        self.assertGreaterEqual(report["feed_seconds"], 0.045)
+        self.assertLess(report["feed_seconds"], 0.09)
+
+    def test_replay_collector(self):
+        report = Replay(collector=True).run(self.records(), speed=0, timeout=10)
+        self.assertEqual(report["lines_received"], 20)
+        self.assertEqual(report["lines_dropped"], 0)
+
+    def test_replay_drops(self):
+        # one tiny queue per stream, lines beyond it are refused.
+        report = Replay(envs={"LOG_MAX_QUEUE_BYTES": "1"}).run(self.records(), speed=0, timeout=10)
+        self.assertEqual(report["lines_received"], 0)
+        self.assertEqual(report["lines_refused"], 20)
+        self.assertEqual(report["lines_dropped"], 20)
+
+    def test_replay_syslog(self):
+        report = Replay(syslog=True).run(self.records(4), speed=0, timeout=10)
+        self.assertEqual(report["lines_received"], 4)
+        self.assertIn("syslog_datagrams", report)
+
+    def test_main(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, "capture")
+        c = Capture(path)
+        for r in self.records(4):
+            c.write(r.watcher, r.name, r.data, now=r.time)
+        c.close()
+        with mock.patch("sys.stdout", io.BytesIO()) as stdout:
+            capture.main(["replay", path, "--speed", "0"])
+        self.assertIn('"lines_received": 4', stdout.getvalue())
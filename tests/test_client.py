@@ -2,7 +2,9 @@ import unittest
 import mock
 from socket import gethostname
 
-from tsuru_unit_agent.client import Client
+from requests.exceptions import ConnectionError, ConnectTimeout
+
+from tsuru_unit_agent.client import Client, DeadlineExceeded
 
 
 class TestClient(unittest.TestCase):
@@ -10,8 +12,11 @@ class TestClient(unittest.TestCase):
         client = Client("http://localhost", "token")
         self.assertEqual(client.url, "http://localhost")
         self.assertEqual(client.token, "token")
+        adapter = client.session.get_adapter("https://localhost")
+        self.assertIs(adapter, client.session.get_adapter("http://localhost"))
+        self.assertEqual(adapter._pool_maxsize, 4)
 
-    @mock.patch("requests.post")
+    @mock.patch("requests.Session.post")
     def test_register_unit(self, post_mock):
         response = post_mock.return_value
         response.status_code = 200
@@ -24,13 +29,14 @@ class TestClient(unittest.TestCase):
         post_mock.assert_called_with(
             "{}/apps/myapp/units/register".format(client.url),
             data={"hostname": gethostname()},
-            headers={"Authorization": "bearer token"})
+            headers={"Authorization": "bearer token"},
+            timeout=(3.05, 30))
         self.assertEqual(envs['var1'], 'var2')
         self.assertEqual(envs['var3'], 'var4')
         self.assertEqual(envs['port'], '8888')
         self.assertEqual(envs['PORT'], '8888')
 
-    @mock.patch("requests.post")
+    @mock.patch("requests.Session.post")
     def test_register_unit_with_customdata(self, post_mock):
         response = post_mock.return_value
         response.status_code = 200
@@ -46,14 +52,15 @@ class TestClient(unittest.TestCase):
                 "hostname": gethostname(),
                 "customdata": '{"mykey": ["val1", "val2"]}'
             },
-            headers={"Authorization": "bearer token"})
+            headers={"Authorization": "bearer token"},
+            timeout=(3.05, 30))
         self.assertEqual(envs['var1'], 'var2')
         self.assertEqual(envs['var3'], 'var4')
         self.assertEqual(envs['port'], '8888')
         self.assertEqual(envs['PORT'], '8888')
 
-    @mock.patch("requests.get")
-    @mock.patch("requests.post")
+    @mock.patch("requests.Session.get")
+    @mock.patch("requests.Session.post")
     def test_register_unit_failing_register(self, post_mock, get_mock):
         response = post_mock.return_value
         response.status_code = 404
@@ -69,17 +76,19 @@ class TestClient(unittest.TestCase):
         post_mock.assert_called_once_with(
             "{}/apps/myapp/units/register".format(client.url),
             data={"hostname": gethostname()},
-            headers={"Authorization": "bearer token"})
+            headers={"Authorization": "bearer token"},
+            timeout=(3.05, 30))
         get_mock.assert_called_once_with(
             "{}/apps/myapp/env".format(client.url),
-            headers={"Authorization": "bearer token"})
+            headers={"Authorization": "bearer token"},
+            timeout=(3.05, 30))
         self.assertEqual(envs['var1'], 'var2')
         self.assertEqual(envs['var3'], 'var4')
         self.assertEqual(envs['port'], '8888')
         self.assertEqual(envs['PORT'], '8888')
 
-    @mock.patch("requests.get")
-    @mock.patch("requests.post")
+    @mock.patch("requests.Session.get")
+    @mock.patch("requests.Session.post")
     def test_register_unit_hard_fail(self, post_mock, get_mock):
         response = post_mock.return_value
         response.status_code = 500
@@ -90,10 +99,11 @@ class TestClient(unittest.TestCase):
         post_mock.assert_called_once_with(
             "{}/apps/myapp/units/register".format(client.url),
             data={"hostname": gethostname()},
-            headers={"Authorization": "bearer token"})
+            headers={"Authorization": "bearer token"},
+            timeout=(3.05, 30))
         self.assertEqual(str(cm.exception), "invalid response 500 - some error")
 
-    @mock.patch("requests.post")
+    @mock.patch("requests.Session.post")
     def test_post_app_yaml(self, post_mock):
         response = post_mock.return_value
         response.status_code = 200
@@ -105,4 +115,139 @@ class TestClient(unittest.TestCase):
             headers={
                 "Authorization": "bearer token",
                 "Content-Type": "application/json",
-            })
+            },
+            timeout=(3.05, 30))
+
+    @mock.patch("time.sleep")
+    @mock.patch("requests.Session.get")
+    @mock.patch("requests.Session.post")
+    def test_register_unit_retries_env_fetch(self, post_mock, get_mock, sleep_mock):
+        post_mock.return_value.status_code = 404
+        unavailable = mock.Mock(status_code=503)
+        ok = mock.Mock(status_code=200)
+        ok.json.return_value = [{'name': 'var1', 'value': 'var2'}]
+        get_mock.side_effect = [ConnectTimeout(), unavailable, ok]
+        client = Client("http://localhost", "token")
+        envs = client.register_unit(app="myapp")
+        self.assertEqual(envs['var1'], 'var2')
+        self.assertEqual(get_mock.call_count, 3)
+        self.assertEqual(post_mock.call_count, 1)
+        self.assertEqual([c[0][0] for c in sleep_mock.call_args_list], [0.5, 1.0])
+
+    @mock.patch("time.sleep")
+    @mock.patch("requests.Session.get")
+    @mock.patch("requests.Session.post")
+    def test_register_unit_gives_up_after_retries(self, post_mock, get_mock, sleep_mock):
+        post_mock.return_value.status_code = 404
+        get_mock.return_value.status_code = 503
+        get_mock.return_value.text = "unavailable"
+        client = Client("http://localhost", "token", retries=2)
+        with self.assertRaises(Exception) as cm:
+            client.register_unit(app="myapp")
+        self.assertEqual(str(cm.exception), "invalid response 503 - unavailable")
+        self.assertEqual(get_mock.call_count, 3)
+
+    @mock.patch("requests.Session.post")
+    def test_register_unit_does_not_retry_register(self, post_mock):
+        post_mock.side_effect = ConnectionError()
+        client = Client("http://localhost", "token")
+        self.assertRaises(ConnectionError, client.register_unit, app="myapp")
+        self.assertEqual(post_mock.call_count, 1)
+
+    @mock.patch("time.sleep")
+    @mock.patch("time.time")
+    @mock.patch("requests.Session.get")
+    @mock.patch("requests.Session.post")
+    def test_register_unit_deadline(self, post_mock, get_mock, time_mock, sleep_mock):
+        time_mock.side_effect = [100, 100, 158, 161, 161]
+        post_mock.return_value.status_code = 404
+        get_mock.return_value.status_code = 503
+        client = Client("http://localhost", "token", deadline=60)
+        self.assertRaises(DeadlineExceeded, client.register_unit, app="myapp")
+        self.assertEqual(post_mock.call_args[1]["timeout"], (3.05, 30))
+        self.assertEqual(get_mock.call_count, 1)
+        self.assertEqual(get_mock.call_args[1]["timeout"], (2, 2))
+        sleep_mock.assert_called_once_with(0)
+
+    @mock.patch("requests.Session.post")
+    def test_register_unit_etag(self, post_mock):
+        response = post_mock.return_value
+        response.status_code = 200
+        response.headers = {"ETag": '"v2"'}
+        response.json.return_value = [{'name': 'var1', 'value': 'var2'}]
+        client = Client("http://localhost", "token")
+        envs = client.register_unit("myapp", etag='"v1"')
+        self.assertEqual(envs['var1'], 'var2')
+        self.assertEqual(client.etag, '"v2"')
+        self.assertEqual(post_mock.call_args[1]["headers"],
+                         {"Authorization": "bearer token", "If-None-Match": '"v1"'})
+
+    @mock.patch("requests.Session.get")
+    @mock.patch("requests.Session.post")
+    def test_register_unit_not_modified(self, post_mock, get_mock):
+        post_mock.return_value.status_code = 304
+        client = Client("http://localhost", "token")
+        self.assertIsNone(client.register_unit("myapp", etag='"v1"'))
+        self.assertEqual(post_mock.return_value.json.call_count, 0)
+        self.assertEqual(get_mock.call_count, 0)
+
+    @mock.patch("requests.Session.get")
+    @mock.patch("requests.Session.post")
+    def test_register_unit_env_fallback_not_modified(self, post_mock, get_mock):
+        post_mock.return_value.status_code = 404
+        get_mock.return_value.status_code = 304
+        client = Client("http://localhost", "token")
+        self.assertIsNone(client.register_unit("myapp", etag='"v1"'))
+        self.assertEqual(get_mock.call_args[1]["headers"],
+                         {"Authorization": "bearer token", "If-None-Match": '"v1"'})
+
+    @mock.patch("requests.Session.post")
+    def test_post_app_yaml_etag(self, post_mock):
+        post_mock.return_value.status_code = 200
+        post_mock.return_value.headers = {"ETag": '"c1"'}
+        client = Client("http://localhost", "token")
+        client.post_app_yaml(app="myapp", data={"x": "y"})
+        self.assertEqual(client.customdata_etag, '"c1"')
+        post_mock.return_value.headers = {}
+        client.post_app_yaml(app="myapp", data={"x": "y"})
+        self.assertIsNone(client.customdata_etag)
+
+    @mock.patch("requests.Session.head")
+    def test_customdata_version(self, head_mock):
+        head_mock.return_value.status_code = 200
+        head_mock.return_value.headers = {"ETag": '"c1"'}
+        client = Client("http://localhost", "token")
+        self.assertEqual(client.customdata_version("myapp"), '"c1"')
+        head_mock.assert_called_once_with(
+            "{}/apps/myapp/customdata".format(client.url),
+            headers={"Authorization": "bearer token"},
+            timeout=(3.05, 30))
+        head_mock.return_value.status_code = 404
+        self.assertIsNone(client.customdata_version("myapp"))
+        head_mock.side_effect = ConnectionError()
+        client.retries = 0
+        self.assertIsNone(client.customdata_version("myapp"))
+
+    @mock.patch("requests.Session.post")
+    def test_post_app_yaml_old_api(self, post_mock):
+        not_found = mock.Mock(status_code=404)
+        registered = mock.Mock(status_code=200)
+        registered.json.return_value = []
+        post_mock.side_effect = [not_found, registered]
+        client = Client("http://localhost", "token")
+        client.post_app_yaml(app="myapp", data={"x": "y"})
+        post_mock.assert_called_with(
+            "{}/apps/myapp/units/register".format(client.url),
+            data={"hostname": gethostname(), "customdata": '{"x": "y"}'},
+            headers={"Authorization": "bearer token"},
+            timeout=(3.05, 30))
+        self.assertIsNone(client.customdata_etag)
+
+    @mock.patch("requests.Session.post")
+    def test_post_app_yaml_error(self, post_mock):
+        post_mock.return_value.status_code = 500
+        post_mock.return_value.text = "some error"
+        client = Client("http://localhost", "token")
+        with self.assertRaises(Exception) as cm:
+            client.post_app_yaml(app="myapp", data={"x": "y"})
+        self.assertEqual(str(cm.exception), "invalid response 500 - some error")
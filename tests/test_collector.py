@@ -0,0 +1,104 @@
+import io
+import os
+import Queue
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from tsuru_unit_agent.collector import (
+    Collector,
+    CollectorServer,
+    CollectorStream,
+    encode_frame,
+    read_frames,
+)
+from tsuru_unit_agent.stream import QUEUE_DONE_MESSAGE, FairQueue
+
+ENVS = {
+    "TSURU_APPNAME": "app1",
+    "TSURU_HOST": "http://tsuru",
+    "TSURU_APP_TOKEN": "secret",
+}
+
+
+class FramesTest(unittest.TestCase):
+
+    def test_encode_read_frames(self):
+        data = encode_frame("web", "stdout", "line 1\n") + encode_frame("web", "stderr", b"\xff\n")
+        frames = list(read_frames(io.BytesIO(data)))
+        self.assertEqual(frames, [{"watcher": "web", "name": "stdout", "data": "line 1\n"},
+                                  {"watcher": "web", "name": "stderr", "data": u"\ufffd\n"}])
+
+    def test_read_truncated_frame(self):
+        data = encode_frame("web", "stdout", "line 1\n")
+        self.assertEqual(list(read_frames(io.BytesIO(data[:-1]))), [])
+        self.assertEqual(list(read_frames(io.BytesIO(data[:2]))), [])
+
+    def test_read_frame_too_large(self):
+        self.assertRaises(ValueError, list, read_frames(io.BytesIO(b"\xff\xff\xff\xff{}")))
+
+
+@mock.patch("tsuru_unit_agent.stream.gethostname", mock.Mock(return_value="myhost"))
+class CollectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "collector.sock")
+        self.collector = Collector(ENVS)
+        self.collector.queue = Queue.Queue()
+
+    def test_handle(self):
+        self.collector.handle({"watcher": "web", "name": "stdout", "data": "a\nb"})
+        self.collector.handle({"watcher": "web", "name": "stderr", "data": "c\n"})
+        self.collector.handle({"watcher": "web", "name": "stdout", "data": "\n"})
+        entries = [self.collector.queue.get_nowait() for _ in range(3)]
+        self.assertEqual([e.messages for e in entries], [["a\n"], ["c\n"], ["b\n"]])
+        self.assertEqual(entries[0].url, "http://tsuru/apps/app1/log?source=web&unit=myhost")
+        self.assertEqual(sorted(self.collector.streams), [("web", "stderr"), ("web", "stdout")])
+
+    def test_handle_queue_full(self):
+        self.collector.queue = Queue.Queue(maxsize=1)
+        self.collector.handle({"watcher": "web", "name": "stdout", "data": "a\n"})
+        self.collector.handle({"watcher": "web", "name": "stdout", "data": "b\n"})
+        self.assertEqual(self.collector.queue.qsize(), 1)
+
+    def test_stream_to_server(self):
+        server = CollectorServer(self.path, self.collector)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            stream = CollectorStream(watcher_name="web", socket_path=self.path)
+            stream({"data": "line 1\nline", "name": "stdout", "pid": 10})
+            stream({"data": " 2\n", "name": "stdout", "pid": 10})
+            first = self.collector.queue.get(timeout=5)
+            second = self.collector.queue.get(timeout=5)
+            stream.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertEqual(first.messages + second.messages, ["line 1\n", "line 2\n"])
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_stream_collector_unavailable(self):
+        stream = CollectorStream(watcher_name="web", socket_path=self.path)
+        stream({"data": "line 1\n", "name": "stdout"})
+        self.assertIsNone(stream.sock)
+
+    @mock.patch.dict(os.environ, {"TSURU_LOG_COLLECTOR": "/tmp/other.sock"})
+    def test_stream_socket_path_from_env(self):
+        self.assertEqual(CollectorStream().socket_path, "/tmp/other.sock")
+
+    def test_start_writer(self):
+        collector = Collector(dict(ENVS, LOG_BATCH_SIZE="10", LOG_SOURCE_WEIGHTS="stderr=4"))
+        collector.start_writer()
+        self.assertEqual(collector.writer.batch_size, 10)
+        self.assertIsInstance(collector.queue, FairQueue)
+        self.assertEqual(collector.queue.weight(("web", "stderr")), 4)
+        self.assertEqual(collector.writer.session.headers["Authorization"], "bearer secret")
+        collector.queue.put(QUEUE_DONE_MESSAGE)
+        collector.writer.join()
@@ -0,0 +1,51 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules loaded by importing each entry point, with some headroom. Raise
+# them only for a dependency that really has to be loaded up front.
+MODULES_BUDGET = {
+    "tsuru_unit_agent.main": 450,
+    "tsuru_unit_agent.stream": 130,
+}
+
+LAZY_MODULES = {
+    "tsuru_unit_agent.main": ["yaml", "honcho", "multiprocessing", "tsuru_unit_agent.stream"],
+    "tsuru_unit_agent.stream": ["requests"],
+}
+
+PROBE = """
+import json, signal, sys
+before = signal.getsignal(signal.SIGTERM)
+__import__(sys.argv[1])
+json.dump({"modules": sorted(m for m, v in sys.modules.items() if v is not None),
+           "sigterm_changed": signal.getsignal(signal.SIGTERM) != before}, sys.stdout)
+"""
+
+
+def cold_import(module):
+    output = subprocess.check_output([sys.executable, "-c", PROBE, module], cwd=ROOT)
+    return json.loads(output)
+
+
+class ImportsTest(unittest.TestCase):
+
+    def test_main_import(self):
+        result = cold_import("tsuru_unit_agent.main")
+        for name in LAZY_MODULES["tsuru_unit_agent.main"]:
+            self.assertNotIn(name, result["modules"])
+        self.assertLessEqual(len(result["modules"]), MODULES_BUDGET["tsuru_unit_agent.main"])
+
+    def test_tasks_import_has_no_side_effects(self):
+        result = cold_import("tsuru_unit_agent.tasks")
+        self.assertFalse(result["sigterm_changed"])
+
+    def test_stream_import(self):
+        result = cold_import("tsuru_unit_agent.stream")
+        for name in LAZY_MODULES["tsuru_unit_agent.stream"]:
+            self.assertNotIn(name, result["modules"])
+        self.assertLessEqual(len(result["modules"]), MODULES_BUDGET["tsuru_unit_agent.stream"])
@@ -0,0 +1,72 @@
+import os
+import Queue
+import shutil
+import signal
+import StringIO
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from tsuru_unit_agent import introspect
+from tsuru_unit_agent.stream import Stream, TsuruLogWriter
+
+
+class IntrospectTest(unittest.TestCase):
+
+    def test_thread_stacks(self):
+        stacks = introspect.thread_stacks()
+        self.assertIn("Thread MainThread", stacks)
+        self.assertIn("in test_thread_stacks", stacks)
+
+    @mock.patch("tsuru_unit_agent.stream.gethostname", mock.Mock(return_value="myhost"))
+    def test_dump(self):
+        queue = Queue.Queue()
+        stream = Stream(watcher_name="web", envs={}, queue=queue)
+        stream._buffer = "partial"
+        writer = TsuruLogWriter(mock.Mock(), queue, "60", "10")
+        out = StringIO.StringIO()
+        introspect.dump(out)
+        output = out.getvalue()
+        self.assertIn("state of pid {}".format(os.getpid()), output)
+        self.assertIn("Stream buffered_bytes=7 queue_depth=0 stream=stdout watcher=web\n", output)
+        self.assertIn("TsuruLogWriter alive=False batch_size=1 last_post=None last_status=None "
+                      "queue_depth=0 rate_limit=True rate_limit_count=10 rate_limit_notice=0 "
+                      "rate_limit_used=0 rate_limit_window=60\n", output)
+        del stream, writer
+
+    def test_sampler(self):
+        sampler = introspect.Sampler()
+        sampler.sample()
+        stacks = [stack for stack in sampler.samples if stack.startswith("MainThread;")]
+        self.assertEqual(len(stacks), 1)
+        self.assertIn(";test_introspect.py:test_sampler:", stacks[0])
+
+    def test_toggle_profiler(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.assertIsNone(introspect.toggle_profiler(tmpdir))
+        busy = threading.Event()
+        busy.wait(0.1)
+        path = introspect.toggle_profiler(tmpdir)
+        self.assertEqual(os.path.dirname(path), tmpdir)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            self.assertTrue(int(count) > 0)
+        self.assertTrue(any(line.startswith("MainThread;") for line in lines))
+        self.assertIsNone(introspect._sampler)
+
+    def test_install(self):
+        previous = signal.getsignal(signal.SIGUSR1), signal.getsignal(signal.SIGUSR2)
+        self.addCleanup(signal.signal, signal.SIGUSR1, previous[0])
+        self.addCleanup(signal.signal, signal.SIGUSR2, previous[1])
+        introspect.install()
+        self.assertEqual(signal.getsignal(signal.SIGUSR1), introspect._on_sigusr1)
+        self.assertEqual(signal.getsignal(signal.SIGUSR2), introspect._on_sigusr2)
+        with mock.patch("sys.stderr") as stderr_mock:
+            os.kill(os.getpid(), signal.SIGUSR1)
+        self.assertIn("state of pid", stderr_mock.write.call_args_list[0][0][0])
@@ -1,8 +1,16 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 import mock
 
 from requests.exceptions import ConnectionError
-from tsuru_unit_agent.main import parse_args, main
+from tsuru_unit_agent import timing
+from tsuru_unit_agent.client import DeadlineExceeded
+from tsuru_unit_agent.main import after_start, parse_args, main, load_cached_envs, refresh_circus, refresh_envs
 
 
 class TestMain(unittest.TestCase):
@@ -30,6 +38,18 @@ class TestMain(unittest.TestCase):
         self.assertEqual(args.app_name, 'c')
         self.assertEqual(args.start_cmd, 'd')
 
+    def test_parse_args_fast_start(self):
+        self.assertFalse(parse_args(['a', 'b', 'c', 'd']).fast_start)
+        self.assertTrue(parse_args(['a', 'b', 'c', 'd', '--fast-start']).fast_start)
+        with mock.patch.dict('os.environ', {'TSURU_UNIT_AGENT_FAST_START': '1'}):
+            self.assertTrue(parse_args(['a', 'b', 'c', 'd']).fast_start)
+
+    def test_parse_args_exec(self):
+        self.assertFalse(parse_args(['a', 'b', 'c', 'd']).exec_start)
+        self.assertTrue(parse_args(['a', 'b', 'c', 'd', '--exec']).exec_start)
+        with mock.patch.dict('os.environ', {'TSURU_UNIT_AGENT_EXEC': '1'}):
+            self.assertTrue(parse_args(['a', 'b', 'c', 'd']).exec_start)
+
     def test_parse_args_invalid(self):
         self.assertRaises(SystemExit, parse_args, [])
         self.assertRaises(SystemExit, parse_args, ['a', 'b', 'c', 'd', 'e'])
@@ -49,22 +69,60 @@ class TestMain(unittest.TestCase):
         run_build_hooks_mock = tasks_mock.run_build_hooks
         write_circus_conf_mock = tasks_mock.write_circus_conf
         save_apprc_mock = tasks_mock.save_apprc_file
+        digest_mock = tasks_mock.customdata_digest
+        digest_mock.return_value = "new-digest"
+        tasks_mock.load_customdata_digest.return_value = "old-digest"
+        client_mock.return_value.customdata_version.return_value = '"c1"'
+        client_mock.return_value.customdata_etag = '"c2"'
         main()
         call_count = len(client_mock.mock_calls) + len(tasks_mock.mock_calls)
-        self.assertEqual(call_count, 10)
+        self.assertEqual(call_count, 15)
         client_mock.assert_called_once_with('http://localhost', 'token')
-        register_mock.assert_any_call('app1')
+        register_mock.assert_called_once_with('app1')
+        client_mock.return_value.customdata_version.assert_called_once_with('app1')
         v = load_yaml_mock.return_value
         v['procfile'] = load_procfile_mock.return_value
-        register_mock.assert_any_call('app1', v)
+        self.assertEqual(digest_mock.call_args_list, [mock.call(v, '"c1"'), mock.call(v, '"c2"')])
+        tasks_mock.save_customdata_digest.assert_called_once_with("new-digest")
         save_apprc_mock.assert_called_once_with(register_mock.return_value)
         exec_script_mock.assert_called_once_with('mycmd')
         load_yaml_mock.assert_called_once_with()
-        write_circus_conf_mock.assert_called_once_with(envs={'env1': 'val1'})
+        write_circus_conf_mock.assert_called_once_with(envs={'env1': 'val1'}, circus_endpoint='')
         post_app_yaml_mock.assert_called_once_with('app1', load_yaml_mock.return_value)
         run_build_hooks_mock.assert_called_once_with(load_yaml_mock.return_value,
                                                      envs={'env1': 'val1'})
 
+    @mock.patch('sys.argv', ['', 'http://localhost', 'token', 'app1', 'mycmd', 'deploy'])
+    @mock.patch('tsuru_unit_agent.main.heartbeat')
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    @mock.patch('tsuru_unit_agent.main.Client')
+    def test_main_deploy_action_customdata_unchanged(self, client_mock, tasks_mock, heartbeat_mock):
+        client_mock.return_value.register_unit.return_value = {'env1': 'val1'}
+        client_mock.return_value.customdata_version.return_value = '"c1"'
+        tasks_mock.load_app_yaml.return_value = {}
+        tasks_mock.load_customdata_digest.return_value = tasks_mock.customdata_digest.return_value
+        main()
+        client_mock.return_value.register_unit.assert_called_once_with('app1')
+        tasks_mock.customdata_digest.assert_called_once_with({'procfile': mock.ANY}, '"c1"')
+        self.assertEqual(client_mock.return_value.post_app_yaml.call_count, 0)
+        self.assertEqual(tasks_mock.save_customdata_digest.call_count, 0)
+
+    @mock.patch('sys.argv', ['', 'http://localhost', 'token', 'app1', 'mycmd', 'deploy'])
+    @mock.patch('tsuru_unit_agent.main.heartbeat')
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    @mock.patch('tsuru_unit_agent.main.Client')
+    def test_main_deploy_action_customdata_without_server_version(self, client_mock, tasks_mock, heartbeat_mock):
+        # a new image inherits the digest, but the API has no customdata for it.
+        client_mock.return_value.register_unit.return_value = {'env1': 'val1'}
+        client_mock.return_value.etag = '"v1"'
+        client_mock.return_value.customdata_version.return_value = None
+        client_mock.return_value.customdata_etag = None
+        tasks_mock.load_app_yaml.return_value = {}
+        tasks_mock.load_customdata_digest.return_value = tasks_mock.customdata_digest.return_value
+        main()
+        client_mock.return_value.post_app_yaml.assert_called_once_with('app1', {'procfile': mock.ANY})
+        self.assertEqual(tasks_mock.save_customdata_digest.call_count, 0)
+
     @mock.patch('sys.argv', ['', 'http://localhost', 'token', 'app1', 'mycmd', 'run'])
     @mock.patch('tsuru_unit_agent.main.tasks')
     @mock.patch('tsuru_unit_agent.main.Client')
@@ -79,11 +137,14 @@ class TestMain(unittest.TestCase):
         load_yaml_mock.return_value = {'hooks': {'build': ['cmd_1', 'cmd_2']}}
         main()
         call_count = len(client_mock.mock_calls) + len(tasks_mock.mock_calls)
-        self.assertEqual(call_count, 8)
-        write_circus_conf_mock.assert_called_once_with(envs={'env1': 'val1'})
+        self.assertEqual(call_count, 12)
+        write_circus_conf_mock.assert_called_once_with(
+            envs={'env1': 'val1'}, procfile=tasks_mock.load_procfile_commands.return_value, circus_endpoint='')
+        tasks_mock.install_sigterm_handler.assert_called_once_with()
         client_mock.assert_called_once_with('http://localhost', 'token')
-        register_mock.assert_called_once_with('app1')
+        register_mock.assert_called_once_with('app1', etag=tasks_mock.load_envs_etag.return_value)
         save_apprc_mock.assert_called_once_with(register_mock.return_value)
+        tasks_mock.save_envs_etag.assert_called_once_with(client_mock.return_value.etag)
         exec_script_mock.assert_called_once_with('mycmd', envs={'env1': 'val1'}, with_shell=False)
         load_yaml_mock.assert_called_once_with()
         run_restart_hooks_mock.assert_any_call('before', load_yaml_mock.return_value,
@@ -91,13 +152,29 @@ class TestMain(unittest.TestCase):
         run_restart_hooks_mock.assert_any_call('after', load_yaml_mock.return_value,
                                                envs={'env1': 'val1'})
 
+    @mock.patch('sys.argv', ['', 'http://localhost', 'token', 'app1', 'mycmd', 'run'])
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    @mock.patch('tsuru_unit_agent.main.Client')
+    def test_main_run_action_envs_not_modified(self, client_mock, tasks_mock):
+        tasks_mock.load_envs_etag.return_value = '"v1"'
+        register_mock = client_mock.return_value.register_unit
+        register_mock.return_value = None
+        tasks_mock.parse_apprc_file.return_value = {'env1': 'val1'}
+        main()
+        register_mock.assert_called_once_with('app1', etag='"v1"')
+        tasks_mock.parse_apprc_file.assert_called_once_with()
+        self.assertEqual(tasks_mock.save_apprc_file.call_count, 0)
+        self.assertEqual(tasks_mock.save_envs_etag.call_count, 0)
+        tasks_mock.write_circus_conf.assert_called_once_with(
+            envs={'env1': 'val1'}, procfile=tasks_mock.load_procfile_commands.return_value, circus_endpoint='')
+
     @mock.patch('sys.argv', ['', 'http://localhost', 'token', 'app1', 'mycmd', 'run'])
     @mock.patch('tsuru_unit_agent.main.tasks')
     @mock.patch('tsuru_unit_agent.main.Client')
     def test_main_run_action_api_error(self, client_mock, tasks_mock):
         register_mock = client_mock.return_value.register_unit
 
-        def fail(*args):
+        def fail(*args, **kwargs):
             raise ConnectionError()
         register_mock.side_effect = fail
         save_apprc_mock = tasks_mock.save_apprc_file
@@ -110,10 +187,11 @@ class TestMain(unittest.TestCase):
         load_yaml_mock.return_value = {'hooks': {'build': ['cmd_1', 'cmd_2']}}
         main()
         call_count = len(client_mock.mock_calls) + len(tasks_mock.mock_calls)
-        self.assertEqual(call_count, 8)
-        write_circus_conf_mock.assert_called_once_with(envs={'env1': 'val1'})
+        self.assertEqual(call_count, 11)
+        write_circus_conf_mock.assert_called_once_with(
+            envs={'env1': 'val1'}, procfile=tasks_mock.load_procfile_commands.return_value, circus_endpoint='')
         client_mock.assert_called_once_with('http://localhost', 'token')
-        register_mock.assert_called_once_with('app1')
+        register_mock.assert_called_once_with('app1', etag=tasks_mock.load_envs_etag.return_value)
         parse_apprc_mock.assert_called_once_with()
         self.assertEqual(save_apprc_mock.call_count, 0)
         exec_script_mock.assert_called_once_with('mycmd', envs={'env1': 'val1'}, with_shell=False)
@@ -122,3 +200,332 @@ class TestMain(unittest.TestCase):
                                                envs={'env1': 'val1'})
         run_restart_hooks_mock.assert_any_call('after', load_yaml_mock.return_value,
                                                envs={'env1': 'val1'})
+
+    @mock.patch('sys.argv', ['', 'http://localhost', 'token', 'app1', 'mycmd', 'run'])
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    @mock.patch('tsuru_unit_agent.main.Client')
+    def test_main_run_action_api_timeout(self, client_mock, tasks_mock):
+        client_mock.return_value.register_unit.side_effect = DeadlineExceeded()
+        parse_apprc_mock = tasks_mock.parse_apprc_file
+        parse_apprc_mock.return_value = {'env1': 'val1'}
+        main()
+        parse_apprc_mock.assert_called_once_with()
+        self.assertEqual(tasks_mock.save_apprc_file.call_count, 0)
+        tasks_mock.write_circus_conf.assert_called_once_with(
+            envs={'env1': 'val1'}, procfile=tasks_mock.load_procfile_commands.return_value, circus_endpoint='')
+
+    @mock.patch('sys.argv', ['', 'http://localhost', 'token', 'app1', 'mycmd', 'run'])
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    @mock.patch('tsuru_unit_agent.main.Client')
+    def test_main_run_action_loads_yaml_while_registering(self, client_mock, tasks_mock):
+        yaml_loaded = threading.Event()
+        procfile_loaded = threading.Event()
+
+        def register(*args, **kwargs):
+            self.assertTrue(yaml_loaded.wait(5))
+            self.assertTrue(procfile_loaded.wait(5))
+            return {'env1': 'val1'}
+        client_mock.return_value.register_unit.side_effect = register
+        tasks_mock.load_app_yaml.side_effect = lambda: yaml_loaded.set() or {}
+        tasks_mock.load_procfile_commands.side_effect = lambda: procfile_loaded.set() or 'procfile'
+        main()
+        tasks_mock.save_apprc_file.assert_called_once_with({'env1': 'val1'})
+        tasks_mock.write_circus_conf.assert_called_once_with(
+            envs={'env1': 'val1'}, procfile='procfile', circus_endpoint='')
+
+    @mock.patch('sys.stderr')
+    @mock.patch.dict('os.environ', {'TSURU_UNIT_AGENT_TIMING': '1'})
+    @mock.patch('sys.argv', ['', 'http://localhost', 'token', 'app1', 'mycmd', 'run'])
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    @mock.patch('tsuru_unit_agent.main.Client')
+    def test_main_run_action_timing(self, client_mock, tasks_mock, stderr_mock):
+        client_mock.return_value.register_unit.return_value = {'env1': 'val1'}
+        main()
+        output = stderr_mock.write.call_args[0][0]
+        self.assertRegexpMatches(output, r"^tsuru_unit_agent: ")
+        for phase in ["envs", "load_app_yaml", "write_circus_conf", "before_hooks"]:
+            self.assertIn(" {}=".format(phase), " " + output)
+
+    @mock.patch('sys.stderr')
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    @mock.patch('tsuru_unit_agent.main.Client')
+    def test_main_run_action_trace(self, client_mock, tasks_mock, stderr_mock):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'trace.json')
+        client_mock.return_value.register_unit.return_value = {'env1': 'val1'}
+        argv = ['', 'http://localhost', 'token', 'app1', 'mycmd', 'run', '--trace', path]
+        with mock.patch('sys.argv', argv):
+            main()
+        with open(path) as f:
+            events = json.load(f)['traceEvents']
+        names = [e['name'] for e in events if e['cat'] == 'phase']
+        self.assertEqual(sorted(names), sorted(['envs', 'load_app_yaml', 'load_procfile', 'write_circus_conf',
+                                                'before_hooks', 'start', 'after_hooks']))
+        with mock.patch('sys.argv', argv[:-2]):
+            main()
+        self.assertIsNone(timing.tracer())
+
+    @mock.patch('sys.argv', ['', 'http://localhost', 'token', 'app1', 'mycmd', 'run', '--fast-start'])
+    @mock.patch('tsuru_unit_agent.main.background.BackgroundCall')
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    @mock.patch('tsuru_unit_agent.main.Client')
+    def test_main_run_action_fast_start(self, client_mock, tasks_mock, background_mock):
+        calls = []
+
+        def background_call(target, *args):
+            calls.append(target.__name__)
+            if target is refresh_envs:
+                return mock.Mock()
+            return mock.Mock(result=lambda: target(*args))
+        background_mock.side_effect = background_call
+        tasks_mock.write_circus_conf.side_effect = lambda **kwargs: calls.append('write_circus_conf')
+        tasks_mock.run_restart_hooks.side_effect = lambda position, *args, **kwargs: calls.append(position)
+        tasks_mock.parse_apprc_file.return_value = {'env1': 'val1'}
+        main()
+        self.assertEqual(client_mock.return_value.register_unit.call_count, 0)
+        tasks_mock.write_circus_conf.assert_called_once_with(
+            envs={'env1': 'val1'}, procfile=tasks_mock.load_procfile_commands.return_value, circus_endpoint='')
+        tasks_mock.execute_start_script.assert_called_once_with('mycmd', envs={'env1': 'val1'},
+                                                                with_shell=False)
+        background_mock.assert_any_call(refresh_envs, client_mock.return_value, 'app1', {'env1': 'val1'})
+        self.assertEqual(calls, ['timed_fetch_envs', 'write_circus_conf', 'before', 'refresh_envs', 'after'])
+
+    @mock.patch('sys.argv', ['', 'http://localhost', 'token', 'app1', 'mycmd', 'run', '--exec'])
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    @mock.patch('tsuru_unit_agent.main.Client')
+    def test_main_run_action_exec(self, client_mock, tasks_mock):
+        client_mock.return_value.register_unit.return_value = {'env1': 'val1'}
+        tasks_mock.restart_hooks.return_value = []
+        main()
+        tasks_mock.restart_hooks.assert_called_once_with('after', tasks_mock.load_app_yaml.return_value)
+        tasks_mock.replace_with_start_script.assert_called_once_with('mycmd', envs={'env1': 'val1'})
+        self.assertEqual(tasks_mock.spawn_after_exec.call_count, 0)
+        self.assertEqual(tasks_mock.execute_start_script.call_count, 0)
+        tasks_mock.run_restart_hooks.assert_called_once_with('before', tasks_mock.load_app_yaml.return_value,
+                                                             envs={'env1': 'val1'})
+
+    @mock.patch('sys.argv', ['', 'http://localhost', 'token', 'app1', 'mycmd', 'run', '--exec'])
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    @mock.patch('tsuru_unit_agent.main.Client')
+    def test_main_run_action_exec_after_hooks(self, client_mock, tasks_mock):
+        client_mock.return_value.register_unit.return_value = {'env1': 'val1'}
+        tasks_mock.restart_hooks.return_value = ['a1']
+        main()
+        call = tasks_mock.spawn_after_exec.call_args[0]
+        self.assertEqual(call[0], after_start)
+        self.assertEqual(call[1], client_mock.return_value)
+        self.assertEqual(call[3:], (tasks_mock.load_app_yaml.return_value, {'env1': 'val1'}))
+        tasks_mock.replace_with_start_script.assert_called_once_with('mycmd', envs={'env1': 'val1'})
+        self.assertEqual(tasks_mock.run_restart_hooks.call_count, 1)
+
+    @mock.patch('sys.argv', ['', 'http://localhost', 'token', 'app1', 'mycmd', 'run', '--exec', '--fast-start'])
+    @mock.patch('tsuru_unit_agent.main.background.BackgroundCall')
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    @mock.patch('tsuru_unit_agent.main.Client')
+    def test_main_run_action_exec_fast_start(self, client_mock, tasks_mock, background_mock):
+        background_mock.side_effect = lambda target, *args: mock.Mock(result=lambda: target(*args))
+        tasks_mock.parse_apprc_file.return_value = {'env1': 'val1'}
+        tasks_mock.restart_hooks.return_value = []
+        main()
+        self.assertEqual(background_mock.call_count, 1)
+        self.assertEqual(tasks_mock.spawn_after_exec.call_args[0][0], after_start)
+        tasks_mock.replace_with_start_script.assert_called_once_with('mycmd', envs={'env1': 'val1'})
+
+    @mock.patch('sys.argv', ['', 'http://localhost', 'token', 'app1', 'mycmd', 'run'])
+    @mock.patch('tsuru_unit_agent.main.readiness')
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    @mock.patch('tsuru_unit_agent.main.Client')
+    def test_main_run_action_waits_until_ready(self, client_mock, tasks_mock, readiness_mock):
+        client_mock.return_value.register_unit.return_value = {'env1': 'val1'}
+        calls = []
+        tasks_mock.execute_start_script.side_effect = lambda *args, **kwargs: calls.append('start')
+        readiness_mock.wait_until_ready.side_effect = lambda *args: calls.append('ready')
+        tasks_mock.run_restart_hooks.side_effect = lambda position, *args, **kwargs: calls.append(position)
+        main()
+        self.assertEqual(calls, ['before', 'start', 'ready', 'after'])
+        readiness_mock.clear_ready.assert_called_once_with({'env1': 'val1'})
+        readiness_mock.wait_until_ready.assert_called_once_with(tasks_mock.load_app_yaml.return_value,
+                                                                {'env1': 'val1'})
+
+    @mock.patch('sys.argv', ['', 'http://localhost', 'token', 'app1', 'mycmd', 'run', '--exec'])
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    @mock.patch('tsuru_unit_agent.main.Client')
+    def test_main_run_action_exec_healthcheck(self, client_mock, tasks_mock):
+        client_mock.return_value.register_unit.return_value = {'env1': 'val1'}
+        tasks_mock.restart_hooks.return_value = []
+        tasks_mock.load_app_yaml.return_value = {'healthcheck': {'path': '/'}}
+        main()
+        self.assertEqual(tasks_mock.spawn_after_exec.call_args[0][0], after_start)
+        tasks_mock.replace_with_start_script.assert_called_once_with('mycmd', envs={'env1': 'val1'})
+
+    @mock.patch('sys.argv', ['', 'http://localhost', 'token', 'app1', 'mycmd', 'run'])
+    @mock.patch('sys.stderr')
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    @mock.patch('tsuru_unit_agent.main.Client')
+    def test_main_run_action_invalid_healthcheck(self, client_mock, tasks_mock, stderr_mock):
+        client_mock.return_value.register_unit.return_value = {'env1': 'val1'}
+        tasks_mock.load_app_yaml.return_value = {'healthcheck': {'port': 'http'}}
+        with mock.patch('tsuru_unit_agent.readiness.clear_ready'):
+            main()
+        tasks_mock.execute_start_script.assert_called_once_with('mycmd', envs={'env1': 'val1'}, with_shell=False)
+        tasks_mock.run_restart_hooks.assert_called_with('after', {}, envs={'env1': 'val1'})
+
+    @mock.patch('sys.argv', ['', 'http://localhost', 'token', 'app1', 'mycmd', 'run', '--exec'])
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    @mock.patch('tsuru_unit_agent.main.Client')
+    def test_main_run_action_exec_ready_file(self, client_mock, tasks_mock):
+        client_mock.return_value.register_unit.return_value = {'TSURU_UNIT_READY_FILE': '/tmp/ready'}
+        tasks_mock.restart_hooks.return_value = []
+        tasks_mock.load_app_yaml.return_value = {}
+        with mock.patch('tsuru_unit_agent.readiness.clear_ready'):
+            main()
+        self.assertEqual(tasks_mock.spawn_after_exec.call_args[0][0], after_start)
+
+    @mock.patch('tsuru_unit_agent.main.readiness')
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    def test_after_start_waits_until_ready(self, tasks_mock, readiness_mock):
+        calls = []
+        readiness_mock.wait_until_ready.side_effect = lambda *args: calls.append('ready')
+        tasks_mock.run_restart_hooks.side_effect = lambda position, *args, **kwargs: calls.append(position)
+        yaml_data = {'healthcheck': {}}
+        after_start(mock.Mock(), parse_args(['a', 'b', 'app1', 'd']), yaml_data, {'env1': 'val1'})
+        readiness_mock.wait_until_ready.assert_called_once_with(yaml_data, {'env1': 'val1'})
+        self.assertEqual(calls, ['ready', 'after'])
+
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    def test_after_start(self, tasks_mock):
+        client = mock.Mock()
+        client.register_unit.return_value = None
+        args = parse_args(['a', 'b', 'app1', 'd', '--fast-start'])
+        after_start(client, args, {'hooks': {}}, {'env1': 'val1'})
+        client.register_unit.assert_called_once_with('app1', etag=tasks_mock.load_envs_etag.return_value)
+        tasks_mock.run_restart_hooks.assert_called_once_with('after', {'hooks': {}}, envs={'env1': 'val1'})
+        after_start(client, parse_args(['a', 'b', 'app1', 'd']), {}, {})
+        self.assertEqual(client.register_unit.call_count, 1)
+
+    @mock.patch('sys.argv', ['', 'http://localhost', 'token', 'app1', '-', 'collect',
+                             '--log-socket', '/tmp/l.sock'])
+    @mock.patch('tsuru_unit_agent.collector.Collector')
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    def test_main_collect_action(self, tasks_mock, collector_mock):
+        tasks_mock.parse_apprc_file.return_value = {'TSURU_APPNAME': 'app1', 'TSURU_APP_TOKEN': 'apptoken'}
+        main()
+        collector_mock.assert_called_once_with({'TSURU_APPNAME': 'app1', 'TSURU_APP_TOKEN': 'apptoken',
+                                                'TSURU_HOST': 'http://localhost'})
+        collector_mock.return_value.serve.assert_called_once_with('/tmp/l.sock')
+
+    @mock.patch('tsuru_unit_agent.main.background.BackgroundCall')
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    def test_load_cached_envs_without_apprc(self, tasks_mock, background_mock):
+        tasks_mock.parse_apprc_file.side_effect = IOError()
+        client = mock.Mock()
+        client.register_unit.return_value = {'env1': 'val1'}
+        self.assertEqual(load_cached_envs(client, 'app1'), {'env1': 'val1'})
+        tasks_mock.save_apprc_file.assert_called_once_with({'env1': 'val1'})
+        self.assertEqual(background_mock.call_count, 0)
+
+    @mock.patch('tsuru_unit_agent.main.watchers')
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    def test_refresh_envs_changed(self, tasks_mock, watchers_mock):
+        client = mock.Mock()
+        client.register_unit.return_value = {'env1': 'val2'}
+        calls = []
+        watchers_mock.wait_for_circus.side_effect = lambda *args: calls.append('wait')
+        tasks_mock.write_circus_conf.side_effect = lambda **kwargs: calls.append('write')
+        refresh_envs(client, 'app1', {'env1': 'val1'})
+        client.register_unit.assert_called_once_with('app1', etag=tasks_mock.load_envs_etag.return_value)
+        tasks_mock.save_apprc_file.assert_called_once_with({'env1': 'val2'})
+        tasks_mock.save_envs_etag.assert_called_once_with(client.etag)
+        endpoint = tasks_mock.read_circus_endpoint.return_value
+        self.assertEqual(watchers_mock.wait_for_circus.call_args[0][0], endpoint)
+        tasks_mock.write_circus_conf.assert_called_once_with(
+            envs={'env1': 'val2'}, previous_envs={'env1': 'val1'}, circus_endpoint=endpoint)
+        self.assertEqual(calls, ['wait', 'write'])
+
+    @mock.patch('time.sleep')
+    @mock.patch('logging.error')
+    @mock.patch('tsuru_unit_agent.main.watchers')
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    def test_refresh_circus_retries_apply(self, tasks_mock, watchers_mock, error_mock, sleep_mock):
+        tasks_mock.read_circus_endpoint.return_value = 'tcp://127.0.0.1:5555'
+        tasks_mock.apply_circus_conf.side_effect = [False, False, True]
+        refresh_circus({'env1': 'val2'}, {'env1': 'val1'}, time.time() + 60)
+        self.assertEqual(tasks_mock.apply_circus_conf.call_count, 3)
+        tasks_mock.apply_circus_conf.assert_called_with(circus_endpoint='tcp://127.0.0.1:5555')
+        self.assertEqual(error_mock.call_count, 0)
+        tasks_mock.apply_circus_conf.side_effect = None
+        tasks_mock.apply_circus_conf.return_value = False
+        refresh_circus({'env1': 'val2'}, {'env1': 'val1'}, time.time() - 1)
+        self.assertEqual(tasks_mock.apply_circus_conf.call_count, 4)
+        self.assertEqual(error_mock.call_count, 1)
+
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    def test_refresh_envs_unchanged(self, tasks_mock):
+        client = mock.Mock()
+        client.register_unit.return_value = {'env1': 'val1'}
+        refresh_envs(client, 'app1', {'env1': 'val1'})
+        self.assertEqual(tasks_mock.write_circus_conf.call_count, 0)
+        client.register_unit.return_value = None
+        refresh_envs(client, 'app1', {'env1': 'val1'})
+        self.assertEqual(tasks_mock.save_apprc_file.call_count, 1)
+        self.assertEqual(tasks_mock.write_circus_conf.call_count, 0)
+
+    @mock.patch('logging.exception')
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    def test_refresh_envs_api_error(self, tasks_mock, exception_mock):
+        client = mock.Mock()
+        client.register_unit.side_effect = ConnectionError()
+        refresh_envs(client, 'app1', {'env1': 'val1'})
+        self.assertEqual(exception_mock.call_count, 1)
+        self.assertEqual(tasks_mock.save_apprc_file.call_count, 0)
+
+    @mock.patch('sys.argv', ['', 'http://localhost', 'token', 'app1', 'mycmd', 'deploy'])
+    @mock.patch('tsuru_unit_agent.main.heartbeat')
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    @mock.patch('tsuru_unit_agent.main.Client')
+    def test_main_deploy_action_uploads_during_build_hooks(self, client_mock, tasks_mock, heartbeat_mock):
+        uploaded = threading.Event()
+        circus_written = threading.Event()
+        client_mock.return_value.register_unit.return_value = {'env1': 'val1'}
+        client_mock.return_value.post_app_yaml.side_effect = lambda *args: uploaded.set()
+        tasks_mock.write_circus_conf.side_effect = lambda **kwargs: circus_written.set()
+        tasks_mock.load_app_yaml.return_value = {}
+        tasks_mock.customdata_digest.return_value = "new-digest"
+        tasks_mock.load_customdata_digest.return_value = None
+
+        def build_hooks(*args, **kwargs):
+            self.assertTrue(uploaded.wait(5))
+            self.assertTrue(circus_written.wait(5))
+        tasks_mock.run_build_hooks.side_effect = build_hooks
+        main()
+        tasks_mock.save_customdata_digest.assert_called_once_with("new-digest")
+
+    @mock.patch('sys.argv', ['', 'http://localhost', 'token', 'app1', 'mycmd', 'deploy'])
+    @mock.patch('tsuru_unit_agent.main.heartbeat')
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    @mock.patch('tsuru_unit_agent.main.Client')
+    def test_main_deploy_action_hook_failure_wins(self, client_mock, tasks_mock, heartbeat_mock):
+        client_mock.return_value.post_app_yaml.side_effect = Exception("upload failed")
+        tasks_mock.load_app_yaml.return_value = {}
+        tasks_mock.customdata_digest.return_value = "new-digest"
+        tasks_mock.run_build_hooks.side_effect = SystemExit(3)
+        with self.assertRaises(SystemExit) as cm:
+            main()
+        self.assertEqual(cm.exception.code, 3)
+        self.assertEqual(client_mock.return_value.post_app_yaml.call_count, 1)
+
+    @mock.patch('sys.argv', ['', 'http://localhost', 'token', 'app1', 'mycmd', 'deploy'])
+    @mock.patch('tsuru_unit_agent.main.heartbeat')
+    @mock.patch('tsuru_unit_agent.main.tasks')
+    @mock.patch('tsuru_unit_agent.main.Client')
+    def test_main_deploy_action_upload_failure(self, client_mock, tasks_mock, heartbeat_mock):
+        client_mock.return_value.post_app_yaml.side_effect = Exception("upload failed")
+        tasks_mock.write_circus_conf.side_effect = IOError("circus failed")
+        tasks_mock.load_app_yaml.return_value = {}
+        tasks_mock.customdata_digest.return_value = "new-digest"
+        with self.assertRaises(Exception) as cm:
+            main()
+        self.assertEqual(str(cm.exception), "upload failed")
+        self.assertEqual(tasks_mock.run_build_hooks.call_count, 1)
+        self.assertEqual(tasks_mock.save_customdata_digest.call_count, 0)
@@ -0,0 +1,156 @@
+import BaseHTTPServer
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from tsuru_unit_agent import readiness
+from tsuru_unit_agent.readiness import Probe, probe_settings, validate_probe, wait_ready, wait_until_ready
+
+
+class HealthcheckServer(BaseHTTPServer.HTTPServer):
+
+    def __init__(self, statuses):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), HealthcheckHandler)
+        self.statuses = list(statuses)
+        self.paths = []
+
+
+class HealthcheckHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        status = self.server.statuses.pop(0) if len(self.server.statuses) > 1 else self.server.statuses[0]
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class ProbeSettingsTest(unittest.TestCase):
+
+    def test_no_healthcheck(self):
+        self.assertIsNone(probe_settings(None))
+        self.assertIsNone(probe_settings({}))
+        self.assertIsNone(probe_settings({"healthcheck": None}))
+
+    def test_tcp(self):
+        self.assertEqual(probe_settings({"healthcheck": {}}, {"PORT": "8888"}),
+                         Probe("127.0.0.1", 8888, None, None, 60, 0.01, 0.5))
+
+    def test_http(self):
+        app_data = {"healthcheck": {"path": "health", "status": 204, "port": 9000, "deadline": 5,
+                                    "interval": 0.1, "max_interval": 2}}
+        self.assertEqual(probe_settings(app_data, {"PORT": "8888"}),
+                         Probe("127.0.0.1", 9000, "/health", 204, 5, 0.1, 2))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, probe_settings, {"healthcheck": {"port": "http"}})
+        self.assertRaises(ValueError, probe_settings, {"healthcheck": {"deadline": "soon"}})
+
+    @mock.patch("sys.stderr")
+    def test_validate_invalid(self, stderr_mock):
+        app_data = {"healthcheck": {"port": "http"}, "hooks": {}}
+        self.assertIsNone(validate_probe(app_data, {"PORT": "8888"}))
+        self.assertEqual(app_data, {"hooks": {}})
+        self.assertIn("ignoring invalid healthcheck", stderr_mock.write.call_args[0][0])
+
+    def test_validate(self):
+        app_data = {"healthcheck": {}}
+        self.assertEqual(validate_probe(app_data, {"PORT": "8888"}), probe_settings(app_data, {"PORT": "8888"}))
+        self.assertEqual(app_data, {"healthcheck": {}})
+
+
+class WaitReadyTest(unittest.TestCase):
+
+    def serve(self, server):
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.addCleanup(stop)
+        return server.server_address[1]
+
+    def test_tcp_ready(self):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(1)
+        self.addCleanup(sock.close)
+        probe = Probe("127.0.0.1", sock.getsockname()[1], None, None, 5, 0.01, 0.5)
+        self.assertTrue(wait_ready(probe))
+
+    def test_tcp_not_ready(self):
+        sleep = mock.Mock()
+        probe = Probe("127.0.0.1", free_port(), None, None, 0.2, 0.01, 0.04)
+        with mock.patch("time.time", side_effect=[0, 0, 0, 0.1, 0.1, 0.15, 0.15, 0.19, 0.19, 0.2]):
+            self.assertFalse(wait_ready(probe, sleep=sleep))
+        self.assertEqual([round(c[0][0], 3) for c in sleep.call_args_list], [0.01, 0.02, 0.04, 0.01])
+
+    def test_http_waits_for_status(self):
+        server = HealthcheckServer([503, 503, 200])
+        port = self.serve(server)
+        self.assertTrue(wait_ready(Probe("127.0.0.1", port, "/health", None, 5, 0.001, 0.01)))
+        self.assertEqual(server.paths, ["/health"] * 3)
+
+    def test_http_expected_status(self):
+        port = self.serve(HealthcheckServer([200]))
+        self.assertFalse(wait_ready(Probe("127.0.0.1", port, "/", 204, 0.1, 0.01, 0.02)))
+        port = self.serve(HealthcheckServer([204]))
+        self.assertTrue(wait_ready(Probe("127.0.0.1", port, "/", 204, 5, 0.01, 0.02)))
+
+    def test_http_unreachable(self):
+        self.assertFalse(wait_ready(Probe("127.0.0.1", free_port(), "/", None, 0.1, 0.01, 0.02)))
+
+
+class WaitUntilReadyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "ready")
+        self.envs = {"TSURU_UNIT_READY_FILE": self.path, "PORT": "8888"}
+
+    @mock.patch("sys.stderr")
+    @mock.patch("tsuru_unit_agent.readiness.wait_ready")
+    def test_without_healthcheck(self, wait_mock, stderr_mock):
+        self.assertIsNone(wait_until_ready({}, self.envs))
+        self.assertEqual(wait_mock.call_count, 0)
+        self.assertTrue(os.path.exists(self.path))
+        stderr_mock.write.assert_called_once_with("tsuru_unit_agent: unit ready\n")
+
+    @mock.patch("sys.stderr")
+    @mock.patch("tsuru_unit_agent.readiness.wait_ready")
+    def test_ready(self, wait_mock, stderr_mock):
+        wait_mock.return_value = True
+        self.assertTrue(wait_until_ready({"healthcheck": {"path": "/"}}, self.envs))
+        wait_mock.assert_called_once_with(Probe("127.0.0.1", 8888, "/", None, 60, 0.01, 0.5))
+        self.assertTrue(os.path.exists(self.path))
+        self.assertIn("unit ready", stderr_mock.write.call_args[0][0])
+        readiness.clear_ready(self.envs)
+        self.assertFalse(os.path.exists(self.path))
+        readiness.clear_ready(self.envs)
+
+    @mock.patch("sys.stderr")
+    @mock.patch("tsuru_unit_agent.readiness.wait_ready")
+    def test_not_ready(self, wait_mock, stderr_mock):
+        wait_mock.return_value = False
+        self.assertFalse(wait_until_ready({"healthcheck": {}}, self.envs))
+        self.assertFalse(os.path.exists(self.path))
+        self.assertIn("not ready", stderr_mock.write.call_args[0][0])
@@ -2,6 +2,9 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import BaseHTTPServer
+import SocketServer
+import threading
 import unittest
 import mock
 import logging
@@ -9,7 +12,20 @@ import socket
 import Queue
 import time
 
-from tsuru_unit_agent.stream import Stream, TsuruLogWriter, LogEntry, QUEUE_DONE_MESSAGE
+import requests
+
+from tsuru_unit_agent.stream import (
+    FairQueue,
+    LineDeduper,
+    LogEntry,
+    QUEUE_DONE_MESSAGE,
+    Stream,
+    StreamingTransport,
+    TsuruLogWriter,
+    json_array,
+    parse_weights,
+    streaming_transport,
+)
 
 mocked_environ = {
     "TSURU_APPNAME": "appname1",
@@ -71,6 +87,11 @@ class StreamTestCase(unittest.TestCase):
         self.assertEqual(2, entry.timeout)
         self.assertEqual([expected_msg], entry.messages)
 
+    def test_should_send_log_not_utf8_to_tsuru(self):
+        self.stream({"data": "caf\xe9\n", "name": "stdout"})
+        entry = self.stream.queue.get()
+        self.assertEqual([u"caf\ufffd\n"], entry.messages)
+
     @mock.patch("logging.getLogger")
     @mock.patch("logging.handlers.SysLogHandler")
     def test_should_send_log_to_syslog_as_info(self, s_handler, logger):
@@ -312,6 +333,53 @@ class TsuruLogWriterTestCase(unittest.TestCase):
         self.assertTrue(45 < session.post.call_count <= 66)
         session.post.assert_any_call('url', data='["msg-1"]', timeout=1)
 
+    def test_batch(self):
+        session = mock.Mock()
+        queue = Queue.Queue(maxsize=1000)
+        for i in xrange(5):
+            queue.put_nowait(LogEntry('url', 1, ['msg-{}'.format(i)]))
+        queue.put_nowait(LogEntry('url2', 1, ['other']))
+        queue.put_nowait(QUEUE_DONE_MESSAGE)
+        writer = TsuruLogWriter(session, queue, None, None, batch_size=4)
+        writer.start()
+        writer.join()
+        self.assertEqual(session.post.call_args_list, [
+            mock.call('url', data='["msg-0", "msg-1", "msg-2", "msg-3"]', timeout=1),
+            mock.call('url', data='["msg-4"]', timeout=1),
+            mock.call('url2', data='["other"]', timeout=1),
+        ])
+
+    def test_batch_rate_limit(self):
+        session = mock.Mock()
+        queue = Queue.Queue(maxsize=1000)
+        for i in xrange(5):
+            queue.put_nowait(LogEntry('url', 1, ['msg-{}'.format(i)]))
+        queue.put_nowait(QUEUE_DONE_MESSAGE)
+        writer = TsuruLogWriter(session, queue, 60, 3, batch_size=10)
+        writer.start()
+        writer.join()
+        self.assertEqual(session.post.call_args_list, [
+            mock.call('url', data='["dropping messages, more than 3 messages in last 60 seconds"]', timeout=1),
+            mock.call('url', data='["msg-0", "msg-1", "msg-2"]', timeout=1),
+        ])
+
+    def test_stream_shared_queue(self):
+        queue = Queue.Queue()
+        with mock.patch("tsuru_unit_agent.stream.TsuruLogWriter") as writer_mock:
+            stream = Stream(watcher_name="web", queue=queue, envs=mocked_environ)
+        self.assertEqual(writer_mock.call_count, 0)
+        self.assertIs(stream.queue, queue)
+
+    def test_last_status(self):
+        session = mock.Mock()
+        session.post.side_effect = [mock.Mock(status_code=503), requests.ConnectionError()]
+        writer = TsuruLogWriter(session, mock.Mock(), None, None)
+        writer.write_entries([LogEntry('url', 1, ['msg'])])
+        self.assertEqual(writer.stats()["last_status"], 503)
+        writer.write_entries([LogEntry('url', 1, ['msg'])])
+        self.assertEqual(writer.stats()["last_status"], "ConnectionError")
+        self.assertIsNotNone(writer.stats()["last_post"])
+
     def test_rate_limit_not_configured(self):
         session = mock.Mock()
         queue = Queue.Queue(maxsize=1000)
@@ -335,3 +403,323 @@ class TsuruLogWriterTestCase(unittest.TestCase):
         writer.join()
         self.assertEqual(session.post.call_count, 100)
         session.post.assert_any_call('url', data='["msg-1"]', timeout=1)
+
+
+class FairQueueTestCase(unittest.TestCase):
+
+    def entry(self, source, message="msg", count=1):
+        return LogEntry('url', 1, [message] * count, source)
+
+    def drain(self, queue, n):
+        return [queue.get_nowait().source for _ in range(n)]
+
+    def test_parse_weights(self):
+        self.assertEqual(parse_weights("stderr=4, web=2,worker:stdout=0.5"),
+                         {"stderr": 4.0, "web": 2.0, "worker:stdout": 0.5})
+        self.assertEqual(parse_weights(None), {})
+        with mock.patch("logging.error") as error_mock:
+            self.assertEqual(parse_weights("web=lots,,stderr=2"), {"stderr": 2.0})
+        self.assertEqual(error_mock.call_count, 1)
+
+    def test_weight(self):
+        queue = FairQueue(weights={"stderr": 4, "web": 2, "web:stderr": 8})
+        self.assertEqual(queue.weight(("web", "stderr")), 8)
+        self.assertEqual(queue.weight(("web", "stdout")), 2)
+        self.assertEqual(queue.weight(("worker", "stderr")), 4)
+        self.assertEqual(queue.weight(("worker", "stdout")), 1)
+        self.assertEqual(queue.weight(None), 1)
+
+    def test_round_robin(self):
+        queue = FairQueue(quantum=1)
+        noisy, quiet = ("web", "stdout"), ("worker", "stdout")
+        for _ in range(10):
+            queue.put_nowait(self.entry(noisy))
+        queue.put_nowait(self.entry(quiet))
+        queue.put_nowait(self.entry(quiet))
+        self.assertEqual(self.drain(queue, 5), [noisy, quiet, noisy, quiet, noisy])
+        self.assertEqual(queue.qsize(), 7)
+
+    def test_weighted(self):
+        queue = FairQueue(weights={"stderr": 3}, quantum=1)
+        out, err = ("web", "stdout"), ("web", "stderr")
+        for _ in range(8):
+            queue.put_nowait(self.entry(out))
+            queue.put_nowait(self.entry(err))
+        sources = self.drain(queue, 8)
+        self.assertEqual(sources.count(err), 6)
+        self.assertEqual(sources.count(out), 2)
+
+    def test_deficit_counts_messages(self):
+        queue = FairQueue(quantum=2)
+        big, small = ("web", "stdout"), ("worker", "stdout")
+        queue.put_nowait(self.entry(big, count=4))
+        for _ in range(4):
+            queue.put_nowait(self.entry(small))
+        self.assertEqual(self.drain(queue, 5), [small, small, big, small, small])
+
+    def test_full_drops_from_noisiest_source(self):
+        queue = FairQueue(maxsize=4)
+        noisy, quiet = ("web", "stdout"), ("worker", "stdout")
+        for i in range(4):
+            queue.put_nowait(self.entry(noisy, "noisy-{}".format(i)))
+        self.assertTrue(queue.full())
+        self.assertRaises(Queue.Full, queue.put_nowait, self.entry(noisy))
+        queue.put_nowait(self.entry(quiet))
+        queue.put_nowait(self.entry(quiet))
+        self.assertRaises(Queue.Full, queue.put_nowait, self.entry(quiet))
+        self.assertEqual(queue.dropped, 2)
+        messages = [queue.get_nowait().messages[0] for _ in range(4)]
+        self.assertEqual(sorted(messages), ["msg", "msg", "noisy-2", "noisy-3"])
+
+    def test_byte_budget(self):
+        queue = FairQueue(max_bytes=40)
+        web = ("web", "stdout")
+        queue.put_nowait(self.entry(web, "a" * 10))
+        self.assertEqual(queue.bytes, 13)
+        queue.put_nowait(self.entry(web, "b" * 10, count=2))
+        self.assertEqual(queue.bytes, 39)
+        self.assertRaises(Queue.Full, queue.put_nowait, self.entry(web, "c"))
+        self.assertRaises(Queue.Full, queue.put_nowait, self.entry(("worker", "stdout"), "x" * 50))
+        queue.get_nowait()
+        self.assertEqual(queue.bytes, 26)
+        queue.get_nowait()
+        self.assertEqual(queue.bytes, 0)
+        self.assertEqual(queue.source_bytes, {})
+
+    def test_byte_budget_drops_from_largest_source(self):
+        queue = FairQueue(max_bytes=45, maxsize=100, quantum=1)
+        noisy, quiet = ("web", "stdout"), ("worker", "stdout")
+        for i in range(3):
+            queue.put_nowait(self.entry(noisy, "noisy-{}".format(i) + "." * 4))
+        queue.put_nowait(self.entry(quiet, "quiet"))
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(queue.bytes, 36)
+        self.assertEqual([queue.get_nowait().messages[0] for _ in range(3)],
+                         ["noisy-1....", "quiet", "noisy-2...."])
+
+    def test_done_after_pending_entries(self):
+        queue = FairQueue()
+        queue.put_nowait(self.entry(("web", "stdout")))
+        queue.put_nowait(QUEUE_DONE_MESSAGE)
+        self.assertEqual(queue.get().source, ("web", "stdout"))
+        self.assertIs(queue.get(), QUEUE_DONE_MESSAGE)
+
+    def test_get_empty(self):
+        queue = FairQueue()
+        self.assertTrue(queue.empty())
+        self.assertRaises(Queue.Empty, queue.get_nowait)
+        self.assertRaises(Queue.Empty, queue.get, True, 0.01)
+
+    def test_writer(self):
+        session = mock.Mock()
+        queue = FairQueue(quantum=1)
+        for i in range(3):
+            queue.put_nowait(self.entry(("web", "stdout"), "out-{}".format(i)))
+        queue.put_nowait(self.entry(("web", "stderr"), "err"))
+        queue.put_nowait(QUEUE_DONE_MESSAGE)
+        writer = TsuruLogWriter(session, queue, None, None)
+        writer.start()
+        writer.join()
+        self.assertEqual([c[1]["data"] for c in session.post.call_args_list],
+                         ['["out-0"]', '["err"]', '["out-1"]', '["out-2"]'])
+        self.assertEqual(queue.unfinished_tasks, 0)
+
+
+class LineDeduperTestCase(unittest.TestCase):
+
+    def test_collapse_consecutive_lines(self):
+        dedupe = LineDeduper(10)
+        self.assertEqual(dedupe.feed(["a\n", "a\n", "a\n", "b\n", "a\n"], now=0),
+                         ["a\n", "last message repeated 2 times\n", "b\n", "a\n"])
+        self.assertEqual(dedupe.feed(["a\n"], now=1), [])
+        self.assertEqual(dedupe.flush(), ["last message repeated 1 times\n"])
+        self.assertEqual(dedupe.flush(), [])
+        self.assertEqual(dedupe.feed(["a\n"], now=2), ["a\n"])
+
+    def test_window(self):
+        dedupe = LineDeduper(5)
+        self.assertEqual(dedupe.feed(["a\n", "a\n"], now=0), ["a\n"])
+        self.assertEqual(dedupe.feed(["a\n"], now=4), [])
+        self.assertEqual(dedupe.feed(["a\n"], now=5), ["last message repeated 2 times\n", "a\n"])
+
+    def test_mask(self):
+        lines = ["retry 1 of 0x1f at 10:00:01\n", "retry 2 of 0x2e at 10:00:02\n",
+                 "request 3fa9c2 failed\n", "request 77b1e0 failed\n"]
+        self.assertEqual(LineDeduper(10).feed(lines, now=0), lines)
+        dedupe = LineDeduper(10, mask=True)
+        self.assertEqual(dedupe.feed(lines, now=0), [lines[0], "last message repeated 1 times\n", lines[2]])
+        self.assertEqual(dedupe.flush(), ["last message repeated 1 times\n"])
+
+
+@mock.patch("tsuru_unit_agent.stream.gethostname", mock.Mock(return_value="myhost"))
+class StreamDedupeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        envs = dict(mocked_environ, LOG_DEDUPE_WINDOW="0.1", TSURU_SYSLOG_SERVER="")
+        self.queue = Queue.Queue()
+        self.stream = Stream(watcher_name="web", envs=envs, queue=self.queue)
+
+    def messages(self):
+        result = []
+        while not self.queue.empty():
+            entry = self.queue.get_nowait()
+            if entry is not QUEUE_DONE_MESSAGE:
+                result.extend(entry.messages)
+        return result
+
+    def test_repeats_reported_on_idle(self):
+        for _ in range(100):
+            self.stream({"data": "connection refused\n", "name": "stderr"})
+        self.assertEqual(self.messages(), ["connection refused\n"])
+        time.sleep(0.3)
+        self.assertEqual(self.messages(), ["last message repeated 99 times\n"])
+        self.assertIsNone(self.stream._repeat_timer)
+
+    def test_repeats_reported_on_close(self):
+        self.stream({"data": "a\na\na\n"})
+        self.stream.close()
+        self.assertEqual(self.messages(), ["a\n", "last message repeated 2 times\n"])
+        self.assertIsNone(self.stream._repeat_timer)
+
+    def test_disabled_by_default(self):
+        stream = Stream(watcher_name="web", envs=mocked_environ, queue=self.queue)
+        self.assertIsNone(stream.dedupe)
+
+
+class LogServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, chunked=True):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), LogHandler)
+        self.chunked = chunked
+        self.requests = []
+        self.url = "http://127.0.0.1:{}/apps/app1/log?source=web".format(self.server_address[1])
+
+
+class LogHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        chunked = self.headers.get("Transfer-Encoding") == "chunked"
+        if chunked:
+            body = ""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunk = self.rfile.read(size + 2)
+                if not size:
+                    break
+                body += chunk[:-2]
+        else:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests.append((chunked, body))
+        self.send_response(200 if self.server.chunked or not chunked else 411)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StreamingTransportTestCase(unittest.TestCase):
+
+    def start_server(self, chunked=True):
+        server = LogServer(chunked)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.addCleanup(stop)
+        return server
+
+    def test_streaming_transport_from_envs(self):
+        session = mock.Mock()
+        self.assertIsNone(streaming_transport(session, {}))
+        transport = streaming_transport(session, {"LOG_STREAMING": "true", "LOG_STREAMING_MAX_BYTES": "100",
+                                                  "LOG_STREAMING_MAX_AGE": "5"})
+        self.assertEqual((transport.max_bytes, transport.max_age), (100, 5))
+
+    def test_writer_streams_ndjson(self):
+        server = self.start_server()
+        session = requests.Session()
+        queue = Queue.Queue()
+        writer = TsuruLogWriter(session, queue, None, None, transport=StreamingTransport(session))
+        writer.start()
+        for i in xrange(3):
+            queue.put_nowait(LogEntry(server.url, 2, ["msg-{}".format(i), "x"]))
+        queue.put_nowait(QUEUE_DONE_MESSAGE)
+        writer.join()
+        self.assertEqual(server.requests, [(True, '"msg-0"\n"x"\n"msg-1"\n"x"\n"msg-2"\n"x"\n')])
+
+    def test_rotate_on_size(self):
+        server = self.start_server()
+        transport = StreamingTransport(requests.Session(), max_bytes=5)
+        for i in xrange(3):
+            self.assertTrue(transport.send(server.url, '"msg-{}"\n'.format(i), 2))
+        transport.close()
+        self.assertEqual(sorted(server.requests), [(True, '"msg-0"\n'), (True, '"msg-1"\n'), (True, '"msg-2"\n')])
+
+    def test_rotate_idle_upload_on_age(self):
+        server = self.start_server()
+        session = requests.Session()
+        queue = Queue.Queue()
+        writer = TsuruLogWriter(session, queue, None, None,
+                                transport=StreamingTransport(session, max_age=0.1))
+        writer.start()
+        queue.put_nowait(LogEntry(server.url, 2, ["msg"]))
+        t0 = time.time()
+        while not server.requests and time.time() - t0 < 5:
+            time.sleep(0.05)
+        self.assertEqual(server.requests, [(True, '"msg"\n')])
+        queue.put_nowait(QUEUE_DONE_MESSAGE)
+        writer.join()
+
+    @mock.patch("logging.error")
+    def test_fallback_to_batched_posts(self, error_mock):
+        server = self.start_server(chunked=False)
+        transport = StreamingTransport(requests.Session())
+        self.assertTrue(transport.send(server.url, '"msg-0"\n"msg-1"\n', 2))
+        transport.close()
+        self.assertIn(server.url, transport.unsupported)
+        self.assertEqual(server.requests, [(True, '"msg-0"\n"msg-1"\n'), (False, '["msg-0", "msg-1"]')])
+        self.assertFalse(transport.send(server.url, '"msg-2"\n', 2))
+        self.assertEqual(error_mock.call_count, 1)
+
+    def test_failed_upload_resent(self):
+        session = mock.Mock()
+        session.post.side_effect = [requests.ConnectionError(), mock.Mock(status_code=200)]
+        transport = StreamingTransport(session)
+        transport.send("http://tsuru/log", '"msg"\n', 2)
+        transport.close()
+        session.post.assert_called_with("http://tsuru/log", data='["msg"]', timeout=2)
+        self.assertEqual(transport.failures["http://tsuru/log"], 1)
+        self.assertNotIn("http://tsuru/log", transport.unsupported)
+
+
+class LogEntryTestCase(unittest.TestCase):
+
+    def test_payload(self):
+        entry = LogEntry("url", 2, ["line 1\n", u"caf\xe9\n"], ("web", "stdout"))
+        self.assertEqual(entry.payload, '"line 1\\n"\n"caf\\u00e9\\n"\n')
+        self.assertEqual(entry.size, len(entry.payload))
+        self.assertEqual(entry.count, 2)
+        self.assertEqual(entry.messages, ["line 1\n", u"caf\xe9\n"])
+        self.assertFalse(hasattr(entry, "__dict__"))
+
+    def test_payload_not_utf8(self):
+        entry = LogEntry("url", 2, ["caf\xe9\n", "ok\n"])
+        self.assertEqual(entry.payload, '"caf\\ufffd\\n"\n"ok\\n"\n')
+        self.assertEqual(entry.messages, [u"caf\ufffd\n", "ok\n"])
+
+    def test_json_array(self):
+        entries = [LogEntry("url", 2, ["a", "b, c"]), LogEntry("url", 2, ["d\n"])]
+        self.assertEqual(json_array([e.payload for e in entries]), '["a", "b, c", "d\\n"]')
+        self.assertEqual(json_array([]), "[]")
+
+    @mock.patch("tsuru_unit_agent.stream.TsuruLogWriter")
+    def test_stream_queue_budget(self, writer_mock):
+        stream = Stream(envs={"LOG_MAX_QUEUE_BYTES": "1024", "LOG_MAX_QUEUE_SIZE": "10"})
+        self.assertEqual((stream.queue.max_bytes, stream.queue.maxsize), (1024, 10))
+        stream = Stream(envs={})
+        self.assertEqual((stream.queue.max_bytes, stream.queue.maxsize), (4 << 20, 0))
@@ -2,17 +2,38 @@
 
 from unittest import TestCase
 import mock
+import datetime
+import json
 import os
+import shutil
 import sys
+import tempfile
+import time
 
+import yaml
+
+from tsuru_unit_agent import tasks
 from tsuru_unit_agent.tasks import (
+    apply_circus_conf,
+    customdata_digest,
     execute_start_script,
     load_app_yaml,
+    load_customdata_digest,
+    load_envs_etag,
     load_procfile,
+    load_procfile_commands,
+    load_watchers_env_inputs,
     run_build_hooks,
     run_restart_hooks,
     save_apprc_file,
+    save_customdata_digest,
+    save_envs_etag,
     parse_apprc_file,
+    read_circus_endpoint,
+    replace_with_start_script,
+    restart_hooks,
+    spawn_after_exec,
+    spawn_detached,
     write_circus_conf,
 )
 
@@ -48,16 +69,53 @@ class TestTasks(TestCase):
         exit_mock.assert_called_once_with(10)
 
     def test_save_apprc_file(self):
+        environs = {"DATABASE_USER": "root", "DATABASE_HOST": "localhost"}
+        path = os.path.join(tempfile.mkdtemp(), "apprc")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        self.assertTrue(save_apprc_file(environs, file_path=path))
+        with open(path) as f:
+            lines = f.readlines()
+        self.assertRegexpMatches(lines[0], '# generated by tsuru at .*\n')
+        self.assertEqual(lines[1:], ["export DATABASE_HOST='localhost'\n",
+                                     "export DATABASE_USER='root'\n"])
+        self.assertEqual(os.listdir(os.path.dirname(path)), ["apprc"])
+
+    def test_save_apprc_file_unchanged(self):
         environs = {"DATABASE_HOST": "localhost", "DATABASE_USER": "root"}
-        with mock.patch("io.open", mock.mock_open()) as m:
-            save_apprc_file(environs)
-            m.assert_called_once_with("/home/application/apprc", "w")
-            write_mock = m().write
-            self.assertRegexpMatches(write_mock.mock_calls[0][1][0],
-                                     '# generated by tsuru at .*\n')
-            write_mock.assert_any_call('export DATABASE_HOST=\'localhost\'\n')
-            write_mock.assert_any_call('export DATABASE_USER=\'root\'\n')
-            self.assertEqual(len(write_mock.mock_calls), 3)
+        path = os.path.join(tempfile.mkdtemp(), "apprc")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        self.assertTrue(save_apprc_file(environs, file_path=path))
+        inode = os.stat(path).st_ino
+        with mock.patch("tempfile.mkstemp") as mkstemp_mock:
+            self.assertFalse(save_apprc_file(environs, file_path=path))
+            self.assertEqual(mkstemp_mock.call_count, 0)
+        self.assertEqual(os.stat(path).st_ino, inode)
+        environs["DATABASE_USER"] = "admin"
+        self.assertTrue(save_apprc_file(environs, file_path=path))
+        self.assertNotEqual(os.stat(path).st_ino, inode)
+        self.assertEqual(parse_apprc_file(path), environs)
+
+    def test_save_load_envs_etag(self):
+        path = os.path.join(tempfile.mkdtemp(), "apprc")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        save_envs_etag('"v1"', file_path=path)
+        self.assertIsNone(load_envs_etag(file_path=path))
+        save_apprc_file({"A": "B"}, file_path=path)
+        self.assertEqual(load_envs_etag(file_path=path), '"v1"')
+        save_envs_etag(None, file_path=path)
+        self.assertFalse(os.path.exists(path + ".etag"))
+        self.assertIsNone(load_envs_etag(file_path=path))
+
+    def test_customdata_digest(self):
+        path = os.path.join(tempfile.mkdtemp(), "customdata.sha1")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        digest = customdata_digest({"hooks": {"build": ["a"]}, "procfile": "web: a"}, '"v1"')
+        self.assertEqual(digest, customdata_digest({"procfile": "web: a", "hooks": {"build": ["a"]}}, '"v1"'))
+        self.assertNotEqual(digest, customdata_digest({"procfile": "web: b", "hooks": {"build": ["a"]}}, '"v1"'))
+        self.assertNotEqual(digest, customdata_digest({"procfile": "web: a", "hooks": {"build": ["a"]}}, '"v2"'))
+        self.assertIsNone(load_customdata_digest(path))
+        save_customdata_digest(digest, path)
+        self.assertEqual(load_customdata_digest(path), digest)
 
     def test_parse_apprc_file(self):
         path = os.path.join(os.path.dirname(__file__), "fixtures", "apprc")
@@ -71,10 +129,43 @@ class TestTasks(TestCase):
             "F": "a(a",
             "MY_awesome_BIG_name": "something",
         }
-        for k, v in envs.items():
-            if k not in expected:
-                envs.pop(k)
+        # nothing the shell sets itself, like PWD or SHLVL, leaks in.
+        self.assertDictEqual(envs, expected)
+
+    @mock.patch("subprocess.Popen")
+    def test_parse_apprc_file_native(self, popen_mock):
+        path = os.path.join(os.path.dirname(__file__), "fixtures", "apprc.native")
+        envs = parse_apprc_file(path)
+        expected = {
+            "A": "B",
+            "C": "C D",
+            "QUOTED": "some'thin'g'",
+            "MULTILINE": "my\nmulti\"line\", with ' quotes'\n",
+            "EMPTY": "",
+            "BARE": "888",
+        }
         self.assertDictEqual(envs, expected)
+        self.assertEqual(popen_mock.call_count, 0)
+
+    @mock.patch("subprocess.Popen")
+    def test_parse_apprc_file_unknown_lines_use_shell(self, popen_mock):
+        popen_mock.return_value.communicate.return_value = (
+            '{"A": "B", "b": "888", "PWD": "/"}\n{"A": "B", "b": "888", "PWD": "/", "C": "C D"}\n', '')
+        path = os.path.join(os.path.dirname(__file__), "fixtures", "apprc")
+        envs = parse_apprc_file(path)
+        self.assertDictEqual(envs, {"A": "B", "b": "888", "MY_awesome_BIG_name": "something", "C": "C D"})
+        self.assertEqual(popen_mock.call_count, 1)
+        script = popen_mock.call_args[0][0]
+        self.assertIn('export C="C D"', script)
+        self.assertNotIn("export A=B", script)
+        self.assertEqual(popen_mock.call_args[1]["env"],
+                         {"A": "B", "b": "888", "MY_awesome_BIG_name": "something"})
+
+    def test_parse_apprc_file_unknown_lines_unset(self):
+        path = os.path.join(tempfile.mkdtemp(), "apprc")
+        with open(path, "w") as f:
+            f.write("export A='B'\nexport C='D'\nunset C\n")
+        self.assertDictEqual(parse_apprc_file(path), {"A": "B"})
 
     def test_save_parse_apprc_escaping(self):
         expected = {
@@ -167,7 +258,7 @@ class RunHooksTest(TestCase):
 
 class RunRestartHooksTest(TestCase):
 
-    @mock.patch("tsuru_unit_agent.tasks.Stream")
+    @mock.patch("tsuru_unit_agent.stream.Stream")
     @mock.patch("os.environ", {'env': 'var', 'env1': 'var1'})
     @mock.patch("subprocess.Popen")
     def test_run_restart_hooks(self, popen_call, Stream):
@@ -195,7 +286,7 @@ class RunRestartHooksTest(TestCase):
         self.assertEqual(popen_call.call_args_list[3][0][0], 'a1')
         self.assertEqual(popen_call.call_args_list[2][0][0], 'a2')
 
-    @mock.patch("tsuru_unit_agent.tasks.Stream")
+    @mock.patch("tsuru_unit_agent.stream.Stream")
     @mock.patch("os.environ", {'env': 'var', 'env1': 'var1'})
     @mock.patch("subprocess.Popen")
     def test_run_restart_hooks_calls_stream(self, popen_call, stream_mock):
@@ -234,11 +325,110 @@ class RunRestartHooksTest(TestCase):
         stream_mock.return_value.flush.assert_any_call()
         stream_mock.return_value.close.assert_any_call()
 
+    def test_restart_hooks(self):
+        data = {"hooks": {"restart": {"after": ["a1"], "after-each": ["a2"]}}}
+        self.assertEqual(restart_hooks('after', data), ['a2', 'a1'])
+        self.assertEqual(restart_hooks('after', data), ['a2', 'a1'])
+        self.assertEqual(restart_hooks('before', data), [])
+        self.assertEqual(restart_hooks('after', {}), [])
+
+
+class StartScriptTest(TestCase):
+
+    @mock.patch("os.execvpe")
+    @mock.patch("os.chdir")
+    @mock.patch("os.environ", {'env': 'var', 'env1': 'var1'})
+    def test_replace_with_start_script(self, chdir_mock, execvpe_mock):
+        replace_with_start_script("/bin/start", envs={'env': 'varrr'}, working_dir="/tmp")
+        chdir_mock.assert_called_once_with("/tmp")
+        execvpe_mock.assert_called_once_with("/bin/start", ["/bin/start"], {'env': 'varrr', 'env1': 'var1'})
+
+    @mock.patch("os.execvpe")
+    @mock.patch("os.chdir")
+    def test_replace_with_start_script_default_cwd_missing(self, chdir_mock, execvpe_mock):
+        replace_with_start_script("/bin/start", working_dir="/does/not/exist")
+        chdir_mock.assert_called_once_with("/")
+
+    @mock.patch("os.waitpid")
+    @mock.patch("os.fork")
+    def test_spawn_detached_parent(self, fork_mock, waitpid_mock):
+        fork_mock.return_value = 42
+        func = mock.Mock()
+        spawn_detached(func, 1)
+        waitpid_mock.assert_called_once_with(42, 0)
+        self.assertEqual(func.call_count, 0)
+
+    @mock.patch("os._exit")
+    @mock.patch("os.setsid")
+    @mock.patch("os.fork")
+    def test_spawn_detached_child(self, fork_mock, setsid_mock, exit_mock):
+        fork_mock.side_effect = [0, 43]
+        func = mock.Mock()
+        spawn_detached(func, 1, a=2)
+        setsid_mock.assert_called_once_with()
+        self.assertEqual(func.call_count, 0)
+        exit_mock.assert_called_once_with(0)
+
+    @mock.patch("os._exit")
+    @mock.patch("os.setsid")
+    @mock.patch("os.fork")
+    def test_spawn_detached_grandchild(self, fork_mock, setsid_mock, exit_mock):
+        fork_mock.side_effect = [0, 0]
+        func = mock.Mock()
+        spawn_detached(func, 1, a=2)
+        func.assert_called_once_with(1, a=2)
+        exit_mock.assert_called_once_with(0)
+        fork_mock.side_effect = [0, 0]
+        func.side_effect = SystemExit(3)
+        spawn_detached(func)
+        exit_mock.assert_called_with(3)
+
+    def _spawn_after_exec(self, then):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "exe")
+
+        def record_exe(pid):
+            with open(path, "w") as f:
+                f.write(os.readlink("/proc/{}/exe".format(pid)))
+        pid = os.fork()
+        if pid == 0:
+            try:
+                spawn_after_exec(record_exe, os.getpid())
+                then()
+            finally:
+                os._exit(1)
+        return pid, path
+
+    def test_spawn_after_exec(self):
+        sleep = "/bin/sleep"
+        pid, path = self._spawn_after_exec(lambda: os.execv(sleep, [sleep, "0.5"]))
+        os.waitpid(pid, 0)
+        for _ in range(100):
+            if os.path.exists(path) and os.path.getsize(path):
+                break
+            time.sleep(0.05)
+        with open(path) as f:
+            self.assertEqual(os.path.basename(f.read()), "sleep")
+
+    def test_spawn_after_exec_caller_exits(self):
+        pid, path = self._spawn_after_exec(lambda: os._exit(0))
+        os.waitpid(pid, 0)
+        time.sleep(0.5)
+        self.assertFalse(os.path.exists(path))
+
 
 class LoadAppYamlTest(TestCase):
 
     def setUp(self):
         self.working_dir = os.path.dirname(__file__)
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.cache_path = os.path.join(cache_dir, "app_yaml_cache")
+        patcher = mock.patch.dict(os.environ, {"APP_YAML_CACHE_PATH": self.cache_path})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tasks._app_yaml_cache.clear()
         self.data = '''
 hooks:
   build:
@@ -274,6 +464,72 @@ hooks:
         data = load_app_yaml(os.path.join(self.working_dir, "fixtures/utf-8"))
         self.assertDictEqual(data, {"key": u"áéíãôüx"})
 
+    def test_load_app_yaml_cached(self):
+        path = os.path.join(self.working_dir, "tsuru.yaml")
+        with open(path, "w") as f:
+            f.write(self.data.format("cached"))
+        self.addCleanup(os.remove, path)
+        expected = {"hooks": {"build": ["cached_1", "cached_2"]}}
+        data = load_app_yaml(self.working_dir)
+        self.assertEqual(data, expected)
+        data["hooks"]["build"].append("changed")
+        with mock.patch("yaml.load") as load_mock:
+            self.assertEqual(load_app_yaml(self.working_dir), expected)
+            tasks._app_yaml_cache.clear()
+            self.assertEqual(load_app_yaml(self.working_dir), expected)
+            self.assertEqual(load_mock.call_count, 0)
+
+    def test_load_app_yaml_cache_invalidated(self):
+        path = os.path.join(self.working_dir, "tsuru.yaml")
+        with open(path, "w") as f:
+            f.write(self.data.format("old"))
+        self.addCleanup(os.remove, path)
+        self.assertEqual(load_app_yaml(self.working_dir),
+                         {"hooks": {"build": ["old_1", "old_2"]}})
+        with open(path, "w") as f:
+            f.write(self.data.format("newer"))
+        tasks._app_yaml_cache.clear()
+        self.assertEqual(load_app_yaml(self.working_dir),
+                         {"hooks": {"build": ["newer_1", "newer_2"]}})
+
+    def test_load_app_yaml_snapshot_is_json(self):
+        path = os.path.join(self.working_dir, "tsuru.yaml")
+        with open(path, "w") as f:
+            f.write(self.data.format("snap"))
+        self.addCleanup(os.remove, path)
+        load_app_yaml(self.working_dir)
+        with open(self.cache_path) as f:
+            snapshot = json.load(f)
+        self.assertEqual(snapshot["data"], {"hooks": {"build": ["snap_1", "snap_2"]}})
+
+    def test_load_app_yaml_ignores_pickled_snapshot(self):
+        path = os.path.join(self.working_dir, "tsuru.yaml")
+        with open(path, "w") as f:
+            f.write(self.data.format("safe"))
+        self.addCleanup(os.remove, path)
+        with open(self.cache_path, "wb") as f:
+            f.write(b"cos\nsystem\n(S'touch /tmp/pwned'\ntR.")
+        with mock.patch("os.system") as system_mock:
+            self.assertEqual(load_app_yaml(self.working_dir), {"hooks": {"build": ["safe_1", "safe_2"]}})
+        self.assertEqual(system_mock.call_count, 0)
+
+    def test_load_app_yaml_not_json_serializable(self):
+        path = os.path.join(self.working_dir, "tsuru.yaml")
+        with open(path, "w") as f:
+            f.write("released: 2015-01-02\n1: one\n")
+        self.addCleanup(os.remove, path)
+        expected = {"released": datetime.date(2015, 1, 2), 1: "one"}
+        self.assertEqual(load_app_yaml(self.working_dir), expected)
+        self.assertFalse(os.path.exists(self.cache_path))
+        self.assertEqual(load_app_yaml(self.working_dir), expected)
+
+    def test_load_app_yaml_is_safe(self):
+        path = os.path.join(self.working_dir, "tsuru.yaml")
+        with open(path, "w") as f:
+            f.write("key: !!python/object/apply:os.getcwd []")
+        self.addCleanup(os.remove, path)
+        self.assertRaises(yaml.YAMLError, load_app_yaml, self.working_dir)
+
     def test_load_broken_yaml(self):
         broken_yaml = '''
 hooks:
@@ -314,6 +570,8 @@ class WriteCircusConfTest(TestCase):
 
     def tearDown(self):
         open(self.conf_path, "w").write(self.original_conf)
+        if os.path.exists(self.conf_path + ".pending"):
+            os.remove(self.conf_path + ".pending")
         del os.environ["PORT"]
         del os.environ["POORT"]
 
@@ -381,6 +639,204 @@ stderr_stream.watcher_name = worker
         got_file = open(self.conf_path).read()
         self.assertEqual(expected_file, got_file)
 
+    def test_write_file_unchanged(self):
+        self.assertTrue(write_circus_conf(procfile_path=self.procfile_path, conf_path=self.conf_path,
+                                          envs={"PORT": "8888"}))
+        inode = os.stat(self.conf_path).st_ino
+        self.assertFalse(write_circus_conf(procfile_path=self.procfile_path, conf_path=self.conf_path,
+                                           envs={"PORT": "8888"}))
+        self.assertEqual(os.stat(self.conf_path).st_ino, inode)
+        self.assertTrue(write_circus_conf(procfile_path=self.procfile_path, conf_path=self.conf_path,
+                                          envs={"PORT": "8080"}))
+        self.assertNotEqual(os.stat(self.conf_path).st_ino, inode)
+
+    @mock.patch("tsuru_unit_agent.watchers.apply_watchers_diff")
+    def test_write_file_applies_diff_to_circus(self, apply_mock):
+        write_circus_conf(procfile_path=self.procfile_path, conf_path=self.conf_path,
+                          envs={"PORT": "8888"})
+        write_circus_conf(procfile_path=self.procfile_path + "2", conf_path=self.conf_path,
+                          envs={"PORT": "8888"}, circus_endpoint="tcp://127.0.0.1:5555")
+        self.assertEqual(apply_mock.call_count, 1)
+        endpoint, diff, current, desired = apply_mock.call_args[0]
+        self.assertEqual(endpoint, "tcp://127.0.0.1:5555")
+        self.assertEqual(diff, ([], [], ["web", "worker"]))
+        self.assertEqual(current["web"]["cmd"], "python run_my_app.py -p 8888 -l 8989")
+        self.assertEqual(desired["web"]["cmd"], "python run_their_app.py -p 8888")
+        write_circus_conf(procfile_path=self.procfile_path + "2", conf_path=self.conf_path,
+                          envs={"PORT": "8888"}, circus_endpoint="tcp://127.0.0.1:5555")
+        self.assertEqual(apply_mock.call_count, 1)
+
+    def test_write_file_parsed_procfile(self):
+        procfile = load_procfile_commands(self.procfile_path + "2")
+        write_circus_conf(procfile_path=self.procfile_path, conf_path=self.conf_path,
+                          envs={"PORT": "8888"}, procfile=procfile)
+        got_file = open(self.conf_path).read()
+        self.assertIn(u"cmd = python run_their_app.py -p 8888\n", got_file)
+        self.assertNotIn(u"run_my_app.py", got_file)
+
+    @mock.patch("tsuru_unit_agent.watchers.apply_watchers_diff")
+    def test_write_file_retries_failed_apply(self, apply_mock):
+        write_circus_conf(procfile_path=self.procfile_path, conf_path=self.conf_path,
+                          envs={"PORT": "8888"})
+        apply_mock.return_value = False
+        self.assertTrue(write_circus_conf(procfile_path=self.procfile_path + "2", conf_path=self.conf_path,
+                                          envs={"PORT": "8888"}, circus_endpoint="tcp://127.0.0.1:5555"))
+        self.assertTrue(os.path.exists(self.conf_path + ".pending"))
+        apply_mock.return_value = True
+        self.assertFalse(write_circus_conf(procfile_path=self.procfile_path + "2", conf_path=self.conf_path,
+                                           envs={"PORT": "8888"}, circus_endpoint="tcp://127.0.0.1:5555"))
+        self.assertEqual(apply_mock.call_count, 2)
+        # the retry starts from what circus runs, not from the file.
+        diff, current, desired = apply_mock.call_args[0][1:]
+        self.assertEqual(diff, ([], [], ["web", "worker"]))
+        self.assertEqual(current["web"]["cmd"], "python run_my_app.py -p 8888 -l 8989")
+        self.assertFalse(os.path.exists(self.conf_path + ".pending"))
+        self.assertTrue(apply_circus_conf(self.conf_path, "tcp://127.0.0.1:5555"))
+        self.assertEqual(apply_mock.call_count, 2)
+
+    @mock.patch("tsuru_unit_agent.watchers.apply_watchers_diff")
+    def test_write_file_without_endpoint_discards_pending(self, apply_mock):
+        write_circus_conf(procfile_path=self.procfile_path, conf_path=self.conf_path,
+                          envs={"PORT": "8888"})
+        apply_mock.return_value = False
+        write_circus_conf(procfile_path=self.procfile_path + "2", conf_path=self.conf_path,
+                          envs={"PORT": "8888"}, circus_endpoint="tcp://127.0.0.1:5555")
+        self.assertFalse(apply_circus_conf(self.conf_path, "tcp://127.0.0.1:5555"))
+        self.assertEqual(apply_mock.call_count, 2)
+        # circusd starts from the file written before it.
+        with mock.patch.dict(os.environ, {"CIRCUS_ENDPOINT": "tcp://127.0.0.1:5555"}):
+            write_circus_conf(procfile_path=self.procfile_path, conf_path=self.conf_path,
+                              envs={"PORT": "8888"}, circus_endpoint="")
+        self.assertEqual(apply_mock.call_count, 2)
+        self.assertFalse(os.path.exists(self.conf_path + ".pending"))
+
+    @mock.patch("tsuru_unit_agent.watchers.available_cpus")
+    def test_write_file_process_settings(self, cpus_mock):
+        cpus_mock.return_value = [0, 1]
+        app_data = {"processes": {"web": {"numprocesses": "auto", "cpu_affinity": True,
+                                          "rlimits": {"nofile": 4096, "core": 0}}}}
+        conf_path = self.conf_path + ".new"
+        write_circus_conf(procfile_path=self.procfile_path, conf_path=conf_path,
+                          envs={"PORT": "8888", "TSURU_PROCESS_WORKER_NUMPROCESSES": "3"},
+                          app_data=app_data)
+        self.addCleanup(os.remove, conf_path)
+        got_file = open(conf_path).read()
+        self.assertIn(u"""
+[watcher:web]
+cmd = {} -m tsuru_unit_agent.affinity $(circus.wid) 0,1 -- python run_my_app.py -p 8888 -l 8989
+copy_env = True
+uid = ubuntu
+gid = ubuntu
+working_dir = /home/application/current
+stdout_stream.class = tsuru.stream.Stream
+stdout_stream.watcher_name = web
+stderr_stream.class = tsuru.stream.Stream
+stderr_stream.watcher_name = web
+numprocesses = 2
+rlimit_core = 0
+rlimit_nofile = 4096
+""".format(sys.executable), got_file)
+        self.assertIn(u"""stderr_stream.watcher_name = worker
+numprocesses = 3
+""", got_file)
+
+    def test_write_file_sockets(self):
+        app_data = {"processes": {"web": {"numprocesses": 2,
+                                          "socket": {"port": 8000, "reuseport": True}}}}
+        procfile_path = self.procfile_path + ".sockets"
+        with open(procfile_path, "w") as f:
+            f.write("web: gunicorn --bind fd://$SOCKET_FD app:app -e PORT=$PORT\n")
+        self.addCleanup(os.remove, procfile_path)
+        conf_path = self.conf_path + ".new"
+        write_circus_conf(procfile_path=procfile_path, conf_path=conf_path,
+                          envs={"PORT": "8888"}, app_data=app_data)
+        self.addCleanup(os.remove, conf_path)
+        expected_file = u"""
+[watcher:web]
+cmd = gunicorn --bind fd://$(circus.sockets.web) app:app -e PORT=8000
+copy_env = True
+uid = ubuntu
+gid = ubuntu
+working_dir = /home/application/current
+stdout_stream.class = tsuru.stream.Stream
+stdout_stream.watcher_name = web
+stderr_stream.class = tsuru.stream.Stream
+stderr_stream.watcher_name = web
+numprocesses = 2
+use_sockets = True
+
+[env:web]
+PORT = 8000
+
+[socket:web]
+host = 0.0.0.0
+port = 8000
+so_reuseport = True
+"""
+        got_file = open(conf_path).read()
+        self.assertEqual(expected_file, got_file)
+
+    def test_write_file_declared_envs(self):
+        app_data = {"processes": {"worker": {"envs": ["DATABASE_URL", "MISSING"]}}}
+        envs = {"PORT": "8888", "DATABASE_URL": "mysql://db/app"}
+        conf_path = self.conf_path + ".new"
+        write_circus_conf(procfile_path=self.procfile_path, conf_path=conf_path,
+                          envs=envs, app_data=app_data)
+        self.addCleanup(os.remove, conf_path)
+        got_file = open(conf_path).read()
+        self.assertIn(u"stderr_stream.watcher_name = worker\n\n[env:worker]\n"
+                      u"DATABASE_URL = mysql://db/app\nMISSING = \n", got_file)
+        with mock.patch("tsuru_unit_agent.watchers.apply_watchers_diff") as apply_mock:
+            envs["DATABASE_URL"] = "mysql://otherdb/app"
+            write_circus_conf(procfile_path=self.procfile_path, conf_path=conf_path,
+                              envs=envs, app_data=app_data, circus_endpoint="tcp://127.0.0.1:5555")
+            diff = apply_mock.call_args[0][1]
+            self.assertEqual(diff, ([], [], ["worker"]))
+
+    @mock.patch("tsuru_unit_agent.watchers.apply_watchers_diff")
+    def test_write_file_pins_changed_envs(self, apply_mock):
+        previous = {"PORT": "8888", "SECRET": "old"}
+        write_circus_conf(procfile_path=self.procfile_path, conf_path=self.conf_path, envs=previous, app_data={})
+        write_circus_conf(procfile_path=self.procfile_path, conf_path=self.conf_path, app_data={},
+                          envs={"PORT": "8888", "POORT": "7000", "SECRET": "old"}, previous_envs=previous,
+                          circus_endpoint="tcp://127.0.0.1:5555")
+        diff, current, desired = apply_mock.call_args[0][1:]
+        self.assertEqual(diff, ([], [], ["web"]))
+        self.assertEqual(desired["web"]["env"], {"POORT": "7000"})
+        self.assertNotIn("env", desired["worker"])
+        # nothing uses SECRET explicitly, any watcher may read it.
+        write_circus_conf(procfile_path=self.procfile_path, conf_path=self.conf_path, app_data={},
+                          envs={"PORT": "8888", "SECRET": "new"}, previous_envs=previous,
+                          circus_endpoint="tcp://127.0.0.1:5555")
+        diff, current, desired = apply_mock.call_args[0][1:]
+        self.assertEqual(diff, ([], [], ["web", "worker"]))
+        self.assertEqual(desired["worker"]["env"], {"SECRET": "new"})
+
+    def test_write_file_log_collector(self):
+        envs = {"PORT": "8888", "TSURU_LOG_COLLECTOR": "/var/run/tsuru/log.sock"}
+        conf_path = self.conf_path + ".new"
+        write_circus_conf(procfile_path=self.procfile_path, conf_path=conf_path, envs=envs, app_data={})
+        self.addCleanup(os.remove, conf_path)
+        got_file = open(conf_path).read()
+        self.assertNotIn(u"tsuru.stream.Stream", got_file)
+        self.assertIn(u"stdout_stream.class = tsuru_unit_agent.collector.CollectorStream\n"
+                      u"stdout_stream.watcher_name = worker\n"
+                      u"stderr_stream.class = tsuru_unit_agent.collector.CollectorStream\n"
+                      u"stderr_stream.watcher_name = worker\n"
+                      u"stdout_stream.socket_path = /var/run/tsuru/log.sock\n"
+                      u"stderr_stream.socket_path = /var/run/tsuru/log.sock\n", got_file)
+
+    def test_load_watchers_env_inputs(self):
+        app_data = {"processes": {"worker": {"envs": ["DATABASE_URL"]}}}
+        inputs = load_watchers_env_inputs(procfile_path=self.procfile_path, app_data=app_data)
+        self.assertEqual(inputs, {"web": set(["PORT", "POORT"]), "worker": set(["DATABASE_URL"])})
+
+    def test_read_circus_endpoint(self):
+        self.assertEqual(read_circus_endpoint(self.conf_path), "tcp://127.0.0.1:5555")
+        self.assertIsNone(read_circus_endpoint(self.conf_path + ".missing"))
+        with mock.patch.dict(os.environ, {"CIRCUS_ENDPOINT": "ipc:///tmp/circus"}):
+            self.assertEqual(read_circus_endpoint(self.conf_path), "ipc:///tmp/circus")
+
     def test_write_file_no_watchers(self):
         expected_file = open(self.conf_path).read()
         write_circus_conf(procfile_path=self.procfile_path + ".empty",
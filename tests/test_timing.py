@@ -0,0 +1,85 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from tsuru_unit_agent import timing
+
+
+class TracerTest(unittest.TestCase):
+
+    def tearDown(self):
+        timing.disable()
+
+    @mock.patch("time.time")
+    def test_summary(self, time_mock):
+        time_mock.side_effect = [10.0, 10.0, 10.5, 10.5, 10.5, 10.6, 10.6125]
+        tracer = timing.Tracer()
+        with tracer.span("envs", cat="phase"):
+            pass
+        with tracer.span("save_apprc_file"):
+            pass
+        with tracer.span("load_app_yaml", cat="phase"):
+            pass
+        self.assertEqual(tracer.summary(), "envs=500.0ms load_app_yaml=12.5ms")
+
+    def test_span_recorded_on_error(self):
+        tracer = timing.Tracer()
+        with self.assertRaises(ValueError):
+            with tracer.span("boom"):
+                raise ValueError()
+        self.assertEqual([(s[0], s[5]) for s in tracer.spans], [("boom", {"error": "ValueError"})])
+
+    @mock.patch("time.time")
+    def test_chrome_trace(self, time_mock):
+        time_mock.side_effect = [10.0, 10.25, 10.5]
+        tracer = timing.Tracer()
+        with tracer.span("exec", command="make") as span:
+            span.args["status"] = 0
+        event, = tracer.chrome_trace()["traceEvents"]
+        self.assertEqual(event["name"], "exec")
+        self.assertEqual(event["cat"], "task")
+        self.assertEqual(event["ph"], "X")
+        self.assertEqual(event["ts"], 250000)
+        self.assertEqual(event["dur"], 250000)
+        self.assertEqual(event["pid"], os.getpid())
+        self.assertEqual(event["args"], {"command": "make", "status": 0})
+
+    def test_dump(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "trace.json")
+        tracer = timing.Tracer()
+        with tracer.span("envs", cat="phase"):
+            pass
+        tracer.dump(path)
+        with open(path) as f:
+            self.assertEqual(json.load(f), tracer.chrome_trace())
+
+    def test_span_disabled(self):
+        timing.disable()
+        self.assertIsNone(timing.tracer())
+        self.assertIs(timing.span("envs", cat="phase"), timing.NULL_SPAN)
+        with timing.span("exec") as span:
+            span.args["status"] = 0
+        self.assertEqual(timing.NULL_SPAN.args, {})
+
+    def test_span_enabled(self):
+        tracer = timing.enable()
+        self.assertIs(timing.tracer(), tracer)
+        with timing.span("envs", cat="phase", attempt=1):
+            pass
+        self.assertEqual([(s[0], s[1], s[5]) for s in tracer.spans], [("envs", "phase", {"attempt": 1})])
+
+    def test_traced(self):
+        @timing.traced("work")
+        def work(value):
+            return value * 2
+        self.assertEqual(work(2), 4)
+        tracer = timing.enable()
+        self.assertEqual(work(3), 6)
+        self.assertEqual(work.__name__, "work")
+        self.assertEqual([s[0] for s in tracer.spans], ["work"])
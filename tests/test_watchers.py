@@ -0,0 +1,240 @@
+import sys
+import time
+import unittest
+
+import mock
+
+from tsuru_unit_agent.watchers import (
+    ProcessSettings,
+    SocketSettings,
+    WatchersDiff,
+    affected_watchers,
+    apply_watchers_diff,
+    available_cpus,
+    changed_envs,
+    diff_watchers,
+    parse_circus_endpoint,
+    parse_watchers,
+    pinned_envs,
+    process_settings,
+    referenced_envs,
+    wait_for_circus,
+)
+
+CONF = b"""
+[circus]
+endpoint = tcp://127.0.0.1:5555
+
+[watcher:web]
+cmd = python app.py
+copy_env = True
+numprocesses = 2
+stdout_stream.class = tsuru.stream.Stream
+stdout_stream.watcher_name = web
+
+[env:web]
+PORT = 8888
+
+[watcher:worker]
+cmd = python worker.py
+"""
+
+
+class WatchersTest(unittest.TestCase):
+
+    def test_parse_watchers(self):
+        watchers = parse_watchers(CONF)
+        self.assertEqual(watchers, {
+            "web": {
+                "cmd": "python app.py",
+                "copy_env": "True",
+                "numprocesses": "2",
+                "stdout_stream.class": "tsuru.stream.Stream",
+                "stdout_stream.watcher_name": "web",
+                "env": {"PORT": "8888"},
+            },
+            "worker": {"cmd": "python worker.py"},
+        })
+
+    def test_parse_circus_endpoint(self):
+        self.assertEqual(parse_circus_endpoint(CONF), "tcp://127.0.0.1:5555")
+        self.assertEqual(parse_circus_endpoint(b"[circus]\nendpoint = ipc:///tmp/circus\n"),
+                         "ipc:///tmp/circus")
+        self.assertEqual(parse_circus_endpoint(b""), "tcp://127.0.0.1:5555")
+
+    def test_diff_watchers(self):
+        current = {"web": {"cmd": "a"}, "worker": {"cmd": "b"}, "clock": {"cmd": "c"}}
+        desired = {"web": {"cmd": "a"}, "worker": {"cmd": "b2"}, "mail": {"cmd": "d"}}
+        self.assertEqual(diff_watchers(current, desired),
+                         WatchersDiff(added=["mail"], removed=["clock"], changed=["worker"]))
+
+    def test_diff_watchers_unchanged(self):
+        watchers = parse_watchers(CONF)
+        self.assertEqual(diff_watchers(watchers, parse_watchers(CONF)), WatchersDiff([], [], []))
+
+    def test_referenced_envs(self):
+        self.assertEqual(referenced_envs("gunicorn -b 0.0.0.0:$PORT ${APP}:app -w $$WORKERS"),
+                         set(["PORT", "APP"]))
+        self.assertEqual(referenced_envs("python worker.py"), set())
+
+    def test_changed_envs(self):
+        self.assertEqual(changed_envs({"A": "1", "B": "2", "C": "3"}, {"A": "1", "B": "20", "D": "4"}),
+                         set(["B", "C", "D"]))
+
+    def test_affected_watchers(self):
+        inputs = {"web": set(["PORT", "DATABASE_URL"]), "worker": set(["QUEUE"]), "clock": set()}
+        self.assertEqual(affected_watchers({"PORT": "8888", "QUEUE": "a", "DATABASE_URL": "x"},
+                                           {"PORT": "8888", "QUEUE": "b", "DATABASE_URL": "x"},
+                                           inputs), ["worker"])
+        self.assertEqual(affected_watchers({"OTHER": "1"}, {"OTHER": "2"}, inputs), [])
+
+    def test_pinned_envs(self):
+        inputs = {"web": set(["PORT"]), "worker": set(["QUEUE"])}
+        self.assertEqual(pinned_envs({"PORT": "1", "QUEUE": "a"}, {"PORT": "2", "QUEUE": "a"}, inputs),
+                         {"web": {"PORT": "2"}})
+        self.assertEqual(pinned_envs({"PORT": "1", "SECRET": "x"}, {"PORT": "2"}, inputs),
+                         {"web": {"PORT": "2", "SECRET": ""}, "worker": {"PORT": "2", "SECRET": ""}})
+        self.assertEqual(pinned_envs({"PORT": "1"}, {"PORT": "1"}, inputs), {})
+        self.assertEqual(pinned_envs({}, {"SECRET": "x"}, {}), {})
+
+    def test_apply_watchers_diff(self):
+        current = {"web": {"cmd": "a", "copy_env": "True"},
+                   "worker": {"cmd": "b", "working_dir": "/tmp"},
+                   "clock": {"cmd": "c"}}
+        desired = {"web": {"cmd": "a2", "copy_env": "True", "env": {"PORT": "8888"}},
+                   "worker": {"cmd": "b"},
+                   "mail": {"cmd": "d", "numprocesses": "3",
+                            "stdout_stream.class": "tsuru.stream.Stream"}}
+        diff = diff_watchers(current, desired)
+        client = mock.Mock()
+        client.call.return_value = {"status": "ok"}
+        client_module = mock.Mock()
+        client_module.CircusClient.return_value = client
+        with mock.patch.dict(sys.modules, {"circus": mock.Mock(), "circus.client": client_module}):
+            self.assertTrue(apply_watchers_diff("tcp://127.0.0.1:5555", diff, current, desired))
+        client_module.CircusClient.assert_called_once_with(endpoint="tcp://127.0.0.1:5555", timeout=2)
+        calls = [c[0][0] for c in client.call.call_args_list]
+        self.assertEqual(calls, [
+            {"command": "set", "properties": {"name": "web", "options": {
+                "cmd": "a2", "env": {"PORT": "8888"}}}},
+            {"command": "rm", "properties": {"name": "clock"}},
+            {"command": "rm", "properties": {"name": "worker"}},
+            {"command": "add", "properties": {
+                "name": "mail", "cmd": "d", "start": True,
+                "options": {"numprocesses": 3, "stdout_stream": {"class": "tsuru.stream.Stream"}}}},
+            {"command": "add", "properties": {
+                "name": "worker", "cmd": "b", "start": True, "options": {}}},
+        ])
+        client.stop.assert_called_once_with()
+
+    @mock.patch("logging.exception")
+    def test_apply_watchers_diff_circus_unavailable(self, exception_mock):
+        diff = WatchersDiff(added=["web"], removed=[], changed=[])
+        with mock.patch.dict(sys.modules, {"circus": None, "circus.client": None}):
+            self.assertFalse(apply_watchers_diff("tcp://127.0.0.1:5555", diff, {}, {"web": {"cmd": "a"}}))
+        self.assertEqual(exception_mock.call_count, 1)
+
+    @mock.patch("logging.error")
+    def test_apply_watchers_diff_refused(self, error_mock):
+        diff = WatchersDiff(added=["web"], removed=[], changed=[])
+        client = mock.Mock()
+        client.call.return_value = {"status": "error", "reason": "already exists"}
+        client_module = mock.Mock()
+        client_module.CircusClient.return_value = client
+        with mock.patch.dict(sys.modules, {"circus": mock.Mock(), "circus.client": client_module}):
+            self.assertFalse(apply_watchers_diff("tcp://127.0.0.1:5555", diff, {}, {"web": {"cmd": "a"}}))
+        self.assertEqual(error_mock.call_count, 1)
+
+    @mock.patch("time.sleep")
+    def test_wait_for_circus(self, sleep_mock):
+        client = mock.Mock()
+        client.call.side_effect = [Exception("Timed out."), {"status": "ok"}]
+        client_module = mock.Mock()
+        client_module.CircusClient.return_value = client
+        with mock.patch.dict(sys.modules, {"circus": mock.Mock(), "circus.client": client_module}):
+            self.assertTrue(wait_for_circus("tcp://127.0.0.1:5555", time.time() + 60))
+            self.assertEqual(client.call.call_count, 2)
+            client.call.assert_called_with({"command": "list", "properties": {}})
+            self.assertEqual(client.stop.call_count, 2)
+            self.assertFalse(wait_for_circus("tcp://127.0.0.1:5555", time.time() - 1))
+            self.assertEqual(client.call.call_count, 2)
+
+    def test_apply_watchers_diff_nothing_changed(self):
+        with mock.patch.dict(sys.modules, {"circus": None, "circus.client": None}):
+            self.assertTrue(apply_watchers_diff("tcp://127.0.0.1:5555", WatchersDiff([], [], []), {}, {}))
+
+
+class ProcessSettingsTest(unittest.TestCase):
+
+    def test_process_settings_default(self):
+        self.assertEqual(process_settings("web"), ProcessSettings(None, False, {}, None, ()))
+        self.assertEqual(process_settings("web", {"processes": None}, {}),
+                         ProcessSettings(None, False, {}, None, ()))
+
+    def test_process_settings_from_yaml(self):
+        app_data = {"processes": {"web": {"numprocesses": 4, "cpu_affinity": True,
+                                          "rlimits": {"nofile": 4096}}}}
+        self.assertEqual(process_settings("web", app_data),
+                         ProcessSettings(4, True, {"nofile": 4096}, None, ()))
+        self.assertEqual(process_settings("worker", app_data),
+                         ProcessSettings(None, False, {}, None, ()))
+
+    def test_process_settings_envs_override_yaml(self):
+        app_data = {"processes": {"my-web": {"numprocesses": 4, "rlimits": {"nofile": 4096}}}}
+        envs = {"TSURU_PROCESS_MY_WEB_NUMPROCESSES": "2",
+                "TSURU_PROCESS_MY_WEB_CPU_AFFINITY": "true",
+                "TSURU_PROCESS_MY_WEB_RLIMIT_NOFILE": "1024",
+                "TSURU_PROCESS_MY_WEB_RLIMIT_NPROC": "64",
+                "TSURU_PROCESS_MY_WEB_ENVS": "DATABASE_URL, REDIS_URL",
+                "TSURU_PROCESS_WORKER_NUMPROCESSES": "8"}
+        self.assertEqual(process_settings("my-web", app_data, envs),
+                         ProcessSettings(2, True, {"nofile": 1024, "nproc": 64}, None,
+                                         ("DATABASE_URL", "REDIS_URL")))
+
+    def test_process_settings_envs(self):
+        app_data = {"processes": {"web": {"envs": ["REDIS_URL", "DATABASE_URL"]}}}
+        self.assertEqual(process_settings("web", app_data).envs, ("DATABASE_URL", "REDIS_URL"))
+
+    @mock.patch("tsuru_unit_agent.watchers.available_cpus")
+    def test_process_settings_auto(self, cpus_mock):
+        cpus_mock.return_value = [0, 1, 2]
+        app_data = {"processes": {"web": {"numprocesses": "auto"}}}
+        self.assertEqual(process_settings("web", app_data).numprocesses, 3)
+        envs = {"TSURU_PROCESS_WORKER_NUMPROCESSES": "auto"}
+        self.assertEqual(process_settings("worker", None, envs).numprocesses, 3)
+
+    def test_process_settings_invalid(self):
+        self.assertRaises(ValueError, process_settings, "web",
+                          {"processes": {"web": {"numprocesses": 0}}})
+        self.assertRaises(ValueError, process_settings, "web", None,
+                          {"TSURU_PROCESS_WEB_NUMPROCESSES": "many"})
+        self.assertRaises(ValueError, process_settings, "web", None,
+                          {"TSURU_PROCESS_WEB_RLIMIT_NOFILE": "lots"})
+
+    def test_process_settings_socket(self):
+        app_data = {"processes": {"web": {"socket": True},
+                                  "api": {"socket": {"port": 9000, "reuseport": True}}}}
+        envs = {"PORT": "8888"}
+        self.assertEqual(process_settings("web", app_data, envs).socket,
+                         SocketSettings("0.0.0.0", 8888, False))
+        self.assertEqual(process_settings("api", app_data, envs).socket,
+                         SocketSettings("0.0.0.0", 9000, True))
+        envs = {"TSURU_PROCESS_WORKER_SOCKET_PORT": "7000",
+                "TSURU_PROCESS_WORKER_SOCKET_HOST": "127.0.0.1",
+                "TSURU_PROCESS_WORKER_SOCKET_REUSEPORT": "yes"}
+        self.assertEqual(process_settings("worker", app_data, envs).socket,
+                         SocketSettings("127.0.0.1", 7000, True))
+        self.assertRaises(ValueError, process_settings, "web", None,
+                          {"TSURU_PROCESS_WEB_SOCKET_PORT": "http"})
+
+    def test_available_cpus(self):
+        cpus = available_cpus()
+        self.assertTrue(len(cpus) > 0)
+        self.assertEqual(cpus, sorted(cpus))
+
+    @mock.patch("tsuru_unit_agent.watchers.os", spec=[])
+    def test_available_cpus_from_proc(self, os_mock):
+        status = "Name:\tpython\nCpus_allowed_list:\t0-2,5\n"
+        with mock.patch("__builtin__.open", mock.mock_open(read_data=status)) as open_mock:
+            open_mock.return_value.__iter__ = lambda self: iter(status.splitlines(True))
+            self.assertEqual(available_cpus(), [0, 1, 2, 5])
@@ -0,0 +1,36 @@
+# Copyright 2015 tsuru-unit-agent authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Pins a circus worker to one CPU and execs its command.
+
+    python -m tsuru_unit_agent.affinity $(circus.wid) 0,1,2,3 -- cmd args...
+
+Worker N runs on the Nth CPU of the list, wrapping around.
+"""
+
+import os
+import sys
+
+
+def cpu_for_worker(wid, cpus):
+    return cpus[(int(wid) - 1) % len(cpus)]
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) < 4 or argv[2] != "--":
+        sys.stderr.write("usage: affinity WID CPU[,CPU...] -- CMD [ARGS...]\n")
+        sys.exit(2)
+    wid, cpus, cmd = argv[0], argv[1], argv[3:]
+    cpu = cpu_for_worker(wid, [int(c) for c in cpus.split(",")])
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, [cpu])
+    else:
+        cmd = ["taskset", "-c", str(cpu)] + cmd
+    os.execvp(cmd[0], cmd)
+
+
+if __name__ == "__main__":
+    main()
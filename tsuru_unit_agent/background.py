@@ -0,0 +1,35 @@
+# Copyright 2015 tsuru-unit-agent authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import sys
+import threading
+
+
+class BackgroundCall(threading.Thread):
+    """Runs ``target(*args, **kwargs)`` in a daemon thread.
+
+    :meth:`result` waits for it and returns its value, or re-raises what it
+    raised in the calling thread.
+    """
+
+    def __init__(self, target, *args, **kwargs):
+        super(BackgroundCall, self).__init__()
+        self.daemon = True
+        self._call = (target, args, kwargs)
+        self._value = None
+        self._exc_info = None
+        self.start()
+
+    def run(self):
+        target, args, kwargs = self._call
+        try:
+            self._value = target(*args, **kwargs)
+        except BaseException:
+            self._exc_info = sys.exc_info()
+
+    def result(self):
+        self.join()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
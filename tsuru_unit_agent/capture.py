@@ -0,0 +1,357 @@
+# Copyright 2015 tsuru-unit-agent authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Capture and replay of the output fed to log streams.
+
+With LOG_CAPTURE_PATH set, every chunk a :class:`Stream` receives is
+appended to that file, up to LOG_CAPTURE_MAX_BYTES (256MB by default).
+The file starts with :data:`MAGIC`, then each record is a :data:`RECORD`
+header (time, watcher, stream name and data lengths) followed by the
+watcher, the stream name and the raw data.
+
+A capture is fed back through streams shipping to local stand-in HTTP and
+syslog servers with:
+
+    python -m tsuru_unit_agent.capture replay [--speed N] [--syslog] [--collector] CAPTURE
+
+``--speed 0`` replays as fast as possible, the original timing is kept by
+default. A JSON report with throughput, delivery latency and drops is
+written to stdout.
+"""
+
+import argparse
+import BaseHTTPServer
+import collections
+import json
+import Queue
+import SocketServer
+import struct
+import sys
+import threading
+import time
+import urlparse
+
+MAGIC = b"TSCAP1\n"
+
+RECORD = struct.Struct("!dHHI")
+
+DEFAULT_MAX_BYTES = 256 << 20
+
+Record = collections.namedtuple("Record", "time watcher name data")
+
+
+def _bytes(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+class Capture(object):
+    """Appends records to ``path``, dropping them once ``max_bytes`` are written."""
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.written = self.file.tell()
+        self.dropped = 0
+
+    def write(self, watcher, name, data, now=None):
+        watcher, name, data = _bytes(watcher or ""), _bytes(name or ""), _bytes(data)
+        record = RECORD.pack(now or time.time(), len(watcher), len(name), len(data)) + watcher + name + data
+        with self.lock:
+            if self.written + len(record) > self.max_bytes:
+                self.dropped += 1
+                return
+            self.file.write(record)
+            # circus may be killed at any time, records must not sit in a buffer.
+            self.file.flush()
+            self.written += len(record)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+_captures = {}
+_captures_lock = threading.Lock()
+
+
+def open_capture(path, max_bytes=DEFAULT_MAX_BYTES):
+    """Returns the capture for ``path``, shared by the streams of the process."""
+    with _captures_lock:
+        if path not in _captures:
+            _captures[path] = Capture(path, max_bytes)
+        return _captures[path]
+
+
+def read_capture(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("not a capture file")
+    while True:
+        header = f.read(RECORD.size)
+        if len(header) < RECORD.size:
+            return
+        now, watcher_size, name_size, data_size = RECORD.unpack(header)
+        body = f.read(watcher_size + name_size + data_size)
+        if len(body) < watcher_size + name_size + data_size:
+            return
+        yield Record(now, body[:watcher_size], body[watcher_size:watcher_size + name_size],
+                     body[watcher_size + name_size:])
+
+
+class StandInLogServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Accepts log posts, batched or streamed, recording when each line arrives."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StandInLogHandler)
+        self.url = "http://127.0.0.1:{}".format(self.server_address[1])
+        self.lock = threading.Lock()
+        self.received = []
+        self.requests = 0
+
+    def record(self, source, messages):
+        now = time.time()
+        with self.lock:
+            self.requests += 1
+            self.received.extend((now, source, m) for m in messages)
+
+
+class StandInLogHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunk = self.rfile.read(size + 2)
+                if not size:
+                    break
+                body.append(chunk[:-2])
+            messages = _decode_lines("".join(body).splitlines())
+        else:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                messages = json.loads(body)
+            except ValueError:
+                # rate limit notices are posted as plain text.
+                messages = []
+        self.server.record(_source(self.path), messages)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _decode_lines(lines):
+    messages = []
+    for line in lines:
+        try:
+            messages.append(json.loads(line))
+        except ValueError:
+            pass
+    return messages
+
+
+class StandInSyslogServer(SocketServer.ThreadingMixIn, SocketServer.UDPServer):
+    """Counts the syslog datagrams it receives."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        SocketServer.UDPServer.__init__(self, ("127.0.0.1", 0), StandInSyslogHandler)
+        self.lock = threading.Lock()
+        self.datagrams = 0
+
+    def record(self):
+        with self.lock:
+            self.datagrams += 1
+
+
+class StandInSyslogHandler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        self.server.record()
+
+
+def _serve(server):
+    thread = threading.Thread(target=server.serve_forever, name=server.__class__.__name__)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _source(url):
+    return urlparse.parse_qs(urlparse.urlparse(url).query).get("source", [""])[0]
+
+
+class Replay(object):
+    """Feeds records through streams and measures what reaches the stand-ins.
+
+    Latency is the time between a line entering a writer queue and the
+    stand-in receiving it, lines are matched by source and content. Lines
+    refused by a full queue or never received count as dropped.
+    """
+
+    def __init__(self, envs=None, syslog=False, collector=False):
+        self.envs = dict(envs or {})
+        self.syslog = syslog
+        self.collector = collector
+        self.lock = threading.Lock()
+        self.enqueued = collections.defaultdict(collections.deque)
+        self.lines_enqueued = 0
+        self.lines_refused = 0
+        self.writers = []
+
+    def run(self, records, speed=1.0, timeout=60):
+        http = StandInLogServer()
+        syslog = StandInSyslogServer() if self.syslog else None
+        servers = [s for s in (http, syslog) if s is not None]
+        for server in servers:
+            _serve(server)
+        try:
+            # the caller's envs tune the pipeline, logs never leave the host.
+            envs = dict(self.envs)
+            envs.update({"TSURU_APPNAME": "replay", "TSURU_HOST": http.url, "TSURU_APP_TOKEN": "replay",
+                         "TSURU_SYSLOG_SERVER": "", "LOG_CAPTURE_PATH": ""})
+            if syslog is not None:
+                envs.update({"TSURU_SYSLOG_SERVER": "127.0.0.1",
+                             "TSURU_SYSLOG_PORT": str(syslog.server_address[1]),
+                             "TSURU_SYSLOG_FACILITY": "LOCAL0", "TSURU_SYSLOG_SOCKET": "udp"})
+            start = time.time()
+            fed = self.feed(records, envs, speed)
+            fed_end = time.time()
+            self.drain(timeout)
+            end = time.time()
+            return self.report(fed, start, fed_end, end, http, syslog)
+        finally:
+            for server in servers:
+                server.shutdown()
+                server.server_close()
+
+    def feed(self, records, envs, speed):
+        from tsuru_unit_agent.stream import Stream
+        fed = {"records": 0, "bytes": 0}
+        streams = {}
+        if self.collector:
+            from tsuru_unit_agent.collector import Collector
+            collector = Collector(envs)
+            collector.start_writer()
+            self._time_queue(collector.queue)
+            self.writers.append(collector.writer)
+        first = started = None
+        for record in records:
+            if first is None:
+                first, started = record.time, time.time()
+            elif speed:
+                delay = (record.time - first) / speed - (time.time() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            data = {"data": record.data, "name": record.name}
+            if self.collector:
+                data["watcher"] = record.watcher
+                collector.handle(data)
+            else:
+                key = (record.watcher, record.name)
+                if key not in streams:
+                    streams[key] = Stream(watcher_name=record.watcher, default_stream_name=record.name, envs=envs)
+                    self._time_queue(streams[key].queue)
+                    self.writers.append(streams[key].writer)
+                try:
+                    streams[key](data)
+                except Queue.Full:
+                    pass
+            fed["records"] += 1
+            fed["bytes"] += len(record.data)
+        for stream in (collector.streams.values() if self.collector else streams.values()):
+            stream.close()
+        return fed
+
+    def _time_queue(self, queue):
+        put = queue.put_nowait
+
+        def timed_put(item):
+            messages = getattr(item, "messages", None)
+            if messages is None:
+                return put(item)
+            try:
+                put(item)
+            except Queue.Full:
+                with self.lock:
+                    self.lines_refused += len(messages)
+                raise
+            now = time.time()
+            source = _source(item.url)
+            with self.lock:
+                self.lines_enqueued += len(messages)
+                for m in messages:
+                    self.enqueued[(source, m)].append(now)
+        queue.put_nowait = timed_put
+
+    def drain(self, timeout):
+        deadline = time.time() + timeout
+        for writer in self.writers:
+            writer.join(max(deadline - time.time(), 0))
+
+    def report(self, fed, start, fed_end, end, http, syslog):
+        latencies = []
+        with http.lock:
+            received = list(http.received)
+        with self.lock:
+            for now, source, message in received:
+                sent = self.enqueued.get((source, message))
+                if sent:
+                    latencies.append(now - sent.popleft())
+            enqueued, refused = self.lines_enqueued, self.lines_refused
+        latencies.sort()
+        elapsed = end - start
+        report = {
+            "records": fed["records"],
+            "bytes": fed["bytes"],
+            "feed_seconds": round(fed_end - start, 6),
+            "elapsed_seconds": round(elapsed, 6),
+            "lines_enqueued": enqueued,
+            "lines_received": len(received),
+            "lines_refused": refused,
+            "lines_dropped": refused + max(enqueued - len(received), 0),
+            "requests": http.requests,
+            "lines_per_second": round(len(received) / elapsed, 1) if elapsed else None,
+            "bytes_per_second": round(fed["bytes"] / elapsed, 1) if elapsed else None,
+            "writers_alive": sum(1 for w in self.writers if w.is_alive()),
+        }
+        for name, q in (("p50", 0.5), ("p99", 0.99), ("max", 1.0)):
+            value = latencies[min(int(len(latencies) * q), len(latencies) - 1)] if latencies else None
+            report["latency_{}_ms".format(name)] = round(value * 1000, 3) if value is not None else None
+        if syslog is not None:
+            report["syslog_datagrams"] = syslog.datagrams
+        return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="capture")
+    subparsers = parser.add_subparsers()
+    replay = subparsers.add_parser("replay", help="replays a capture against local stand-in servers")
+    replay.add_argument("path")
+    replay.add_argument("--speed", type=float, default=1.0,
+                        help="timing multiplier, 0 replays as fast as possible")
+    replay.add_argument("--syslog", action="store_true", help="forward to a stand-in syslog server too")
+    replay.add_argument("--collector", action="store_true", help="share one writer, as the log collector does")
+    replay.add_argument("--timeout", type=float, default=60, help="seconds to wait for the writers to drain")
+    args = parser.parse_args(argv)
+    with open(args.path, "rb") as f:
+        report = Replay(syslog=args.syslog, collector=args.collector).run(
+            read_capture(f), speed=args.speed, timeout=args.timeout)
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
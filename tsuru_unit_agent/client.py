@@ -1,33 +1,94 @@
 from socket import gethostname
 import json
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+from tsuru_unit_agent import timing
+
+RETRY_STATUSES = (502, 503, 504)
+
+
+class DeadlineExceeded(Timeout):
+    pass
 
 
 class Client(object):
-    def __init__(self, url, token):
+    def __init__(self, url, token, timeout=(3.05, 30), retries=3, backoff=0.5, deadline=60,
+                 pool_size=4):
         self.url = url
         self.token = token
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.deadline = deadline
+        self.etag = None
+        self.customdata_etag = None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _request(self, method, url, deadline, retry=False, **kwargs):
+        # Only idempotent calls should be retried. Every attempt, and the
+        # backoff between them, must fit before the deadline.
+        attempt = 0
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise DeadlineExceeded("deadline exceeded before requesting {}".format(url))
+            timeout = tuple(min(t, remaining) for t in self.timeout)
+            try:
+                with timing.span("http", method=method.upper(), url=url, attempt=attempt) as span:
+                    response = getattr(self.session, method)(url, timeout=timeout, **kwargs)
+                    span.args["status"] = response.status_code
+            except (ConnectionError, Timeout):
+                if not retry or attempt >= self.retries:
+                    raise
+            else:
+                if not retry or attempt >= self.retries or response.status_code not in RETRY_STATUSES:
+                    return response
+            time.sleep(max(min(self.backoff * 2 ** attempt, deadline - time.time()), 0))
+            attempt += 1
 
-    def register_unit(self, app, custom_data=None):
+    def register_unit(self, app, custom_data=None, etag=None):
+        """Registers the unit and returns the app envs.
+
+        When ``etag`` is given and the API answers 304 Not Modified, None is
+        returned and the envs the caller already has are still valid. The
+        ETag of the last full response is kept in ``self.etag``.
+        """
+        deadline = time.time() + self.deadline
         params = {
             'headers': {"Authorization": "bearer {}".format(self.token)},
         }
+        if etag:
+            params['headers']['If-None-Match'] = etag
         request_data = {
             "hostname": gethostname(),
         }
         if custom_data is not None:
             request_data["customdata"] = json.dumps(custom_data)
-        response = requests.post(
+        response = self._request(
+            "post",
             "{}/apps/{}/units/register".format(self.url, app),
+            deadline,
             data=request_data,
             **params)
         if 400 <= response.status_code < 500:
-            response = requests.get(
+            response = self._request(
+                "get",
                 "{}/apps/{}/env".format(self.url, app),
+                deadline,
+                retry=True,
                 **params)
+        if etag and response.status_code == 304:
+            return None
         if not 200 <= response.status_code < 400:
             raise Exception("invalid response {} - {}".format(response.status_code, response.text))
+        self.etag = response.headers.get("ETag")
         tsuru_envs = response.json()
         envs = {env['name']: env['value'] for env in tsuru_envs}
         # TODO(fss): tsuru should handle this, see
@@ -35,12 +96,47 @@ class Client(object):
         envs["port"] = envs["PORT"] = "8888"
         return envs
 
+    def customdata_version(self, app):
+        """Returns the ETag of the customdata the API has for ``app``.
+
+        None when the API doesn't tell, e.g. it has no customdata for the
+        app or no customdata endpoint at all.
+        """
+        try:
+            response = self._request(
+                "head",
+                "{}/apps/{}/customdata".format(self.url, app),
+                time.time() + self.deadline,
+                retry=True,
+                headers={"Authorization": "bearer {}".format(self.token)},
+            )
+        except (ConnectionError, Timeout):
+            return None
+        if not 200 <= response.status_code < 300:
+            return None
+        return response.headers.get("ETag")
+
     def post_app_yaml(self, app, data):
-        requests.post(
+        """Uploads the customdata of ``app``.
+
+        The ETag of the stored customdata, when the API returns one, is kept
+        in ``self.customdata_etag``.
+        """
+        self.customdata_etag = None
+        response = self._request(
+            "post",
             "{}/apps/{}/customdata".format(self.url, app),
+            time.time() + self.deadline,
             data=json.dumps(data),
             headers={
                 "Authorization": "bearer {}".format(self.token),
                 "Content-Type": "application/json",
             },
         )
+        if response.status_code in (404, 405):
+            # API servers without the customdata endpoint take it on register.
+            self.register_unit(app, data)
+        elif not 200 <= response.status_code < 400:
+            raise Exception("invalid response {} - {}".format(response.status_code, response.text))
+        else:
+            self.customdata_etag = response.headers.get("ETag")
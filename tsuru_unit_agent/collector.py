@@ -0,0 +1,187 @@
+# Copyright 2015 tsuru-unit-agent authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Unit-local log collector.
+
+Circus watchers configured with :class:`CollectorStream` send their output
+over a unix socket to a single collector process, which frames lines and
+ships them through one batching, rate-limited writer for the whole unit.
+
+Each frame is a 4-byte big-endian length followed by a JSON object with
+``watcher``, ``name`` (stdout or stderr) and ``data`` keys.
+"""
+
+import json
+import logging
+import os
+import Queue
+import socket
+import SocketServer
+import struct
+import threading
+
+DEFAULT_SOCKET_PATH = "/var/run/tsuru/log-collector.sock"
+
+HEADER = struct.Struct("!I")
+
+MAX_FRAME_SIZE = 1 << 20
+
+
+def default_socket_path(envs=None):
+    return (envs or os.environ).get("TSURU_LOG_COLLECTOR") or DEFAULT_SOCKET_PATH
+
+
+def encode_frame(watcher, name, data):
+    if isinstance(data, bytes):
+        data = data.decode("utf-8", "replace")
+    body = json.dumps({"watcher": watcher, "name": name, "data": data})
+    return HEADER.pack(len(body)) + body
+
+
+def read_frames(f):
+    while True:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return
+        size, = HEADER.unpack(header)
+        if size > MAX_FRAME_SIZE:
+            raise ValueError("frame too large: {} bytes".format(size))
+        body = f.read(size)
+        if len(body) < size:
+            return
+        yield json.loads(body)
+
+
+class CollectorStream(object):
+    """Circus stream class forwarding watcher output to the collector.
+
+    Output is dropped while the collector is unreachable, circus is never
+    blocked for longer than ``timeout`` seconds.
+    """
+
+    def __init__(self, watcher_name="", socket_path=None, timeout=1, **kwargs):
+        self.watcher_name = watcher_name
+        self.socket_path = socket_path or default_socket_path()
+        self.timeout = float(timeout)
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def __call__(self, data):
+        frame = encode_frame(self.watcher_name, data.get("name", "stdout"), data["data"])
+        with self.lock:
+            # A second attempt reconnects after the collector restarted.
+            for _ in range(2):
+                try:
+                    if self.sock is None:
+                        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                        self.sock.settimeout(self.timeout)
+                        self.sock.connect(self.socket_path)
+                    self.sock.sendall(frame)
+                    return
+                except socket.error:
+                    self._disconnect()
+
+    def close(self):
+        with self.lock:
+            self._disconnect()
+
+    def _disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+
+class Collector(object):
+    """Receives frames and ships them with a single writer.
+
+    Lines are framed per watcher and stream by a :class:`Stream` sharing
+    the writer queue, so syslog forwarding works as in circus.
+    """
+
+    def __init__(self, envs=None):
+        self.envs = {}
+        self.envs.update(os.environ)
+        self.envs.update(envs or {})
+        self.streams = {}
+        self.lock = threading.Lock()
+        self.queue = None
+        self.writer = None
+
+    def start_writer(self):
+        import requests
+        from tsuru_unit_agent.stream import (DEFAULT_QUEUE_BYTES, FairQueue, TsuruLogWriter, parse_weights,
+                                             streaming_transport)
+        session = requests.Session()
+        token = self.envs.get("TSURU_APP_TOKEN")
+        if token:
+            session.headers.update({"Authorization": "bearer " + token})
+        # Watchers share the writer, a noisy one must not starve the others.
+        self.queue = FairQueue(maxsize=int(self.envs.get("LOG_MAX_QUEUE_SIZE", 0)),
+                               max_bytes=int(self.envs.get("LOG_MAX_QUEUE_BYTES", DEFAULT_QUEUE_BYTES)),
+                               weights=parse_weights(self.envs.get("LOG_SOURCE_WEIGHTS")))
+        self.writer = TsuruLogWriter(session, self.queue,
+                                     self.envs.get("LOG_RATE_LIMIT_WINDOW"),
+                                     self.envs.get("LOG_RATE_LIMIT_COUNT"),
+                                     batch_size=int(self.envs.get("LOG_BATCH_SIZE", 100)),
+                                     transport=streaming_transport(session, self.envs))
+        self.writer.daemon = True
+        self.writer.start()
+
+    def stream(self, watcher, name):
+        from tsuru_unit_agent.stream import Stream
+        key = (watcher, name)
+        if key not in self.streams:
+            self.streams[key] = Stream(watcher_name=watcher, default_stream_name=name,
+                                       envs=self.envs, queue=self.queue)
+        return self.streams[key]
+
+    def handle(self, frame):
+        name = frame.get("name", "stdout")
+        with self.lock:
+            stream = self.stream(frame.get("watcher", ""), name)
+            try:
+                stream({"data": frame["data"], "name": name})
+            except Queue.Full:
+                pass
+
+    def serve(self, path):
+        if self.writer is None:
+            self.start_writer()
+        server = CollectorServer(path, self)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+
+class CollectorServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, collector):
+        self.collector = collector
+        if os.path.exists(path):
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, CollectorHandler)
+        # watchers usually run as another user.
+        os.chmod(path, 0o666)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+
+class CollectorHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            for frame in read_frames(self.rfile):
+                self.server.collector.handle(frame)
+        except ValueError:
+            logging.exception("Invalid frame from log collector client")
@@ -0,0 +1,132 @@
+# Copyright 2015 tsuru-unit-agent authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Signal-triggered introspection.
+
+SIGUSR1 writes every thread's stack and the state of the log streams and
+writers to stderr. SIGUSR2 starts a sampling profiler, the next SIGUSR2
+stops it and writes the samples as collapsed stacks (one
+``frame;frame;... count`` line per stack, as flamegraph.pl reads them) to
+TSURU_UNIT_AGENT_PROFILE_DIR, the temp dir by default.
+"""
+
+import collections
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+
+def thread_stacks():
+    names = {t.ident: t.name for t in threading.enumerate()}
+    lines = []
+    for ident, frame in sorted(sys._current_frames().items()):
+        lines.append("Thread {} ({}):\n".format(names.get(ident, "?"), ident))
+        lines.extend(traceback.format_stack(frame))
+    return "".join(lines)
+
+
+def log_state():
+    # stream is only loaded when something uses it.
+    stream = sys.modules.get("tsuru_unit_agent.stream")
+    if stream is None:
+        return ""
+    lines = []
+    for s in list(stream.STREAMS):
+        lines.append("Stream {}\n".format(_format_stats(s.stats())))
+    for w in list(stream.WRITERS):
+        lines.append("TsuruLogWriter {}\n".format(_format_stats(w.stats())))
+    return "".join(lines)
+
+
+def _format_stats(stats):
+    return " ".join("{}={}".format(key, value) for key, value in sorted(stats.items()))
+
+
+def dump(out=None):
+    out = out or sys.stderr
+    out.write("tsuru_unit_agent: state of pid {}\n".format(os.getpid()))
+    out.write(thread_stacks())
+    out.write(log_state())
+    out.flush()
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return "{}:{}:{}".format(os.path.basename(code.co_filename), code.co_name, frame.f_lineno)
+
+
+class Sampler(threading.Thread):
+    """Samples the stack of every other thread each ``interval`` seconds."""
+
+    def __init__(self, interval=0.01):
+        super(Sampler, self).__init__(name="sampler")
+        self.daemon = True
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.stopped = threading.Event()
+
+    def sample(self):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.samples[";".join(reversed(stack))] += 1
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write("{} {}\n".format(stack, count))
+
+
+_sampler = None
+
+
+def toggle_profiler(profile_dir=None):
+    """Starts the sampler, or stops it and returns the file it wrote."""
+    global _sampler
+    if _sampler is None:
+        _sampler = Sampler()
+        _sampler.start()
+        return None
+    sampler, _sampler = _sampler, None
+    sampler.stop()
+    profile_dir = profile_dir or os.environ.get("TSURU_UNIT_AGENT_PROFILE_DIR") or tempfile.gettempdir()
+    path = os.path.join(profile_dir, "tsuru_unit_agent-{}-{}.folded".format(os.getpid(), int(time.time())))
+    sampler.write(path)
+    return path
+
+
+def _on_sigusr1(signum, frame):
+    dump()
+
+
+def _on_sigusr2(signum, frame):
+    path = toggle_profiler()
+    if path is None:
+        sys.stderr.write("tsuru_unit_agent: profiler started\n")
+    else:
+        sys.stderr.write("tsuru_unit_agent: profile written to {}\n".format(path))
+
+
+def install():
+    """Installs the SIGUSR1 and SIGUSR2 handlers, from the main thread."""
+    signal.signal(signal.SIGUSR1, _on_sigusr1)
+    signal.signal(signal.SIGUSR2, _on_sigusr2)
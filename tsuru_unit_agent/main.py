@@ -1,43 +1,201 @@
+import logging
+import os
 import sys
+import time
 import argparse
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, Timeout
 
-from tsuru_unit_agent import heartbeat, tasks
+from tsuru_unit_agent import background, heartbeat, introspect, readiness, tasks, timing, watchers
 from tsuru_unit_agent.client import Client
 
 
-def run_action(args):
-    client = Client(args.url, args.token)
-    envs = None
+def fetch_envs(client, app_name):
     try:
-        envs = client.register_unit(args.app_name)
+        envs = client.register_unit(app_name, etag=tasks.load_envs_etag())
+        if envs is None:
+            return tasks.parse_apprc_file()
         tasks.save_apprc_file(envs)
-    except ConnectionError:
-        envs = tasks.parse_apprc_file()
-    yaml_data = tasks.load_app_yaml()
-    tasks.write_circus_conf(envs=envs)
-    tasks.run_restart_hooks('before', yaml_data, envs=envs)
-    tasks.execute_start_script(args.start_cmd, envs=envs, with_shell=False)
+        tasks.save_envs_etag(client.etag)
+        return envs
+    except (ConnectionError, Timeout):
+        return tasks.parse_apprc_file()
+
+
+# Seconds a refresh waits for circusd to take the new envs.
+REFRESH_CIRCUS_DEADLINE = 60
+
+
+def refresh_envs(client, app_name, envs):
+    try:
+        new_envs = client.register_unit(app_name, etag=tasks.load_envs_etag())
+        if new_envs is None:
+            return
+        tasks.save_apprc_file(new_envs)
+        tasks.save_envs_etag(client.etag)
+        if new_envs != envs:
+            refresh_circus(new_envs, envs, time.time() + REFRESH_CIRCUS_DEADLINE)
+    except Exception:
+        logging.exception("Unable to refresh envs for {}".format(app_name))
+
+
+def refresh_circus(envs, previous_envs, deadline, interval=0.5):
+    # circusd is started along with the refresh. circus.ini is only
+    # rewritten once it answers, and an apply that fails is tried again
+    # until the deadline, so the new envs can't miss the running watchers.
+    endpoint = tasks.read_circus_endpoint()
+    if endpoint:
+        watchers.wait_for_circus(endpoint, deadline)
+    tasks.write_circus_conf(envs=envs, previous_envs=previous_envs, circus_endpoint=endpoint)
+    while endpoint and not tasks.apply_circus_conf(circus_endpoint=endpoint):
+        if time.time() >= deadline:
+            logging.error("circus at {} didn't take the refreshed envs".format(endpoint))
+            return
+        time.sleep(interval)
+
+
+def load_cached_envs(client, app_name):
+    # Fast start: use the apprc we already have, run_action refreshes it
+    # while the unit starts and circus only restarts the watchers whose
+    # config changed.
+    try:
+        return tasks.parse_apprc_file()
+    except (IOError, ValueError):
+        return fetch_envs(client, app_name)
+
+
+def report_trace(args):
+    tracer = timing.tracer()
+    if tracer is None:
+        return
+    sys.stderr.write("tsuru_unit_agent: {}\n".format(tracer.summary()))
+    if args.trace:
+        tracer.dump(args.trace)
+
+
+def after_start(client, args, yaml_data, envs):
+    refresh = None
+    if args.fast_start:
+        # it may wait for circusd, the after hooks don't.
+        refresh = background.BackgroundCall(refresh_envs, client, args.app_name, envs)
+    readiness.wait_until_ready(yaml_data, envs)
     tasks.run_restart_hooks('after', yaml_data, envs=envs)
+    if refresh is not None:
+        refresh.join()
+
+
+def run_action(args):
+    client = Client(args.url, args.token)
+
+    def timed_fetch_envs():
+        with timing.span("envs", cat="phase"):
+            if args.fast_start:
+                return load_cached_envs(client, args.app_name)
+            return fetch_envs(client, args.app_name)
+    # tsuru.yaml and the Procfile don't depend on the API response, parse
+    # them while we wait. The process settings can be overridden by envs,
+    # they're left for write_circus_conf with the $VAR substitution.
+    envs_call = background.BackgroundCall(timed_fetch_envs)
+    with timing.span("load_app_yaml", cat="phase"):
+        yaml_data = tasks.load_app_yaml()
+    with timing.span("load_procfile", cat="phase"):
+        procfile = tasks.load_procfile_commands()
+    envs = envs_call.result()
+    probe = readiness.validate_probe(yaml_data, envs)
+    with timing.span("write_circus_conf", cat="phase"):
+        # circusd isn't running yet, it is the start command.
+        tasks.write_circus_conf(envs=envs, procfile=procfile, circus_endpoint="")
+    with timing.span("before_hooks", cat="phase"):
+        tasks.run_restart_hooks('before', yaml_data, envs=envs)
+    # The start command usually runs for the whole unit lifetime, report
+    # the setup before it.
+    report_trace(args)
+    readiness.clear_ready(envs)
+    if args.exec_start:
+        if (args.fast_start or tasks.restart_hooks('after', yaml_data) or
+                probe or readiness.ready_file(envs)):
+            # the helper waits until the start command replaced the agent.
+            tasks.spawn_after_exec(after_start, client, args, yaml_data, envs)
+        return tasks.replace_with_start_script(args.start_cmd, envs=envs)
+    refresh = None
+    if args.fast_start:
+        # only once circus.ini is written, the two writes must not race.
+        refresh = background.BackgroundCall(refresh_envs, client, args.app_name, envs)
+    with timing.span("start", cat="phase"):
+        tasks.execute_start_script(args.start_cmd, envs=envs, with_shell=False)
+    # after hooks usually expect the app to be serving already.
+    readiness.wait_until_ready(yaml_data, envs)
+    with timing.span("after_hooks", cat="phase"):
+        tasks.run_restart_hooks('after', yaml_data, envs=envs)
+    if refresh is not None:
+        refresh.join()
+    report_trace(args)
+
+
+@timing.traced("upload_customdata")
+def upload_customdata(client, app_name, yaml_data):
+    # The digest file is inherited by the next deploy's image, only the
+    # version of the customdata the API has tells whether it's still there.
+    # Without one, it's uploaded.
+    version = client.customdata_version(app_name)
+    if version and tasks.customdata_digest(yaml_data, version) == tasks.load_customdata_digest():
+        return
+    client.post_app_yaml(app_name, yaml_data)
+    if client.customdata_etag:
+        tasks.save_customdata_digest(tasks.customdata_digest(yaml_data, client.customdata_etag))
 
 
 def deploy_action(args):
     heartbeat.StderrHeartbeat().start()
     client = Client(args.url, args.token)
-    envs = client.register_unit(args.app_name)
-    tasks.save_apprc_file(envs)
-    tasks.execute_start_script(args.start_cmd)
-    yaml_data = tasks.load_app_yaml()
-    yaml_data["procfile"] = tasks.load_procfile()
-    client.register_unit(args.app_name, yaml_data)
-    client.post_app_yaml(args.app_name, yaml_data)
-    tasks.run_build_hooks(yaml_data, envs=envs)
-    tasks.write_circus_conf(envs=envs)
+    try:
+        _deploy(client, args)
+    finally:
+        report_trace(args)
+
+
+def _deploy(client, args):
+    with timing.span("envs", cat="phase"):
+        envs = client.register_unit(args.app_name)
+        tasks.save_apprc_file(envs)
+    with timing.span("start", cat="phase"):
+        tasks.execute_start_script(args.start_cmd)
+    with timing.span("load_app_yaml", cat="phase"):
+        yaml_data = tasks.load_app_yaml()
+        yaml_data["procfile"] = tasks.load_procfile()
+    # Build hooks don't depend on the upload nor on circus.ini, so both run
+    # while they do, circusd isn't running during a deploy. Hook failures
+    # win; otherwise errors are raised in a fixed order: upload, then
+    # circus.ini.
+    upload = background.BackgroundCall(upload_customdata, client, args.app_name, yaml_data)
+    circus_conf = background.BackgroundCall(tasks.write_circus_conf, envs=envs, circus_endpoint="")
+    with timing.span("build_hooks", cat="phase"):
+        try:
+            tasks.run_build_hooks(yaml_data, envs=envs)
+        except BaseException:
+            upload.join()
+            circus_conf.join()
+            raise
+    with timing.span("wait_background", cat="phase"):
+        upload.result()
+        circus_conf.result()
+
+
+def collect_action(args):
+    from tsuru_unit_agent import collector
+    try:
+        envs = tasks.parse_apprc_file()
+    except (IOError, ValueError):
+        envs = {}
+    envs.setdefault("TSURU_HOST", args.url)
+    envs.setdefault("TSURU_APP_TOKEN", args.token)
+    envs.setdefault("TSURU_APPNAME", args.app_name)
+    collector.Collector(envs).serve(args.log_socket or collector.default_socket_path(envs))
 
 
 actions = {
     'run': run_action,
-    'deploy': deploy_action
+    'deploy': deploy_action,
+    'collect': collect_action,
 }
 
 
@@ -50,11 +208,27 @@ def parse_args(args=None):
     parser.add_argument('app_name', help='The app name')
     parser.add_argument('start_cmd', help='Command to run after notifying tsuru API server')
     parser.add_argument('action', default='run', nargs='?', choices=actions.keys(), help='Action being executed')
+    parser.add_argument('--fast-start', action='store_true',
+                        default=bool(os.environ.get('TSURU_UNIT_AGENT_FAST_START')),
+                        help='Start with the saved apprc and refresh envs in background (run only)')
+    parser.add_argument('--exec', dest='exec_start', action='store_true',
+                        default=bool(os.environ.get('TSURU_UNIT_AGENT_EXEC')),
+                        help='Replace the agent with the start command, after hooks run detached (run only)')
+    parser.add_argument('--log-socket', metavar='PATH',
+                        help='Unix socket the log collector listens on (collect only)')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='Write a Chrome trace of the startup phases to FILE')
     return parser.parse_args(args)
 
 
 def main():
     args = parse_args()
+    if args.trace or os.environ.get("TSURU_UNIT_AGENT_TIMING"):
+        timing.enable()
+    else:
+        timing.disable()
+    tasks.install_sigterm_handler()
+    introspect.install()
     actions[args.action](args)
 
 
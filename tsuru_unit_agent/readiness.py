@@ -0,0 +1,148 @@
+# Copyright 2015 tsuru-unit-agent authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Readiness probing of the started app.
+
+The ``healthcheck`` section in tsuru.yaml makes the agent wait for the app
+to serve before running the ``after`` restart hooks and reporting the unit
+ready, instead of assuming it is as soon as the start command returns.
+"""
+
+import collections
+import httplib
+import os
+import socket
+import sys
+import time
+
+from tsuru_unit_agent import timing
+
+Probe = collections.namedtuple("Probe", ["host", "port", "path", "status", "deadline", "interval",
+                                         "max_interval"])
+
+DEFAULT_DEADLINE = 60
+DEFAULT_INTERVAL = 0.01
+DEFAULT_MAX_INTERVAL = 0.5
+
+# A slow answer is still an answer, but a hung one must not eat the deadline.
+ATTEMPT_TIMEOUT = 5
+
+
+def probe_settings(app_data=None, envs=None):
+    """Returns the probe for the ``healthcheck`` section in tsuru.yaml, or None.
+
+    With a ``path``, the app must answer a GET with ``status`` (any 2xx or
+    3xx by default), otherwise accepting a TCP connection is enough.
+    ``host`` and ``port`` default to 127.0.0.1 and PORT. Polls start
+    ``interval`` seconds apart and double up to ``max_interval``, until
+    ``deadline`` seconds have passed.
+    """
+    envs = envs or {}
+    section = (app_data or {}).get("healthcheck")
+    if not isinstance(section, dict):
+        return None
+    path = section.get("path")
+    if path and not path.startswith("/"):
+        path = "/" + path
+    try:
+        return Probe(host=str(section.get("host") or "127.0.0.1"),
+                     port=int(section.get("port") or envs.get("PORT") or 8888),
+                     path=path or None,
+                     status=int(section["status"]) if section.get("status") else None,
+                     deadline=float(section.get("deadline", DEFAULT_DEADLINE)),
+                     interval=float(section.get("interval", DEFAULT_INTERVAL)),
+                     max_interval=float(section.get("max_interval", DEFAULT_MAX_INTERVAL)))
+    except (TypeError, ValueError):
+        raise ValueError("invalid healthcheck section in tsuru.yaml: {!r}".format(section))
+
+
+def validate_probe(app_data, envs=None):
+    """Returns the probe for ``app_data``, dropping an invalid ``healthcheck`` section.
+
+    The unit then starts as if there was no probe, instead of the agent
+    failing once the app is already running.
+    """
+    try:
+        return probe_settings(app_data, envs)
+    except ValueError as e:
+        sys.stderr.write("tsuru_unit_agent: ignoring {}\n".format(e))
+        app_data.pop("healthcheck", None)
+        return None
+
+
+def check(probe, timeout):
+    if probe.path is None:
+        socket.create_connection((probe.host, probe.port), timeout).close()
+        return True
+    conn = httplib.HTTPConnection(probe.host, probe.port, timeout=timeout)
+    try:
+        conn.request("GET", probe.path)
+        status = conn.getresponse().status
+    finally:
+        conn.close()
+    if probe.status is None:
+        return 200 <= status < 400
+    return status == probe.status
+
+
+def wait_ready(probe, sleep=time.sleep):
+    """Polls ``probe`` until it passes, returning False once the deadline is over."""
+    deadline = time.time() + probe.deadline
+    interval = probe.interval
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        try:
+            if check(probe, min(remaining, ATTEMPT_TIMEOUT)):
+                return True
+        except (socket.error, httplib.HTTPException):
+            pass
+        sleep(max(min(interval, deadline - time.time()), 0))
+        interval = min(interval * 2, probe.max_interval)
+
+
+def ready_file(envs=None):
+    return (envs or {}).get("TSURU_UNIT_READY_FILE") or os.environ.get("TSURU_UNIT_READY_FILE")
+
+
+def clear_ready(envs=None):
+    """Removes the ready file left by a previous start."""
+    path = ready_file(envs)
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
+def notify_ready(envs=None, elapsed=None):
+    if elapsed is None:
+        sys.stderr.write("tsuru_unit_agent: unit ready\n")
+    else:
+        sys.stderr.write("tsuru_unit_agent: unit ready after {:.1f}ms\n".format(elapsed * 1000))
+    path = ready_file(envs)
+    if path:
+        with open(path, "w") as f:
+            f.write("{}\n".format(time.time()))
+
+
+def wait_until_ready(app_data, envs=None):
+    """Waits for the app and reports the unit ready.
+
+    Without a ``healthcheck`` section the unit is reported ready right away
+    and None is returned, otherwise whether the app passed the probe before
+    the deadline. Only a failed probe is not reported.
+    """
+    probe = probe_settings(app_data, envs)
+    if probe is None:
+        notify_ready(envs)
+        return None
+    start = time.time()
+    with timing.span("readiness", cat="phase") as span:
+        ready = wait_ready(probe)
+        span.args["ready"] = ready
+    if ready:
+        notify_ready(envs, time.time() - start)
+    else:
+        sys.stderr.write("tsuru_unit_agent: unit not ready after {:.1f}s, running after hooks anyway\n".format(
+            probe.deadline))
+    return ready
@@ -11,15 +11,18 @@ import os
 import threading
 import time
 import collections
+import weakref
 
 from socket import gethostname
 
-import requests
-
 from . import syslog
 
 QUEUE_DONE_MESSAGE = object()
 
+# Live streams and writers, for introspection.
+STREAMS = weakref.WeakSet()
+WRITERS = weakref.WeakSet()
+
 
 def extract_message(msg):
     # 2012-11-06 18:30:10 [13887] [INFO]
@@ -42,18 +45,41 @@ class Stream(object):
         self.envs.update(os.environ)
         self.envs.update(envs)
         self.hostname = gethostname()
-        self.start_writer()
+        STREAMS.add(self)
+        self.capture = None
+        capture_path = self.envs.get("LOG_CAPTURE_PATH")
+        if capture_path:
+            from .capture import DEFAULT_MAX_BYTES, open_capture
+            self.capture = open_capture(capture_path,
+                                        int(self.envs.get("LOG_CAPTURE_MAX_BYTES", DEFAULT_MAX_BYTES)))
+        self.dedupe = None
+        window = self.envs.get("LOG_DEDUPE_WINDOW")
+        if window:
+            mask = self.envs.get("LOG_DEDUPE_MASK", "").lower() in ("1", "true", "yes", "on")
+            self.dedupe = LineDeduper(float(window), mask=mask)
+            self._dedupe_lock = threading.Lock()
+            self._repeat_timer = None
+        if kwargs.get("queue") is not None:
+            # entries go to a writer shared with other streams.
+            self.queue = kwargs["queue"]
+        else:
+            self.start_writer()
 
     def start_writer(self):
+        import requests
         _, _, token, _, _, _, _ = self._load_envs()
         session = requests.Session()
         if token:
             session.headers.update({"Authorization": "bearer " + token})
-        maxsize = int(self.envs.get("LOG_MAX_QUEUE_SIZE", 1000))
-        self.queue = Queue.Queue(maxsize=maxsize)
+        self.queue = FairQueue(maxsize=int(self.envs.get("LOG_MAX_QUEUE_SIZE", 0)),
+                               max_bytes=int(self.envs.get("LOG_MAX_QUEUE_BYTES", DEFAULT_QUEUE_BYTES)))
         rate_limit_window = self.envs.get("LOG_RATE_LIMIT_WINDOW")
         rate_limit_count = self.envs.get("LOG_RATE_LIMIT_COUNT")
-        self.writer = TsuruLogWriter(session, self.queue, rate_limit_window, rate_limit_count)
+        kwargs = {}
+        transport = streaming_transport(session, self.envs)
+        if transport is not None:
+            kwargs["transport"] = transport
+        self.writer = TsuruLogWriter(session, self.queue, rate_limit_window, rate_limit_count, **kwargs)
         self.writer.start()
 
     def write(self, message):
@@ -63,28 +89,58 @@ class Stream(object):
 
     def flush(self):
         self._flush()
+        self._flush_repeats(self.default_stream_name)
         if self.echo:
             self.echo.flush()
 
     def close(self):
+        self._flush_repeats(self.default_stream_name)
         self.queue.put_nowait(QUEUE_DONE_MESSAGE)
 
     def __call__(self, data):
+        stream_name = data.get('name', self.default_stream_name)
+        if self.capture is not None:
+            self.capture.write(self.watcher_name, stream_name, data["data"])
+        messages = self._get_messages(data["data"])
+        if self.dedupe is not None:
+            with self._dedupe_lock:
+                messages = self.dedupe.feed(messages)
+                if self.dedupe.repeated and self._repeat_timer is None:
+                    # the count is reported even if the app goes quiet.
+                    self._repeat_timer = threading.Timer(self.dedupe.window, self._flush_repeats,
+                                                         args=(stream_name,))
+                    self._repeat_timer.daemon = True
+                    self._repeat_timer.start()
+            if not messages:
+                return
+        self._log(messages, stream_name)
+
+    def _flush_repeats(self, stream_name):
+        if self.dedupe is None:
+            return
+        with self._dedupe_lock:
+            if self._repeat_timer is not None:
+                self._repeat_timer.cancel()
+                self._repeat_timer = None
+            messages = self.dedupe.flush()
+        if messages:
+            self._log(messages, stream_name)
+
+    def _log(self, messages, stream_name):
         (appname, host, token, syslog_server, syslog_port,
          syslog_facility, syslog_socket) = self._load_envs()
-        messages = self._get_messages(data["data"])
-        stream_name = data.get('name', self.default_stream_name)
         if appname and host and token:
-            self._log_tsuru_api(messages, appname, host, token)
+            self._log_tsuru_api(messages, appname, host, token, stream_name)
         if syslog_server and syslog_port and syslog_facility:
             self._log_syslog(messages, appname, syslog_server, syslog_port,
                              syslog_facility, syslog_socket, stream_name)
 
-    def _log_tsuru_api(self, messages, appname, host, token):
+    def _log_tsuru_api(self, messages, appname, host, token, stream_name=None):
         url = "{0}/apps/{1}/log?source={2}&unit={3}".format(host, appname,
                                                             self.watcher_name,
                                                             self.hostname)
-        self.queue.put_nowait(LogEntry(url, self.timeout, messages))
+        source = (self.watcher_name, stream_name or self.default_stream_name)
+        self.queue.put_nowait(LogEntry(url, self.timeout, messages, source))
 
     def _get_syslog(self, host, port, facility, socktype):
         if not hasattr(self, "_syslog"):
@@ -115,6 +171,17 @@ class Stream(object):
         except:
             pass
 
+    def stats(self):
+        stats = {"watcher": self.watcher_name, "stream": self.default_stream_name,
+                 "buffered_bytes": len(self._buffer)}
+        stats.update(queue_stats(self.queue))
+        if self.dedupe is not None:
+            stats["pending_repeats"] = self.dedupe.repeated
+        if self.capture is not None:
+            stats["capture_bytes"] = self.capture.written
+            stats["capture_dropped"] = self.capture.dropped
+        return stats
+
     def _load_envs(self):
         return (self.envs.get("TSURU_APPNAME"), self.envs.get("TSURU_HOST"),
                 self.envs.get("TSURU_APP_TOKEN"), self.envs.get("TSURU_SYSLOG_SERVER"),
@@ -142,16 +209,106 @@ class Stream(object):
         return result
 
 
+REPEATED = "last message repeated {} times\n"
+
+MASK_RE = re.compile(r"0x[0-9a-fA-F]+|\b[0-9a-fA-F]*[0-9][0-9a-fA-F]*\b")
+
+
+class LineDeduper(object):
+    """Collapses consecutive repeated lines.
+
+    Repeats of a line within ``window`` seconds of its first occurrence are
+    counted instead of shipped, and reported as one :data:`REPEATED` line
+    when a different line arrives, the window ends or :meth:`flush` is
+    called. With ``mask``, lines differing only in numbers and hex values
+    count as repeats. Only the last line is kept.
+    """
+
+    def __init__(self, window, mask=False):
+        self.window = window
+        self.mask = mask
+        self.last_key = None
+        self.started = 0
+        self.repeated = 0
+
+    def key(self, line):
+        if self.mask:
+            return MASK_RE.sub("#", line)
+        return line
+
+    def feed(self, lines, now=None):
+        if now is None:
+            now = time.time()
+        result = []
+        for line in lines:
+            key = self.key(line)
+            if key == self.last_key and now - self.started < self.window:
+                self.repeated += 1
+                continue
+            result.extend(self.flush())
+            result.append(line)
+            self.last_key = key
+            self.started = now
+        return result
+
+    def flush(self):
+        if not self.repeated:
+            return []
+        count, self.repeated = self.repeated, 0
+        self.last_key = None
+        return [REPEATED.format(count)]
+
+
+DEFAULT_QUEUE_BYTES = 4 << 20
+
+
+def json_array(payloads):
+    """Joins LogEntry payloads into the body of a batched POST."""
+    body = "".join(payloads)
+    # encoded JSON strings never contain a raw newline.
+    return "[" + body[:-1].replace("\n", ", ") + "]"
+
+
 RATE_LIMITED = '["dropping messages, more than {} messages in last {} seconds"]'
 
 
 class TsuruLogWriter(threading.Thread):
 
     def __init__(self, session, queue, rate_limit_window, rate_limit_count, *args, **kwargs):
+        self.batch_size = kwargs.pop("batch_size", 1)
+        self.transport = kwargs.pop("transport", None)
         super(TsuruLogWriter, self).__init__(*args, **kwargs)
         self.queue = queue
         self.session = session
+        self.last_status = None
+        self.last_post = None
         self.setup_rate_limiter(rate_limit_window, rate_limit_count)
+        WRITERS.add(self)
+
+    def stats(self):
+        stats = {"alive": self.is_alive(), "batch_size": self.batch_size,
+                 "last_status": self.last_status, "last_post": self.last_post,
+                 "rate_limit": self.rate_limit_enabled}
+        if self.rate_limit_enabled:
+            stats["rate_limit_window"] = self.rate_limit_window
+            stats["rate_limit_count"] = self.rate_limit_count
+            stats["rate_limit_used"] = len(self.rate_queue)
+            stats["rate_limit_notice"] = self.rate_limit_notice
+        if self.transport is not None:
+            stats["streaming_uploads"] = len(self.transport.uploads)
+            stats["streaming_unsupported"] = len(self.transport.unsupported)
+        stats.update(queue_stats(self.queue))
+        return stats
+
+    def post(self, url, data, timeout):
+        self.last_post = time.time()
+        try:
+            response = self.session.post(url, data=data, timeout=timeout)
+        except Exception as e:
+            self.last_status = e.__class__.__name__
+            raise
+        self.last_status = getattr(response, "status_code", None)
+        return response
 
     def setup_rate_limiter(self, rate_limit_window, rate_limit_count):
         self.rate_limit_enabled = rate_limit_window is not None and rate_limit_count is not None
@@ -185,31 +342,375 @@ class TsuruLogWriter(threading.Thread):
     def run(self):
         while True:
             try:
-                entry = self.queue.get()
-                if entry == QUEUE_DONE_MESSAGE:
+                if self.transport is None:
+                    entries = [self.queue.get()]
+                else:
+                    try:
+                        entries = [self.queue.get(timeout=self.transport.tick_interval)]
+                    except Queue.Empty:
+                        # idle uploads still have to rotate.
+                        self.transport.tick()
+                        continue
+                # Whatever is already queued goes in the same batch.
+                while entries[-1] != QUEUE_DONE_MESSAGE and len(entries) < self.batch_size:
+                    try:
+                        entries.append(self.queue.get_nowait())
+                    except Queue.Empty:
+                        break
+                done = entries[-1] == QUEUE_DONE_MESSAGE
+                if done:
+                    entries.pop()
+                self.write_entries(entries)
+                if done:
+                    if self.transport is not None:
+                        self.transport.close()
                     break
-                if not self.should_accept_log():
-                    now = time.time()
-                    if self.rate_limit_notice < now - self.rate_limit_window:
-                        msg = RATE_LIMITED.format(self.rate_limit_count, self.rate_limit_window)
-                        self.session.post(
-                            entry.url,
-                            data=msg,
-                            timeout=entry.timeout)
-                        self.rate_limit_notice = now
+            except:
+                pass
+
+    def write_entries(self, entries):
+        # Messages for the same url are sent in a single request.
+        batches = collections.OrderedDict()
+        try:
+            for entry in entries:
+                if self.should_accept_log():
+                    batches.setdefault((entry.url, entry.timeout), []).append(entry.payload)
+                else:
+                    self.notify_rate_limited(entry)
+            for (url, timeout), payloads in batches.items():
+                if self.transport is not None and self.transport.send(url, "".join(payloads), timeout):
                     continue
                 try:
-                    self.session.post(entry.url, data=json.dumps(entry.messages),
-                                      timeout=entry.timeout)
-                finally:
-                    self.queue.task_done()
+                    self.post(url, json_array(payloads), timeout)
+                except:
+                    pass
+        finally:
+            for _ in entries:
+                self.queue.task_done()
+
+    def notify_rate_limited(self, entry):
+        now = time.time()
+        if self.rate_limit_notice < now - self.rate_limit_window:
+            msg = RATE_LIMITED.format(self.rate_limit_count, self.rate_limit_window)
+            self.rate_limit_notice = now
+            try:
+                self.post(entry.url, msg, entry.timeout)
+            except:
+                pass
+
+
+STREAMING_FALLBACK_STATUSES = (400, 404, 405, 411, 415, 501, 505)
+
+
+def streaming_transport(session, envs):
+    """Returns the transport for the LOG_STREAMING* envs, or None."""
+    if (envs.get("LOG_STREAMING") or "").lower() not in ("1", "true", "yes", "on"):
+        return None
+    return StreamingTransport(session,
+                              max_bytes=int(envs.get("LOG_STREAMING_MAX_BYTES", 1 << 20)),
+                              max_age=float(envs.get("LOG_STREAMING_MAX_AGE", 30)))
+
+
+class ChunkedUpload(threading.Thread):
+    """A POST with a chunked NDJSON body, fed by :meth:`write` until :meth:`close`.
+
+    Records are kept until the request ends, so they can be resent when
+    it fails.
+    """
+
+    def __init__(self, session, url, timeout):
+        super(ChunkedUpload, self).__init__()
+        self.daemon = True
+        self.session = session
+        self.url = url
+        self.timeout = timeout
+        self.chunks = Queue.Queue()
+        self.records = []
+        self.size = 0
+        self.started = time.time()
+        self.status = None
+        self.error = None
+        self.start()
+
+    def write(self, payload):
+        self.records.append(payload)
+        self.size += len(payload)
+        self.chunks.put(payload)
+
+    def close(self):
+        self.chunks.put(None)
+
+    def body(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            yield chunk
+
+    def run(self):
+        try:
+            response = self.session.post(self.url, data=self.body(), timeout=self.timeout,
+                                         headers={"Content-Type": "application/x-ndjson"})
+            self.status = response.status_code
+        except Exception as e:
+            self.error = e
+
+    def ok(self):
+        return self.error is None and self.status is not None and 200 <= self.status < 400
+
+
+class StreamingTransport(object):
+    """Ships messages over long-lived chunked uploads, one per url.
+
+    Uploads are rotated once they carry ``max_bytes`` or are ``max_age``
+    seconds old. Records of a failed upload are resent with a regular
+    POST. A url answering with a status in STREAMING_FALLBACK_STATUSES, or
+    failing ``max_failures`` uploads in a row, goes back to batched POSTs.
+    """
+
+    def __init__(self, session, max_bytes=1 << 20, max_age=30, max_failures=3):
+        self.session = session
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_failures = max_failures
+        self.tick_interval = min(max_age, 1)
+        self.uploads = {}
+        self.closing = []
+        self.failures = collections.defaultdict(int)
+        self.unsupported = set()
+
+    def send(self, url, payload, timeout):
+        """Sends NDJSON ``payload``, returns False when ``url`` doesn't take streaming uploads."""
+        self.tick()
+        if url in self.unsupported:
+            return False
+        upload = self.uploads.get(url)
+        if upload is None:
+            upload = self.uploads[url] = ChunkedUpload(self.session, url, timeout)
+        upload.write(payload)
+        return True
+
+    def tick(self):
+        now = time.time()
+        for url, upload in self.uploads.items():
+            if (not upload.is_alive() or upload.size >= self.max_bytes or
+                    now - upload.started >= self.max_age):
+                self.rotate(url)
+        self.reap()
+
+    def rotate(self, url):
+        upload = self.uploads.pop(url)
+        upload.close()
+        self.closing.append(upload)
+
+    def reap(self, wait=False):
+        for upload in self.closing[:]:
+            if wait:
+                upload.join(upload.timeout)
+            if upload.is_alive():
+                continue
+            self.closing.remove(upload)
+            if upload.ok():
+                self.failures.pop(upload.url, None)
+                continue
+            self.failures[upload.url] += 1
+            if (upload.status in STREAMING_FALLBACK_STATUSES or
+                    self.failures[upload.url] >= self.max_failures):
+                logging.error("Streaming logs to {} failed ({}), using batched requests".format(
+                    upload.url, upload.status or upload.error))
+                self.unsupported.add(upload.url)
+            try:
+                self.session.post(upload.url, data=json_array(upload.records), timeout=upload.timeout)
             except:
                 pass
 
+    def close(self):
+        for url in self.uploads.keys():
+            self.rotate(url)
+        self.reap(wait=True)
+
+
+def queue_stats(queue):
+    stats = {"queue_depth": queue.qsize()}
+    for name in ("bytes", "dropped"):
+        if hasattr(queue, name):
+            stats["queue_" + name] = getattr(queue, name)
+    return stats
+
+
+def parse_weights(value):
+    """Parses LOG_SOURCE_WEIGHTS, like ``stderr=4,web=2,worker:stdout=0.5``.
+
+    Keys are a stream name, a watcher name or ``watcher:stream``.
+    """
+    weights = {}
+    for item in (value or "").split(","):
+        key, _, weight = item.partition("=")
+        if not key.strip():
+            continue
+        try:
+            weights[key.strip()] = float(weight)
+        except ValueError:
+            logging.error("Invalid log source weight: '{}'".format(item))
+    return weights
+
+
+class FairQueue(object):
+    """Queue with one sub-queue per log source, serviced by deficit round-robin.
+
+    Sources are the (watcher, stream) pairs of the entries. Each turn a
+    source gets ``quantum * weight`` messages of credit, so under overload
+    every source keeps a share of the writer proportional to its weight.
+    The queue is bounded by ``max_bytes`` of payload and, optionally, by
+    ``maxsize`` entries. When full, the oldest entry of the source using
+    the most (bytes or entries) per weight is dropped instead of refusing
+    a put from a quieter source. ``bytes`` is the current payload size.
+    """
+
+    def __init__(self, maxsize=0, weights=None, quantum=10, max_bytes=0):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.weights = weights or {}
+        self.quantum = quantum
+        self.queues = collections.OrderedDict()
+        self.deficits = {}
+        self.source_bytes = {}
+        self.size = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.unfinished_tasks = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def weight(self, source):
+        watcher, name = source if isinstance(source, tuple) else (source, None)
+        for key in ("{}:{}".format(watcher, name), watcher, name):
+            if key in self.weights:
+                return max(self.weights[key], 0.01)
+        return 1.0
+
+    def put(self, item, block=False, timeout=None):
+        with self.cond:
+            if item is QUEUE_DONE_MESSAGE:
+                self.closed = True
+                self.cond.notify()
+                return
+            source = getattr(item, "source", None)
+            size = getattr(item, "size", 0)
+            if self.max_bytes and size > self.max_bytes:
+                raise Queue.Full
+            while self._over(size):
+                if not self._push_out(source, size):
+                    raise Queue.Full
+            if source not in self.queues:
+                self.queues[source] = collections.deque()
+                self.deficits[source] = 0
+                self.source_bytes[source] = 0
+            self.queues[source].append(item)
+            self.size += 1
+            self.bytes += size
+            self.source_bytes[source] += size
+            self.unfinished_tasks += 1
+            self.cond.notify()
+
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+    def _over(self, size):
+        return ((self.maxsize and self.size >= self.maxsize) or
+                (self.max_bytes and self.bytes + size > self.max_bytes))
+
+    def _push_out(self, source, size):
+        if self.max_bytes:
+            def load(s):
+                return self.source_bytes.get(s, 0) / self.weight(s)
+        else:
+            def load(s):
+                return len(self.queues.get(s, ())) / self.weight(s)
+            size = 1
+        victim = max(self.queues, key=load)
+        if victim == source or load(victim) <= load(source) + size / self.weight(source):
+            return False
+        self._pop(victim)
+        self.dropped += 1
+        self.unfinished_tasks -= 1
+        return True
+
+    def _pop(self, source):
+        item = self.queues[source].popleft()
+        size = getattr(item, "size", 0)
+        self.size -= 1
+        self.bytes -= size
+        self.source_bytes[source] -= size
+        if not self.queues[source]:
+            del self.queues[source]
+            del self.deficits[source]
+            del self.source_bytes[source]
+        return item
+
+    def get(self, block=True, timeout=None):
+        with self.cond:
+            deadline = None if timeout is None else time.time() + timeout
+            while not self.size:
+                if self.closed:
+                    return QUEUE_DONE_MESSAGE
+                remaining = None if deadline is None else deadline - time.time()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise Queue.Empty
+                self.cond.wait(remaining)
+            while True:
+                source, queue = next(self.queues.iteritems())
+                cost = max(getattr(queue[0], "count", 1), 1)
+                if self.deficits[source] >= cost:
+                    self.deficits[source] -= cost
+                    return self._pop(source)
+                self.deficits[source] += self.quantum * self.weight(source)
+                # next source's turn.
+                del self.queues[source]
+                self.queues[source] = queue
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def task_done(self):
+        with self.cond:
+            self.unfinished_tasks = max(self.unfinished_tasks - 1, 0)
+
+    def qsize(self):
+        return self.size
+
+    def empty(self):
+        return self.size == 0
+
+    def full(self):
+        return bool((self.maxsize and self.size >= self.maxsize) or
+                    (self.max_bytes and self.bytes >= self.max_bytes))
+
+
+def _encode_message(message):
+    # App output isn't always UTF-8, json.dumps would raise in the thread
+    # feeding the stream.
+    if isinstance(message, bytes):
+        message = message.decode("utf-8", "replace")
+    return json.dumps(message) + "\n"
+
 
 class LogEntry(object):
+    """Messages for one url, stored as NDJSON bytes (one encoded message per line)."""
+
+    __slots__ = ("url", "timeout", "source", "payload", "count")
 
-    def __init__(self, url, timeout, messages):
+    def __init__(self, url, timeout, messages, source=None):
         self.url = url
         self.timeout = timeout
-        self.messages = messages
+        self.source = source
+        self.payload = "".join(_encode_message(m) for m in messages)
+        self.count = len(messages)
+
+    @property
+    def size(self):
+        return len(self.payload)
+
+    @property
+    def messages(self):
+        return [json.loads(line) for line in self.payload.splitlines()]
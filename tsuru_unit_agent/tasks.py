@@ -1,20 +1,25 @@
 import codecs
 import collections
+import copy
+import errno
+import fcntl
+import hashlib
 import io
 import os
 import os.path
+import re
 import shutil
 import string
 import subprocess
 import sys
-import yaml
+import tempfile
 import json
+import logging
 import signal
 from datetime import datetime
 from threading import Thread
 
-from honcho import procfile
-from tsuru_unit_agent.stream import Stream
+from tsuru_unit_agent import timing, watchers
 
 WATCHER_TEMPLATE = u"""
 [watcher:{name}]
@@ -23,12 +28,30 @@ copy_env = True
 uid = {user}
 gid = {group}
 working_dir = {working_dir}
-stdout_stream.class = tsuru.stream.Stream
+stdout_stream.class = {stream_class}
 stdout_stream.watcher_name = {name}
-stderr_stream.class = tsuru.stream.Stream
+stderr_stream.class = {stream_class}
 stderr_stream.watcher_name = {name}
 """
 
+STREAM_CLASS = u"tsuru.stream.Stream"
+
+COLLECTOR_STREAM_CLASS = u"tsuru_unit_agent.collector.CollectorStream"
+
+WATCHER_OPTION_TEMPLATE = u"{} = {}\n"
+
+SOCKET_TEMPLATE = u"""
+[socket:{name}]
+host = {host}
+port = {port}
+"""
+
+ENV_TEMPLATE = u"""
+[env:{name}]
+"""
+
+AFFINITY_CMD_TEMPLATE = u"{python} -m tsuru_unit_agent.affinity $(circus.wid) {cpus} -- {cmd}"
+
 
 def process_output(in_fd, out_fd):
     for line in iter(in_fd.readline, b''):
@@ -48,7 +71,14 @@ def sigterm_handler(signum, sigframe):
     except:
         pass
     sys.exit(0)
-signal.signal(signal.SIGTERM, sigterm_handler)
+
+
+def install_sigterm_handler():
+    """Forwards SIGTERM to the command :func:`exec_with_envs` is running.
+
+    It must be called from the main thread.
+    """
+    signal.signal(signal.SIGTERM, sigterm_handler)
 
 
 def exec_with_envs(commands, with_shell=False, working_dir="/home/application/current", pipe_output=False,
@@ -65,27 +95,30 @@ def exec_with_envs(commands, with_shell=False, working_dir="/home/application/cu
         popen_output = None
         if pipe_output:
             popen_output = subprocess.PIPE
-        pipe = subprocess.Popen(command, shell=with_shell, cwd=working_dir, env=app_envs,
-                                stdout=popen_output, stderr=popen_output)
-        running_pipe = pipe
-        if pipe_output:
-            stdout = Stream(echo_output=sys.stdout,
-                            default_stream_name='stdout',
-                            watcher_name='unit-agent',
-                            envs=app_envs)
-            stderr = Stream(echo_output=sys.stderr,
-                            default_stream_name='stderr',
-                            watcher_name='unit-agent',
-                            envs=app_envs)
-            stdout_thread = Thread(target=process_output, args=(pipe.stdout, stdout))
-            stdout_thread.start()
-            stderr_thread = Thread(target=process_output, args=(pipe.stderr, stderr))
-            stderr_thread.start()
-        status = pipe.wait()
-        running_pipe = None
-        if pipe_output:
-            stdout_thread.join()
-            stderr_thread.join()
+        with timing.span("exec", command=command) as command_span:
+            pipe = subprocess.Popen(command, shell=with_shell, cwd=working_dir, env=app_envs,
+                                    stdout=popen_output, stderr=popen_output)
+            running_pipe = pipe
+            if pipe_output:
+                from tsuru_unit_agent.stream import Stream
+                stdout = Stream(echo_output=sys.stdout,
+                                default_stream_name='stdout',
+                                watcher_name='unit-agent',
+                                envs=app_envs)
+                stderr = Stream(echo_output=sys.stderr,
+                                default_stream_name='stderr',
+                                watcher_name='unit-agent',
+                                envs=app_envs)
+                stdout_thread = Thread(target=process_output, args=(pipe.stdout, stdout))
+                stdout_thread.start()
+                stderr_thread = Thread(target=process_output, args=(pipe.stderr, stderr))
+                stderr_thread.start()
+            status = pipe.wait()
+            running_pipe = None
+            if pipe_output:
+                stdout_thread.join()
+                stderr_thread.join()
+            command_span.args["status"] = status
         if status != 0:
             sys.exit(status)
 
@@ -94,81 +127,522 @@ def execute_start_script(start_cmd, envs=None, with_shell=True):
     exec_with_envs([start_cmd], with_shell=with_shell, envs=envs)
 
 
+def replace_with_start_script(start_cmd, envs=None, working_dir="/home/application/current"):
+    """Replaces the agent process with ``start_cmd``, it never returns.
+
+    Like :func:`execute_start_script` with ``with_shell=False``, but the
+    command inherits the agent pid and no interpreter stays resident.
+    """
+    app_envs = {}
+    app_envs.update(os.environ)
+    app_envs.update(envs or {})
+    if not os.path.exists(working_dir):
+        working_dir = "/"
+    os.chdir(working_dir)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execvpe(start_cmd, [start_cmd], app_envs)
+
+
+def spawn_detached(func, *args, **kwargs):
+    """Runs ``func`` in a detached grandchild process and returns at once.
+
+    The grandchild is reparented to init, so it outlives an exec in the
+    caller and never becomes a zombie of the command that replaces it.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    status = 1
+    try:
+        os.setsid()
+        if os.fork() == 0:
+            func(*args, **kwargs)
+        status = 0
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        logging.exception("Detached call to {} failed".format(getattr(func, "__name__", func)))
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
+def spawn_after_exec(func, *args, **kwargs):
+    """Like :func:`spawn_detached`, but ``func`` waits for the caller's exec.
+
+    The helper blocks on a pipe whose write end the caller closes on exec,
+    so ``func`` only runs once the start command replaced the agent. If the
+    caller exits instead, ``func`` doesn't run at all.
+    """
+    read_fd, write_fd = os.pipe()
+    fcntl.fcntl(write_fd, fcntl.F_SETFD, fcntl.fcntl(write_fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    try:
+        spawn_detached(_run_after_exec, os.getpid(), read_fd, write_fd, func, args, kwargs)
+    finally:
+        os.close(read_fd)
+
+
+def _run_after_exec(pid, read_fd, write_fd, func, args, kwargs):
+    os.close(write_fd)
+    try:
+        os.read(read_fd, 1)
+    finally:
+        os.close(read_fd)
+    if _process_running(pid):
+        func(*args, **kwargs)
+
+
+def _process_running(pid):
+    # The pipe is closed either by the exec or by the exit, and an exiting
+    # process has released its executable before its files.
+    try:
+        os.readlink("/proc/{}/exe".format(pid))
+    except OSError as e:
+        return e.errno != errno.ENOENT
+    return True
+
+
 def run_build_hooks(app_data, envs=None):
     commands = (app_data.get('hooks') or {}).get('build') or []
     exec_with_envs(commands, with_shell=True, envs=envs)
 
 
-def run_restart_hooks(position, app_data, envs=None):
+def restart_hooks(position, app_data):
     restart_hook = (app_data.get('hooks') or {}).get('restart') or {}
-    commands = restart_hook.get('{}-each'.format(position)) or []
+    commands = list(restart_hook.get('{}-each'.format(position)) or [])
     commands += restart_hook.get(position) or []
-    exec_with_envs(commands, with_shell=True, pipe_output=True,
+    return commands
+
+
+def run_restart_hooks(position, app_data, envs=None):
+    exec_with_envs(restart_hooks(position, app_data), with_shell=True, pipe_output=True,
                    envs=envs)
 
 
-def load_app_yaml(working_dir="/home/application/current"):
+_app_yaml_cache = {}
+
+
+def _load_app_yaml_snapshot(cache_path, key):
+    # The snapshot is writable by the app, it must never be able to run code.
+    try:
+        with open(cache_path, "rb") as f:
+            snapshot = json.load(f)
+    except Exception:
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get("key") != list(key):
+        return None
+    data = snapshot.get("data")
+    if data is not None and not isinstance(data, dict):
+        return None
+    return snapshot
+
+
+def _save_app_yaml_snapshot(cache_path, key, data):
+    try:
+        blob = json.dumps({"key": list(key), "data": data})
+    except (TypeError, ValueError):
+        return
+    # dates, sets or non-string keys don't survive JSON, those files are
+    # only cached in memory.
+    if json.loads(blob)["data"] != data:
+        return
+    try:
+        write_file_atomically(cache_path, blob)
+    except (IOError, OSError):
+        pass
+
+
+def yaml_loader():
+    import yaml
+    try:
+        return yaml.CSafeLoader
+    except AttributeError:
+        return yaml.SafeLoader
+
+
+@timing.traced("load_app_yaml")
+def load_app_yaml(working_dir="/home/application/current", cache_path=None):
+    # Parsed files are cached by path, mtime and size, in memory and in a
+    # JSON snapshot file that survives restarts. Every caller gets its own
+    # copy.
+    if cache_path is None:
+        cache_path = os.environ.get("APP_YAML_CACHE_PATH", "/home/application/.app_yaml_cache")
     files_name = ["tsuru.yaml", "tsuru.yml", "app.yaml", "app.yml"]
     for file_name in files_name:
+        fullpath = os.path.join(working_dir, file_name)
         try:
-            fullpath = os.path.join(working_dir, file_name)
-            with codecs.open(fullpath, 'r', encoding='utf-8', errors='ignore') as f:
-                return yaml.load(f.read()) or {}
-        except (IOError, yaml.scanner.ScannerError):
-            pass
+            stat = os.stat(fullpath)
+        except OSError:
+            continue
+        key = (fullpath, stat.st_mtime, stat.st_size)
+        if key not in _app_yaml_cache:
+            snapshot = _load_app_yaml_snapshot(cache_path, key)
+            if snapshot is not None:
+                data = snapshot["data"]
+            else:
+                import yaml
+                try:
+                    with codecs.open(fullpath, 'r', encoding='utf-8', errors='ignore') as f:
+                        data = yaml.load(f.read(), Loader=yaml_loader()) or {}
+                except IOError:
+                    continue
+                except yaml.scanner.ScannerError:
+                    data = None
+                _save_app_yaml_snapshot(cache_path, key, data)
+            _app_yaml_cache[key] = data
+        data = copy.deepcopy(_app_yaml_cache[key])
+        if data is not None:
+            return data
     return {}
 
 
+@timing.traced("load_procfile")
 def load_procfile(working_dir="/home/application/current"):
     path = os.path.join(working_dir, "Procfile")
     with codecs.open(path, "r", encoding="utf-8", errors="ignore") as f:
         return f.read()
 
 
+@timing.traced("write_circus_conf")
 def write_circus_conf(procfile_path=None, conf_path="/etc/circus/circus.ini",
-                      envs=None):
+                      envs=None, circus_endpoint=None, app_data=None, previous_envs=None, procfile=None):
+    """Writes the watchers for the Procfile and applies the changes to circus.
+
+    ``procfile`` is the Procfile already parsed by
+    :func:`load_procfile_commands`, it's loaded from ``procfile_path``
+    otherwise. ``previous_envs`` are the envs circusd was started with, the
+    vars that changed since are pinned in the env sections of the watchers
+    they affect, see :func:`watchers.pinned_envs`.
+    """
+    if circus_endpoint is None:
+        circus_endpoint = os.environ.get("CIRCUS_ENDPOINT")
     if not envs:
         envs = {}
     expanding_envs = collections.defaultdict(str)
     expanding_envs.update(os.environ)
     expanding_envs.update(envs)
-    procfile_path = procfile_path or os.environ.get("PROCFILE_PATH",
-                                                    "/home/application/current/Procfile")
-    content = ""
-    with open(procfile_path) as f:
-        content = f.read()
-    pfile = procfile.Procfile(content)
+    pfile = procfile if procfile is not None else load_procfile_commands(procfile_path)
     new_watchers = []
     working_dir = os.environ.get("APP_WORKING_DIR", "/home/application/current")
+    if app_data is None:
+        app_data = load_app_yaml(working_dir)
+    new_sockets = []
+    # TSURU_LOG_COLLECTOR points watchers at the socket of `collect`.
+    collector = expanding_envs.get("TSURU_LOG_COLLECTOR")
+    pinned = {}
+    if previous_envs is not None:
+        inputs = _watchers_env_inputs(pfile, app_data, expanding_envs)
+        pinned = watchers.pinned_envs(previous_envs, envs, inputs)
     for name, cmd in pfile.commands.items():
-        cmd = string.Template(cmd).substitute(expanding_envs)
-        new_watchers.append(WATCHER_TEMPLATE.format(name=name, cmd=cmd,
-                                                    user="ubuntu", group="ubuntu",
-                                                    working_dir=working_dir))
+        settings = watchers.process_settings(name, app_data, expanding_envs)
+        cmd_envs = expanding_envs
+        if settings.socket:
+            cmd_envs = expanding_envs.copy()
+            cmd_envs["SOCKET_FD"] = "$(circus.sockets.{})".format(name)
+            cmd_envs["PORT"] = str(settings.socket.port)
+        cmd = string.Template(cmd).substitute(cmd_envs)
+        if settings.cpu_affinity:
+            cpus = ",".join(str(cpu) for cpu in watchers.available_cpus())
+            cmd = AFFINITY_CMD_TEMPLATE.format(python=sys.executable, cpus=cpus, cmd=cmd)
+        watcher = WATCHER_TEMPLATE.format(name=name, cmd=cmd,
+                                          user="ubuntu", group="ubuntu",
+                                          working_dir=working_dir,
+                                          stream_class=COLLECTOR_STREAM_CLASS if collector else STREAM_CLASS)
+        if collector:
+            watcher += WATCHER_OPTION_TEMPLATE.format("stdout_stream.socket_path", collector)
+            watcher += WATCHER_OPTION_TEMPLATE.format("stderr_stream.socket_path", collector)
+        if settings.numprocesses is not None:
+            watcher += WATCHER_OPTION_TEMPLATE.format("numprocesses", settings.numprocesses)
+        for resource, value in sorted(settings.rlimits.items()):
+            watcher += WATCHER_OPTION_TEMPLATE.format("rlimit_" + resource, value)
+        watcher_envs = {}
+        for env, value in pinned.get(name, {}).items():
+            watcher_envs[env] = value.replace("\n", "\n    ")
+        for env in settings.envs:
+            watcher_envs[env] = expanding_envs.get(env, "").replace("\n", "\n    ")
+        if settings.socket:
+            watcher += WATCHER_OPTION_TEMPLATE.format("use_sockets", True)
+            watcher_envs["PORT"] = settings.socket.port
+            socket = SOCKET_TEMPLATE.format(name=name, host=settings.socket.host,
+                                            port=settings.socket.port)
+            if settings.socket.reuseport:
+                socket += WATCHER_OPTION_TEMPLATE.format("so_reuseport", True)
+            new_sockets.append(socket)
+        if watcher_envs:
+            watcher += ENV_TEMPLATE.format(name=name)
+            for env, value in sorted(watcher_envs.items()):
+                watcher += WATCHER_OPTION_TEMPLATE.format(env, value)
+        new_watchers.append(watcher)
     base_conf = conf_path + ".base"
+    conf = b""
+    current_watchers = {}
     if os.path.exists(conf_path):
         if not os.path.exists(base_conf):
             shutil.copy2(conf_path, base_conf)
-        shutil.copy2(base_conf, conf_path)
-    if new_watchers:
-        with open(conf_path, "a") as f:
-            for watcher in new_watchers:
-                f.write(watcher)
+        with open(base_conf, "rb") as f:
+            conf = f.read()
+        with open(conf_path, "rb") as f:
+            current_watchers = watchers.parse_watchers(f.read())
+    elif not new_watchers:
+        return False
+    conf += u"".join(new_watchers + new_sockets).encode("utf-8")
+    written = write_file_atomically(conf_path, conf)
+    if not circus_endpoint:
+        # circusd isn't running, it loads the new file when it starts.
+        _discard_pending_watchers(conf_path)
+        return written
+    if written and _load_pending_watchers(conf_path) is None:
+        _save_pending_watchers(conf_path, current_watchers)
+    apply_circus_conf(conf_path, circus_endpoint)
+    return written
 
 
+def apply_circus_conf(conf_path="/etc/circus/circus.ini", circus_endpoint=None):
+    """Applies to circus the changes to circus.ini it hasn't taken yet.
+
+    The watchers circus runs are recorded before a change is written, so a
+    failed apply is tried again by the next call. Returns whether circus is
+    up to date.
+    """
+    if circus_endpoint is None:
+        circus_endpoint = os.environ.get("CIRCUS_ENDPOINT")
+    current_watchers = _load_pending_watchers(conf_path)
+    if current_watchers is None:
+        return True
+    if not circus_endpoint:
+        return False
+    with open(conf_path, "rb") as f:
+        desired_watchers = watchers.parse_watchers(f.read())
+    diff = watchers.diff_watchers(current_watchers, desired_watchers)
+    if not watchers.apply_watchers_diff(circus_endpoint, diff, current_watchers, desired_watchers):
+        return False
+    _discard_pending_watchers(conf_path)
+    return True
+
+
+def _load_pending_watchers(conf_path):
+    try:
+        with open(conf_path + ".pending", "rb") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _save_pending_watchers(conf_path, current_watchers):
+    write_file_atomically(conf_path + ".pending", json.dumps(current_watchers, sort_keys=True))
+
+
+def _discard_pending_watchers(conf_path):
+    if os.path.exists(conf_path + ".pending"):
+        os.remove(conf_path + ".pending")
+
+
+def read_circus_endpoint(conf_path="/etc/circus/circus.ini"):
+    endpoint = os.environ.get("CIRCUS_ENDPOINT")
+    if endpoint:
+        return endpoint
+    try:
+        with open(conf_path, "rb") as f:
+            return watchers.parse_circus_endpoint(f.read())
+    except IOError:
+        return None
+
+
+@timing.traced("load_procfile_commands")
+def load_procfile_commands(procfile_path=None):
+    procfile_path = procfile_path or os.environ.get("PROCFILE_PATH",
+                                                    "/home/application/current/Procfile")
+    from honcho import procfile
+    with open(procfile_path) as f:
+        return procfile.Procfile(f.read())
+
+
+def load_watchers_env_inputs(procfile_path=None, app_data=None, envs=None):
+    """Returns the env vars each watcher depends on.
+
+    Those are the vars referenced in its Procfile command plus the ones
+    declared in the ``envs`` process setting. Use it with
+    :func:`watchers.affected_watchers` to tell which watchers an env change
+    affects.
+    """
+    expanding_envs = {}
+    expanding_envs.update(os.environ)
+    expanding_envs.update(envs or {})
+    if app_data is None:
+        app_data = load_app_yaml(os.environ.get("APP_WORKING_DIR", "/home/application/current"))
+    return _watchers_env_inputs(load_procfile_commands(procfile_path), app_data, expanding_envs)
+
+
+def _watchers_env_inputs(pfile, app_data, envs):
+    inputs = {}
+    for name, cmd in pfile.commands.items():
+        settings = watchers.process_settings(name, app_data, envs)
+        inputs[name] = watchers.referenced_envs(cmd) | set(settings.envs)
+    return inputs
+
+
+@timing.traced("save_apprc_file")
 def save_apprc_file(environs, file_path="/home/application/apprc"):
-    with io.open(file_path, "w") as file:
-        file.write(u"# generated by tsuru at {}\n".format(datetime.now()))
-        for name, value in environs.iteritems():
-            value = value.replace("'", "'\\''")
-            file.write(u"export {}='{}'\n".format(name, value))
+    lines = []
+    for name, value in sorted(environs.iteritems()):
+        value = value.replace("'", "'\\''")
+        lines.append(u"export {}='{}'\n".format(name, value))
+    header = u"# generated by tsuru at {}\n".format(datetime.now())
+    return write_file_atomically(file_path, u"".join(lines).encode("utf-8"),
+                                 header=header.encode("utf-8"))
+
+
+def load_envs_etag(file_path="/home/application/apprc"):
+    # The ETag is only useful while the apprc it describes is still around.
+    if not os.path.exists(file_path):
+        return None
+    try:
+        with open(file_path + ".etag") as f:
+            return f.read().strip() or None
+    except IOError:
+        return None
+
+
+def save_envs_etag(etag, file_path="/home/application/apprc"):
+    etag_path = file_path + ".etag"
+    if etag:
+        write_file_atomically(etag_path, etag.encode("utf-8") + b"\n")
+    elif os.path.exists(etag_path):
+        os.remove(etag_path)
+
+
+def customdata_digest(data, version):
+    # Keyed on the ETag of the customdata the API stores, a digest saved
+    # against anything else it has (another deploy, a reset database) never
+    # matches.
+    return hashlib.sha1(json.dumps([version, data], sort_keys=True)).hexdigest()
+
+
+def load_customdata_digest(file_path="/home/application/.customdata.sha1"):
+    try:
+        with open(file_path) as f:
+            return f.read().strip() or None
+    except IOError:
+        return None
+
 
+def save_customdata_digest(digest, file_path="/home/application/.customdata.sha1"):
+    try:
+        write_file_atomically(file_path, digest.encode("utf-8") + b"\n")
+    except (IOError, OSError):
+        pass
+
+
+def _file_digest(file_path, skip_header=False):
+    try:
+        with open(file_path, "rb") as f:
+            if skip_header:
+                f.readline()
+            return hashlib.sha1(f.read()).hexdigest()
+    except IOError:
+        return None
 
+
+def write_file_atomically(file_path, content, header=b""):
+    # The header (e.g. a timestamp) is not taken into account when checking
+    # whether the file changed. Returns False when nothing was written.
+    if header and not header.endswith(b"\n"):
+        raise ValueError("header must be a single line")
+    if _file_digest(file_path, skip_header=bool(header)) == hashlib.sha1(content).hexdigest():
+        return False
+    dir_name, base_name = os.path.split(os.path.abspath(file_path))
+    try:
+        mode = os.stat(file_path).st_mode & 0o777
+    except OSError:
+        mode = 0o644
+    fd, tmp_path = tempfile.mkstemp(prefix="." + base_name + ".", dir=dir_name)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(header)
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, file_path)
+    except:
+        os.remove(tmp_path)
+        raise
+    dir_fd = os.open(dir_name, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return True
+
+
+APPRC_EXPORT_RE = re.compile(r"export ([A-Za-z_][A-Za-z0-9_]*)="
+                             r"(?:'((?:[^']|'\\'')*)'|([^\s'\"\\$`()<>|;&~]*))[ \t]*(?:\n|$)")
+
+
+def _parse_apprc_content(content):
+    # Returns the envs parsed natively and the lines left for the shell.
+    envs = {}
+    unknown = []
+    pos = 0
+    while pos < len(content):
+        end = content.find("\n", pos)
+        if end == -1:
+            end = len(content)
+        line = content[pos:end].strip()
+        if not line or line.startswith("#"):
+            if unknown:
+                # it may be part of a multi-line value the shell evaluates.
+                unknown.append(content[pos:end])
+            pos = end + 1
+            continue
+        match = APPRC_EXPORT_RE.match(content, pos)
+        if match is None:
+            unknown.append(content[pos:end])
+            pos = end + 1
+            continue
+        name, quoted, bare = match.groups()
+        if quoted is not None:
+            envs[name] = quoted.replace("'\\''", "'")
+        else:
+            envs[name] = bare
+        pos = match.end()
+    return envs, unknown
+
+
+@timing.traced("parse_apprc_file")
 def parse_apprc_file(file_path="/home/application/apprc"):
-    # Let the shell parse environment variables for us, there are escaping
-    # edge cases we don't want to be aware of.
-    pipe = subprocess.Popen('source {}; python -c "import os, json; e=dict(); '.format(file_path) +
-                            'e.update(os.environ); print json.dumps(e)"',
-                            shell=True, env={}, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    result = pipe.communicate()
-    return json.loads(result[0])
+    # Files written by save_apprc_file are parsed in process, only the lines
+    # we don't recognise are left for the shell, there are escaping edge
+    # cases we don't want to be aware of.
+    with io.open(file_path, encoding="utf-8") as f:
+        envs, unknown = _parse_apprc_content(f.read())
+    if not unknown:
+        return envs
+    return _parse_apprc_lines_with_shell(unknown, envs)
+
+
+def _parse_apprc_lines_with_shell(lines, envs):
+    # The lines run on top of the envs parsed natively. The env is dumped
+    # before and after them, so vars the shell sets itself (PWD, SHLVL, _)
+    # are the same in both dumps and are left out.
+    dump = '"{}" -c "import os, json; print json.dumps(dict(os.environ))"'.format(sys.executable)
+    script = u"{0}\n{{\n{1}\n}} >&2\n{0}\n".format(dump, u"\n".join(lines))
+    shell_envs = {name.encode("utf-8"): value.encode("utf-8") for name, value in envs.items()}
+    pipe = subprocess.Popen(script.encode("utf-8"), shell=True, env=shell_envs,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    dumps = pipe.communicate()[0].splitlines()
+    if len(dumps) != 2:
+        raise ValueError("unable to evaluate apprc lines: {!r}".format(lines))
+    before, after = json.loads(dumps[0]), json.loads(dumps[1])
+    result = dict(envs)
+    for name in set(before) | set(after):
+        if name not in after:
+            result.pop(name, None)
+        elif before.get(name) != after[name]:
+            result[name] = after[name]
+    return result
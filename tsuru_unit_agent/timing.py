@@ -0,0 +1,119 @@
+# Copyright 2015 tsuru-unit-agent authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import functools
+import json
+import os
+import threading
+import time
+
+
+class Tracer(object):
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.spans = []
+
+    def span(self, name, cat="task", **args):
+        return Span(self, name, cat, args)
+
+    def summary(self, cat="phase"):
+        return " ".join("{}={:.1f}ms".format(name, (end - start) * 1000)
+                        for name, span_cat, start, end, _, _ in sorted(self.spans, key=lambda s: s[2])
+                        if span_cat == cat)
+
+    def chrome_trace(self):
+        events = []
+        for name, cat, start, end, tid, args in sorted(self.spans, key=lambda s: s[2]):
+            events.append({
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": int((start - self.started) * 1e6),
+                "dur": int((end - start) * 1e6),
+                "pid": self.pid,
+                "tid": tid,
+                "args": args,
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+
+class Span(object):
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer.spans.append((self.name, self.cat, self.start, time.time(),
+                                  threading.current_thread().ident, self.args))
+
+
+class NullSpan(object):
+
+    @property
+    def args(self):
+        # writes go to a throwaway dict.
+        return {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+_tracer = None
+
+
+def enable():
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def disable():
+    global _tracer
+    _tracer = None
+
+
+def tracer():
+    return _tracer
+
+
+def span(name, cat="task", **args):
+    """Returns a context manager recording ``name`` in the current tracer.
+
+    It is a shared no-op when tracing is disabled.
+    """
+    if _tracer is None:
+        return NULL_SPAN
+    return _tracer.span(name, cat, **args)
+
+
+def traced(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            with _tracer.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,295 @@
+# Copyright 2015 tsuru-unit-agent authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import collections
+import ConfigParser
+import io
+import logging
+import os
+import re
+import string
+import time
+
+WatchersDiff = collections.namedtuple("WatchersDiff", ["added", "removed", "changed"])
+
+ProcessSettings = collections.namedtuple("ProcessSettings",
+                                         ["numprocesses", "cpu_affinity", "rlimits", "socket", "envs"])
+
+SocketSettings = collections.namedtuple("SocketSettings", ["host", "port", "reuseport"])
+
+TRUE_VALUES = ("1", "true", "yes", "on")
+
+# Seconds to wait for each answer of the circus control socket.
+CIRCUS_TIMEOUT = 2
+
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("Cpus_allowed_list:"):
+                    return _parse_cpu_list(line.split(":", 1)[1])
+    except (IOError, ValueError):
+        pass
+    import multiprocessing
+    return range(multiprocessing.cpu_count())
+
+
+def _parse_cpu_list(value):
+    cpus = []
+    for part in value.strip().split(","):
+        start, _, end = part.partition("-")
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def process_settings(name, app_data=None, envs=None):
+    """Returns the scaling settings for the process type ``name``.
+
+    Settings come from the ``processes`` section in tsuru.yaml and can be
+    overridden by TSURU_PROCESS_<NAME>_NUMPROCESSES, _CPU_AFFINITY,
+    _RLIMIT_<RESOURCE>, _SOCKET_{HOST,PORT,REUSEPORT} and _ENVS (comma
+    separated) env vars.
+    """
+    envs = envs or {}
+    settings = ((app_data or {}).get("processes") or {}).get(name) or {}
+    numprocesses = settings.get("numprocesses")
+    cpu_affinity = settings.get("cpu_affinity", False)
+    rlimits = dict(settings.get("rlimits") or {})
+    declared_envs = settings.get("envs") or []
+    socket = settings.get("socket")
+    if socket is True:
+        socket = {}
+    elif socket:
+        socket = dict(socket)
+    prefix = "TSURU_PROCESS_{}_".format(re.sub(r"[^A-Z0-9]", "_", name.upper()))
+    for key, value in envs.items():
+        if not key.startswith(prefix):
+            continue
+        option = key[len(prefix):]
+        if option == "NUMPROCESSES":
+            numprocesses = value
+        elif option == "CPU_AFFINITY":
+            cpu_affinity = value.lower() in TRUE_VALUES
+        elif option.startswith("RLIMIT_"):
+            rlimits[option[len("RLIMIT_"):].lower()] = value
+        elif option == "ENVS":
+            declared_envs = value.split(",")
+        elif option in ("SOCKET_HOST", "SOCKET_PORT", "SOCKET_REUSEPORT"):
+            if not isinstance(socket, dict):
+                socket = {}
+            socket[option[len("SOCKET_"):].lower()] = value
+    if numprocesses == "auto":
+        numprocesses = len(available_cpus())
+    elif numprocesses is not None:
+        value = numprocesses
+        try:
+            numprocesses = int(value)
+        except ValueError:
+            numprocesses = 0
+        if numprocesses < 1:
+            raise ValueError("invalid numprocesses for process {}: {!r}".format(name, value))
+    for resource, value in rlimits.items():
+        try:
+            rlimits[resource] = int(value)
+        except ValueError:
+            raise ValueError("invalid rlimit {} for process {}: {!r}".format(resource, name, value))
+    if isinstance(socket, dict):
+        socket = _socket_settings(name, socket, envs)
+    else:
+        socket = None
+    declared_envs = tuple(sorted(set(env.strip() for env in declared_envs if env.strip())))
+    return ProcessSettings(numprocesses, bool(cpu_affinity), rlimits, socket, declared_envs)
+
+
+def _socket_settings(name, socket, envs):
+    port = socket.get("port", envs.get("PORT", "8888"))
+    try:
+        port = int(port)
+    except ValueError:
+        raise ValueError("invalid socket port for process {}: {!r}".format(name, port))
+    reuseport = socket.get("reuseport", False)
+    if not isinstance(reuseport, bool):
+        reuseport = str(reuseport).lower() in TRUE_VALUES
+    return SocketSettings(socket.get("host", "0.0.0.0"), port, reuseport)
+
+
+def referenced_envs(cmd):
+    names = set()
+    for match in string.Template.pattern.finditer(cmd):
+        name = match.group("named") or match.group("braced")
+        if name:
+            names.add(name)
+    return names
+
+
+def changed_envs(previous, current):
+    names = set(previous) | set(current)
+    return set(name for name in names if previous.get(name) != current.get(name))
+
+
+def affected_watchers(previous_envs, current_envs, inputs):
+    """Returns the watchers whose inputs changed between two env maps.
+
+    ``inputs`` maps each watcher to the env vars it uses, see
+    :func:`referenced_envs` and the ``envs`` process setting.
+    """
+    changed = changed_envs(previous_envs, current_envs)
+    return sorted(name for name, names in inputs.items() if changed & set(names))
+
+
+def pinned_envs(previous_envs, current_envs, inputs):
+    """Returns, per watcher, the changed env vars to set in its env section.
+
+    Watchers copy the env circusd was started with, a changed var only
+    reaches them through their ``[env:]`` section. The watchers whose inputs
+    changed get every changed var; a var that is nobody's input may be read
+    by any watcher, so then all of them get it. Removed vars are set empty.
+    """
+    changed = changed_envs(previous_envs, current_envs)
+    if not changed:
+        return {}
+    if changed - set().union(*inputs.values()):
+        names = sorted(inputs)
+    else:
+        names = affected_watchers(previous_envs, current_envs, inputs)
+    values = {env: current_envs.get(env, "") for env in changed}
+    return {name: dict(values) for name in names}
+
+
+def _parse_conf(conf):
+    parser = ConfigParser.RawConfigParser()
+    parser.optionxform = str
+    parser.readfp(io.BytesIO(conf))
+    return parser
+
+
+def parse_circus_endpoint(conf):
+    parser = _parse_conf(conf)
+    if parser.has_option("circus", "endpoint"):
+        return parser.get("circus", "endpoint")
+    return "tcp://127.0.0.1:5555"
+
+
+def parse_watchers(conf):
+    parser = _parse_conf(conf)
+    watchers = {}
+    envs = {}
+    for section in parser.sections():
+        kind, _, name = section.partition(":")
+        if kind == "watcher":
+            watchers[name] = dict(parser.items(section))
+        elif kind == "env":
+            envs[name] = dict(parser.items(section))
+    for name, env in envs.items():
+        if name in watchers:
+            watchers[name]["env"] = env
+    return watchers
+
+
+def diff_watchers(current, desired):
+    added = sorted(set(desired) - set(current))
+    removed = sorted(set(current) - set(desired))
+    changed = sorted(name for name in set(current) & set(desired)
+                     if current[name] != desired[name])
+    return WatchersDiff(added, removed, changed)
+
+
+def _circus_value(value):
+    if isinstance(value, dict):
+        return value
+    if value in ("True", "False"):
+        return value == "True"
+    if value.isdigit():
+        return int(value)
+    return value
+
+
+def _circus_options(options):
+    # circus expects stream settings (stdout_stream.class = ...) as dicts.
+    result = {}
+    for key, value in options.items():
+        value = _circus_value(value)
+        if "." in key:
+            prefix, _, sub_key = key.partition(".")
+            result.setdefault(prefix, {})[sub_key] = value
+        else:
+            result[key] = value
+    return result
+
+
+def _watcher_commands(diff, current, desired):
+    commands = []
+    recreate = []
+    for name in diff.changed:
+        if set(current[name]) - set(desired[name]):
+            # options can't be unset through the control socket.
+            recreate.append(name)
+            continue
+        options = {key: value for key, value in desired[name].items()
+                   if current[name].get(key) != value}
+        commands.append({"command": "set",
+                         "properties": {"name": name, "options": _circus_options(options)}})
+    for name in sorted(diff.removed + recreate):
+        commands.append({"command": "rm", "properties": {"name": name}})
+    for name in sorted(diff.added + recreate):
+        options = _circus_options(desired[name])
+        cmd = options.pop("cmd")
+        commands.append({"command": "add",
+                         "properties": {"name": name, "cmd": cmd, "options": options, "start": True}})
+    return commands
+
+
+def apply_watchers_diff(endpoint, diff, current, desired):
+    """Applies ``diff`` through the circus control socket.
+
+    Returns whether circus took every change, a circusd that isn't
+    listening fails after :data:`CIRCUS_TIMEOUT` seconds.
+    """
+    commands = _watcher_commands(diff, current, desired)
+    if not commands:
+        return True
+    try:
+        from circus.client import CircusClient
+        client = CircusClient(endpoint=endpoint, timeout=CIRCUS_TIMEOUT)
+        applied = True
+        try:
+            for command in commands:
+                response = client.call(command)
+                if response.get("status") != "ok":
+                    logging.error("circus refused {}: {}".format(command, response))
+                    applied = False
+        finally:
+            client.stop()
+        return applied
+    except Exception:
+        logging.exception("Unable to apply watcher changes to circus at {}".format(endpoint))
+        return False
+
+
+def wait_for_circus(endpoint, deadline, interval=0.1):
+    """Polls circusd at ``endpoint`` until it answers, or until ``deadline``.
+
+    Returns whether it answered.
+    """
+    try:
+        from circus.client import CircusClient
+    except ImportError:
+        logging.exception("Unable to reach circus at {}".format(endpoint))
+        return False
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        client = CircusClient(endpoint=endpoint, timeout=min(CIRCUS_TIMEOUT, remaining))
+        try:
+            if client.call({"command": "list", "properties": {}}).get("status") == "ok":
+                return True
+        except Exception:
+            pass
+        finally:
+            client.stop()
+        time.sleep(max(min(interval, deadline - time.time()), 0))